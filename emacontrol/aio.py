@@ -0,0 +1,264 @@
+"""
+asyncio versions of the socket connector and robot classes. These allow the
+robot to be controlled from an asyncio event loop, so that waiting for the
+robot to move does not block other tasks (e.g. detector readout or motor
+moves) running in the same loop:
+
+async with AsyncRobot() as ema:
+    await ema.power_on()
+    await ema.mount_sample(5)
+
+The protocol and the checks made on the replies from the controller are the
+same as for the gevent based Robot class.
+"""
+import asyncio
+
+from emacontrol.commands import COMMANDS, coords_command
+from emacontrol.ema import Robot, default_config
+from emacontrol.magazine import Magazine
+from emacontrol.network import read_peer_config
+from emacontrol.sequence import MOUNT, UNMOUNT
+
+
+class AsyncSocketConnector(object):
+
+    def __init__(self, host, port, config_file=None, socket_timeout=120,
+                 persistent=False):
+        self.peer = (host, port)
+        self.reader = None
+        self.writer = None
+        self.socket_timeout = socket_timeout
+        self.config_file = config_file
+        self.persistent = persistent
+        # Created on first use, so that it belongs to the running loop
+        self._lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """
+        Start a persistent session with the controller, keeping the connection
+        open until close is called.
+        """
+        self.persistent = True
+        await self._connect()
+
+    async def close(self):
+        """
+        End a persistent session with the controller, closing the connection.
+        """
+        self.persistent = False
+        await self._disconnect()
+
+    def _read_config(self):
+        self.peer = read_peer_config(self.config_file)
+
+    def is_connected(self):
+        """
+        Reports whether there is an open connection to the controller
+        """
+        # StreamWriter.is_closing is only available from Python 3.7
+        return ((self.writer is not None)
+                and not self.writer.transport.is_closing())
+
+    async def _connect(self):
+        """
+        Connect to the robot controller
+        """
+        if self.is_connected():
+            if not self.reader.at_eof():
+                return
+            # The controller closed the connection since the last message
+            await self._disconnect()
+        if (self.peer[0] is None) or (self.peer[1] is None):
+            self._read_config()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(*self.peer), self.socket_timeout)
+        except asyncio.TimeoutError:
+            msg = 'Connection to {}:{} not made before timeout'.format(
+                *self.peer)
+            raise RuntimeError(msg)
+
+    async def _disconnect(self):
+        """
+        Close the connection (if one exists)
+        """
+        if self.writer is None:
+            return
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+        writer.close()
+        # StreamWriter.wait_closed is only available from Python 3.7
+        wait_closed = getattr(writer, 'wait_closed', None)
+        if wait_closed is None:
+            return
+        try:
+            await wait_closed()
+        except OSError:
+            # Connection already broken
+            pass
+
+    async def _read_reply(self):
+        while True:
+            try:
+                chunk = await self.reader.readuntil(b';')
+            except asyncio.IncompleteReadError:
+                msg = 'Connection closed before reply was received'
+                raise RuntimeError(msg)
+            # Replies are padded with null bytes, which are left over at the
+            # start of the next read
+            reply = chunk.strip(b'\x00').decode('utf-8')
+            if reply != ';':
+                return reply
+
+    async def __send__(self, message, data=None):
+        """
+        Send a message and wait for the reply. To send messages to the robot,
+        use the send method. If the encoded message has already been
+        prepared, it can be passed as data.
+        """
+        if data is None:
+            data = str(message).encode()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            completed = False
+            try:
+                await self._connect()
+                self.writer.write(data)
+                try:
+                    await asyncio.wait_for(self.writer.drain(),
+                                           self.socket_timeout)
+                except asyncio.TimeoutError:
+                    raise RuntimeError('Message not sent before timeout')
+                try:
+                    reply = await asyncio.wait_for(self._read_reply(),
+                                                   self.socket_timeout)
+                except asyncio.TimeoutError:
+                    msg = 'No message delimiter received before timeout'
+                    raise RuntimeError(msg)
+                completed = True
+            finally:
+                if (not self.persistent) or (not completed):
+                    await self._disconnect()
+        return reply
+
+
+class AsyncRobot(AsyncSocketConnector):
+    """
+    Sends commands to the E.M.A. sample changer controller from an asyncio
+    event loop. See Robot for the details of the commands.
+    """
+
+    def __init__(self, config_file=default_config, robot_host=None,
+                 robot_port=None, socket_timeout=60, persistent=False):
+        super().__init__(robot_host, robot_port, config_file=config_file,
+                         socket_timeout=socket_timeout, persistent=persistent)
+        self.sample_index = 1
+        self.started = False
+        self._magazine = None
+
+    @property
+    def magazine(self):
+        """
+        Geometry of the sample magazines (see Robot.magazine)
+        """
+        if self._magazine is None:
+            self._magazine = Magazine.from_config(self.config_file)
+        return self._magazine
+
+    @magazine.setter
+    def magazine(self, magazine):
+        self._magazine = magazine
+
+    async def send(self, message, wait_for=None, parse=True):
+        '''
+        Send a message to the robot controller and wait for a response.
+
+        Parameters
+        ----------
+        message : String message to send to the controller
+        wait_for : String message to wait for the controller to send back
+        parse : Bool should received message be run through message_parser to
+                     check for errors
+        '''
+        return await self._send(message, wait_for, parse)
+
+    async def send_command(self, command, parse=True):
+        """
+        Send a command from the registry (see emacontrol.commands) and wait
+        for the reply it expects.
+        """
+        return await self._send(command.message, command.wait_for, parse,
+                                command.data)
+
+    async def _send(self, message, wait_for, parse, data=None):
+        recvd_msg = await self.__send__(message, data)
+        if parse:
+            output = Robot.parse_message(recvd_msg)
+        else:
+            output = recvd_msg
+        Robot.check_reply(message, recvd_msg, wait_for)
+        return output
+
+    async def set_sample_coords(self, n):
+        """
+        Sets the xy coordinates for the next sample to mount based on the index
+        of that sample. Sends these coordinates to the robot controller.
+
+        Parameters
+        ----------
+        n : integer index of the sample to pick
+        """
+        x_coord, y_coord = self.magazine.index_to_xy(n)
+        await self.send_command(coords_command(x_coord, y_coord))
+        self.sample_index = n
+
+    async def power_on(self):
+        """
+        Switch on the power to the robot, ready to exchange samples
+        """
+        await self.send_command(COMMANDS['powerOn'])
+        self.started = True
+
+    async def power_off(self):
+        """
+        Switch off the power to the robot
+        """
+        await self.send_command(COMMANDS['powerOff'])
+        self.started = False
+
+    def _check_started(self):
+        if self.started is False:
+            msg = 'Robot not started. Did you run the power_on() method?'
+            raise Exception(msg)
+
+    async def mount_sample(self, n):
+        """
+        Mount a sample with the requested index on the sample spinner.
+
+        Parameters
+        ----------
+        n : integer index of the sample to be mounted
+        """
+        self._check_started()
+        await self.set_sample_coords(n)
+        for command in MOUNT:
+            await self.send_command(command)
+
+    async def unmount_sample(self):
+        """
+        Return the sample currently on the spinner to its place in the sample
+        magazine.
+        """
+        self._check_started()
+        for command in UNMOUNT:
+            await self.send_command(command)
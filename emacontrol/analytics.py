@@ -0,0 +1,458 @@
+"""
+Cycle-time analytics over recorded sessions, to find out whether the speeds,
+the magazine layout or the client code limit the number of samples that can
+be exchanged per hour:
+
+python -m emacontrol.analytics session1.log.gz session2.log.gz timings.json
+
+Sessions are read from traffic logs (see emacontrol.recorder) or from
+timings exported by Robot.instrumentation.to_json(history=True). The
+messages of all the sessions are loaded into NumPy arrays (see Timings)
+and the report gives:
+- the distribution of the time taken by each command, and by the moves to
+  each position on the magazine
+- drift: how much each command slows down (or speeds up) per hour of a
+  session
+- outliers: messages which took much longer (or shorter) than usual for
+  their command, found with the median absolute deviation
+- the breakdown of the time taken by exchange cycles into motion (moves),
+  gripping (samplePick, sampleRelease, gripperOpen and gripperClose) and
+  communication (everything else: other messages, the client's own time
+  and the gaps between messages)
+
+A cycle is a run of messages with no gap between them longer than the idle
+gap (e.g. while a sample is measured), which moves the arm. Queries (e.g.
+status polling on the control channel) aren't part of any cycle. Each cycle
+is counted against the magazine position of the sample it leaves on the
+spinner, i.e. the coordinates last set.
+"""
+import argparse
+import json
+import sys
+
+from emacontrol.ema import Robot, default_config
+from emacontrol.instrumentation import command_name
+from emacontrol.magazine import Magazine
+from emacontrol.replay import Session
+from emacontrol.state import MOVE_TARGETS, QUERIES, ControllerState
+
+# Longest gap in seconds between the messages of one cycle
+IDLE_GAP = 2.0
+# Robust z-score above which a message is an outlier
+OUTLIER_Z = 3.5
+# Fewest messages of a command needed to estimate its drift or outliers
+MIN_SAMPLES = 5
+
+GRIPPING = frozenset(['samplePick', 'sampleRelease', 'gripperOpen',
+                      'gripperClose'])
+CATEGORIES = ('motion', 'gripping', 'communication')
+
+
+def _numpy():
+    # NumPy is only needed once sessions are analysed
+    import numpy
+    return numpy
+
+
+def category(command):
+    """
+    Returns the part of the exchange time a command counts towards: motion,
+    gripping or communication
+    """
+    if command in MOVE_TARGETS:
+        return 'motion'
+    if command in GRIPPING:
+        return 'gripping'
+    return 'communication'
+
+
+def _session_rows(path):
+    # Each row is (start, duration, wait, message, reply, failed)
+    with open(path, 'rb') as peek:
+        is_json = peek.read(1) == b'{'
+    if is_json:
+        with open(path, encoding='utf-8') as export:
+            history = json.load(export).get('history', [])
+        first = history[0]['started'] if history else 0.0
+        return [(timing['started'] - first, timing['total'], timing['wait'],
+                 timing['message'], timing['reply'], timing['failed'])
+                for timing in history]
+    return [(exchange.sent, exchange.wait, exchange.wait, exchange.message,
+             exchange.reply, exchange.reply is None)
+            for exchange in Session.from_log(path).exchanges]
+
+
+class Timings(object):
+    """
+    The messages of one or more sessions, as NumPy arrays with one element
+    per message.
+
+    Parameters
+    ----------
+    paths : list of String paths of traffic logs or instrumentation exports
+    magazine : Magazine used to find the position of the coordinates set
+               (default geometry if None)
+
+    Attributes
+    ----------
+    sessions : list of String paths of the sessions
+    commands : list of String command names
+    session : integer array, index of the session in sessions
+    time : float array, time in seconds from the start of the session the
+           message was sent
+    duration : float array, time in seconds taken by the message (including
+               the client's own time, if it was recorded)
+    wait : float array, time in seconds waiting for the reply
+    command : integer array, index of the command in commands
+    slot : integer array, index of the magazine position of the coordinates
+           set when the message was sent (0 if unknown)
+    failed : boolean array, True if the message failed or had no reply
+    """
+
+    def __init__(self, paths, magazine=None):
+        np = _numpy()
+        magazine = Magazine() if magazine is None else magazine
+        self.sessions = list(paths)
+        self.commands = []
+        codes = {}
+        columns = ([], [], [], [], [], [], [])
+        for index, path in enumerate(self.sessions):
+            state = ControllerState()
+            for start, duration, wait, message, reply, failed in \
+                    sorted(_session_rows(path), key=lambda row: row[0]):
+                if reply is not None:
+                    try:
+                        parsed = Robot.parse_message(reply)
+                    except ValueError:
+                        parsed = None
+                    coords = state.coords
+                    state.update(message, reply, parsed)
+                    if command_name(message) != 'setCoords' and \
+                            state.coords is None:
+                        # Only setCoords changes the coordinates
+                        state.coords = coords
+                command = command_name(message)
+                if command not in codes:
+                    codes[command] = len(self.commands)
+                    self.commands.append(command)
+                slot = 0
+                if state.coords is not None:
+                    try:
+                        slot = magazine.xy_to_index(*state.coords)
+                    except ValueError:
+                        pass
+                for column, value in zip(columns, (
+                        index, start, duration, wait, codes[command], slot,
+                        failed)):
+                    column.append(value)
+        self.session = np.array(columns[0], dtype=int)
+        self.time = np.array(columns[1], dtype=float)
+        self.duration = np.array(columns[2], dtype=float)
+        self.wait = np.array(columns[3], dtype=float)
+        self.command = np.array(columns[4], dtype=int)
+        self.slot = np.array(columns[5], dtype=int)
+        self.failed = np.array(columns[6], dtype=bool)
+
+    def __len__(self):
+        return len(self.time)
+
+    def of_command(self, command):
+        """
+        Returns a boolean mask of the messages of a command
+        """
+        if command not in self.commands:
+            return self.command < 0
+        return self.command == self.commands.index(command)
+
+    def cycles(self, idle_gap=IDLE_GAP):
+        """
+        Split the sessions into exchange cycles.
+
+        Parameters
+        ----------
+        idle_gap : float longest gap in seconds between messages of a cycle
+
+        Returns
+        -------
+        dict of float or integer arrays with one element per cycle: session,
+        time (start), total, motion, gripping, communication and slot
+        """
+        np = _numpy()
+        categories = [category(command) for command in self.commands]
+        queries = np.array([command in QUERIES for command in self.commands],
+                           dtype=bool)
+        cycles = {name: [] for name in ('session', 'time', 'total', 'motion',
+                                        'gripping', 'slot')}
+        current = None
+        for i in np.flatnonzero(~queries[self.command]):
+            end = self.time[i] + self.duration[i]
+            if current is None or current['session'] != self.session[i] or \
+                    self.time[i] - current['end'] > idle_gap:
+                self._add_cycle(cycles, current)
+                current = {'session': self.session[i], 'time': self.time[i],
+                           'end': end, 'motion': 0.0, 'gripping': 0.0}
+            current['end'] = max(current['end'], end)
+            current['slot'] = self.slot[i]
+            kind = categories[self.command[i]]
+            if kind != 'communication':
+                current[kind] += self.wait[i]
+        self._add_cycle(cycles, current)
+
+        result = {name: np.array(values, dtype=int if name in (
+            'session', 'slot') else float) for name, values in cycles.items()}
+        result['communication'] = np.maximum(
+            0.0, result['total'] - result['motion'] - result['gripping'])
+        return result
+
+    @staticmethod
+    def _add_cycle(cycles, cycle):
+        if cycle is None or cycle['motion'] == 0.0:
+            # Nothing moved, so this wasn't an exchange
+            return
+        cycles['session'].append(cycle['session'])
+        cycles['time'].append(cycle['time'])
+        cycles['total'].append(cycle['end'] - cycle['time'])
+        cycles['motion'].append(cycle['motion'])
+        cycles['gripping'].append(cycle['gripping'])
+        cycles['slot'].append(cycle['slot'])
+
+
+def distribution(values):
+    """
+    Returns the count, mean, standard deviation, minimum, median, 90th and
+    99th percentiles and maximum of an array of durations
+    """
+    np = _numpy()
+    if len(values) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'count': int(len(values)), 'mean': float(np.mean(values)),
+            'std': float(np.std(values)), 'min': float(np.min(values)),
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+            'max': float(np.max(values))}
+
+
+def drift(times, values):
+    """
+    Fit a straight line to durations against the time in the session they
+    were measured at.
+
+    Returns
+    -------
+    float : change of the duration in seconds per hour (None if there are
+            too few values to tell)
+    """
+    np = _numpy()
+    if len(values) < MIN_SAMPLES or np.ptp(times) == 0:
+        return None
+    slope = np.polyfit(times / 3600.0, values, 1)[0]
+    return float(slope)
+
+
+def robust_z(values):
+    """
+    Returns the robust z-score of each value, from the median and the median
+    absolute deviation (zero for every value if there are too few values or
+    they hardly vary)
+    """
+    np = _numpy()
+    if len(values) < MIN_SAMPLES:
+        return np.zeros(len(values))
+    values = np.asarray(values, dtype=float)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    if mad == 0:
+        return np.zeros(len(values))
+    return 0.6745 * (values - median) / mad
+
+
+class CycleReport(object):
+    """
+    Statistics of the commands and exchange cycles of some sessions.
+
+    Parameters
+    ----------
+    timings : Timings of the sessions
+    idle_gap : float longest gap in seconds between messages of a cycle
+    outlier_z : float robust z-score above which a message is an outlier
+    """
+
+    def __init__(self, timings, idle_gap=IDLE_GAP, outlier_z=OUTLIER_Z):
+        np = _numpy()
+        self.timings = timings
+        self.cycles = timings.cycles(idle_gap)
+
+        self.commands = {}
+        self.outliers = []
+        ok = ~timings.failed
+        for command in timings.commands:
+            mask = timings.of_command(command) & ok
+            durations = timings.duration[mask]
+            stats = distribution(durations)
+            stats['category'] = category(command)
+            stats['drift'] = drift(timings.time[mask], durations)
+            z = robust_z(durations)
+            outlying = np.abs(z) > outlier_z
+            stats['outliers'] = int(np.count_nonzero(outlying))
+            self.commands[command] = stats
+            indices = np.flatnonzero(mask)[outlying]
+            for i, score in zip(indices, z[outlying]):
+                self.outliers.append({
+                    'session': timings.sessions[timings.session[i]],
+                    'time': float(timings.time[i]), 'command': command,
+                    'duration': float(timings.duration[i]),
+                    'z': float(score)})
+        self.outliers.sort(key=lambda outlier: -abs(outlier['z']))
+
+        self.slots = {}
+        moves = timings.of_command('moveCoords') & ok & (timings.slot > 0)
+        cycles = self.cycles
+        for slot in np.union1d(np.unique(timings.slot[moves]),
+                               np.unique(cycles['slot'][cycles['slot'] > 0])):
+            self.slots[int(slot)] = {
+                'moveCoords': distribution(
+                    timings.duration[moves & (timings.slot == slot)]),
+                'cycle': distribution(
+                    cycles['total'][cycles['slot'] == slot])}
+
+        total = float(np.sum(cycles['total']))
+        self.breakdown = {}
+        for name in CATEGORIES:
+            spent = float(np.sum(cycles[name]))
+            self.breakdown[name] = {
+                'seconds': spent, 'share': spent / total if total else 0.0}
+
+    @property
+    def cycle_time(self):
+        return distribution(self.cycles['total'])
+
+    @property
+    def samples_per_hour(self):
+        """
+        Samples per hour if cycles followed each other without any time
+        between them (None if there were no cycles)
+        """
+        stats = self.cycle_time
+        if not stats['count'] or not stats['mean']:
+            return None
+        return 3600.0 / stats['mean']
+
+    def advice(self):
+        """
+        Returns what limits the number of samples per hour most
+        """
+        if not len(self.cycles['total']):
+            return 'No exchange cycles found'
+        largest = max(CATEGORIES, key=lambda name: self.breakdown[name][
+            'seconds'])
+        advice = {'motion': 'tune the speed profiles',
+                  'gripping': 'tune the gripping speed of the controller '
+                              'program',
+                  'communication': 'reduce the time spent by the client and '
+                                   'on messages between moves'}[largest]
+        text = '{} takes the largest share of exchange time ({:.0%}): ' \
+               '{}'.format(largest.capitalize(),
+                           self.breakdown[largest]['share'], advice)
+        means = [stats['moveCoords']['mean'] for stats in self.slots.values()
+                 if stats['moveCoords']['count']]
+        if len(means) > 1 and min(means) > 0 and \
+                max(means) > 1.5 * min(means):
+            text += '; moves to the slowest magazine positions take {:.1f}x ' \
+                    'as long as to the fastest, so the magazine layout (or ' \
+                    'sample order) matters'.format(max(means) / min(means))
+        return text
+
+    def as_dict(self):
+        return {'sessions': self.timings.sessions,
+                'messages': len(self.timings),
+                'cycles': self.cycle_time,
+                'samples_per_hour': self.samples_per_hour,
+                'breakdown': self.breakdown,
+                'commands': self.commands,
+                'slots': self.slots,
+                'outliers': self.outliers,
+                'advice': self.advice()}
+
+    def format(self, max_outliers=10):
+        lines = ['{:d} messages in {:d} sessions, {:d} exchange cycles'.format(
+            len(self.timings), len(self.timings.sessions),
+            len(self.cycles['total']))]
+        cycle = self.cycle_time
+        if cycle['count']:
+            lines.append('Cycle time: mean {mean:.3f} s, median {p50:.3f} s, '
+                         'p90 {p90:.3f} s ({:.1f} samples per hour)'.format(
+                             self.samples_per_hour, **cycle))
+            lines.append('  ' + ', '.join(
+                '{} {:.3f} s ({:.0%})'.format(name, part['seconds'],
+                                              part['share'])
+                for name, part in self.breakdown.items()))
+
+        lines.append('')
+        lines.append('{:<16} {:>6} {:>8} {:>8} {:>8} {:>8} {:>10} {:>4}'
+                     ''.format('command', 'count', 'mean', 'p50', 'p90',
+                               'max', 'drift/h', 'out'))
+        for command, stats in sorted(self.commands.items()):
+            if not stats['count']:
+                continue
+            drift_text = '-' if stats['drift'] is None else \
+                '{:+.3f}'.format(stats['drift'])
+            lines.append('{:<16} {count:>6d} {mean:>8.3f} {p50:>8.3f} '
+                         '{p90:>8.3f} {max:>8.3f} {:>10} {outliers:>4d}'
+                         ''.format(command, drift_text, **stats))
+
+        if self.slots:
+            lines.append('')
+            lines.append('{:<6} {:>14} {:>14}'.format(
+                'slot', 'moveCoords', 'cycle'))
+            for slot, stats in sorted(self.slots.items()):
+                lines.append('{:<6d} {:>14} {:>14}'.format(
+                    slot, _mean_text(stats['moveCoords']),
+                    _mean_text(stats['cycle'])))
+
+        if self.outliers:
+            lines.append('')
+            lines.append('Outliers:')
+            for outlier in self.outliers[:max_outliers]:
+                lines.append('  {session} at {time:.1f} s: {command} took '
+                             '{duration:.3f} s (z {z:+.1f})'.format(**outlier))
+        lines.append('')
+        lines.append(self.advice())
+        return '\n'.join(lines)
+
+
+def _mean_text(stats):
+    if not stats['count']:
+        return '-'
+    return '{:.3f} s ({:d})'.format(stats['mean'], stats['count'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Analyse the cycle times of recorded E.M.A. sessions')
+    parser.add_argument('sessions', nargs='+',
+                        help='Traffic logs (see emacontrol.recorder) or '
+                             'instrumentation exports')
+    parser.add_argument('--config', default=default_config,
+                        help='Robot config file, for the magazine geometry '
+                             '(default: %(default)s)')
+    parser.add_argument('--idle-gap', type=float, default=IDLE_GAP,
+                        help='Longest gap in seconds between the messages '
+                             'of a cycle (default: %(default)s)')
+    parser.add_argument('--outlier-z', type=float, default=OUTLIER_Z,
+                        help='Robust z-score above which a message is an '
+                             'outlier (default: %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    timings = Timings(args.sessions, Magazine.from_config(args.config))
+    report = CycleReport(timings, args.idle_gap, args.outlier_z)
+    if args.json:
+        print(json.dumps(report.as_dict(), indent=2))
+    else:
+        print(report.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
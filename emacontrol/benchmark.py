@@ -0,0 +1,282 @@
+"""
+Benchmarks for the time taken to exchange messages with the robot controller.
+
+The benchmarks are run against the local controller simulator, so that the
+time measured is the time spent by the client (connecting, sending, waiting,
+parsing) rather than by the robot moving. The results reported are:
+- round-trip time of Robot.send and Robot.set_sample_coords
+- Python-side overhead per command: the round-trip time less that of a bare
+  socket exchanging the same message on an open connection
+- cycle time of a full mount + unmount exchange, with the number of messages
+  sent and connections opened for each cycle
+- time taken to parse replies, compared with the original regular expression
+  based parser
+
+Run from the command line with:
+    python -m emacontrol.benchmark
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import re
+import socket
+import time
+
+from emacontrol.ema import Robot
+from emacontrol.sequence import MOUNT, UNMOUNT
+from emacontrol.simulator import ControllerSimulator
+from emacontrol.utils import input_to_int
+
+MODES = ('per-message', 'persistent')
+
+# A mix of replies typical of a sample exchange run
+PARSE_MESSAGES = ('moveCoords:done;', 'samplePick:done;', 'moveGate:done;',
+                  'moveSpinner:done;', 'sampleRelease:done;',
+                  'moveOffside:done;', 'getCoords:#X4#Y2;',
+                  'getPowerState:#On;',
+                  'powerOn:fail_\'RobotPowerCannotBeSwitched\';',
+                  )
+
+
+def percentile(values, pct):
+    """
+    Calculate a percentile of a list of values, interpolating between the
+    closest ranks.
+
+    Parameters
+    ----------
+    values : list of numbers
+    pct : float percentile to calculate (0-100)
+
+    Returns
+    -------
+    float : the percentile
+    """
+    ordered = sorted(values)
+    if not ordered:
+        raise ValueError('Cannot calculate percentile of no values')
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarise(durations):
+    """
+    Summarise a list of durations (in seconds) as p50/p95/p99 and mean
+    """
+    return {'n': len(durations),
+            'mean': sum(durations) / len(durations),
+            'p50': percentile(durations, 50),
+            'p95': percentile(durations, 95),
+            'p99': percentile(durations, 99),
+            }
+
+
+def time_calls(func, iterations):
+    """
+    Call a function repeatedly, returning how long each call took
+    """
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def raw_round_trips(address, message, iterations):
+    """
+    Time exchanging a message on a bare, already connected socket. This is the
+    least time any client could take, so serves as the floor for calculating
+    client overhead.
+    """
+    msg_bytes = message.encode()
+    with socket.create_connection(address) as sock:
+        def exchange():
+            sock.sendall(msg_bytes)
+            reply = b''
+            while b';' not in reply:
+                reply += sock.recv(1024)
+        return time_calls(exchange, iterations)
+
+
+def exchange_cycle(robot, sample):
+    """
+    Mount and then unmount a sample with the given robot. In a persistent
+    session the mount and unmount sequences are run on the open socket.
+    Otherwise each message is sent on a socket of its own, as run_sequence
+    would keep one socket open for all of the steps.
+    """
+    if robot.persistent:
+        robot.mount(sample)
+        robot.unmount()
+        return
+    robot.set_sample_coords(sample)
+    for step in MOUNT + UNMOUNT:
+        robot.send_command(step)
+
+
+def legacy_parse_message(message):
+    """
+    The original implementation of Robot.parse_message, kept as a reference
+    for benchmarking the current one.
+    """
+    command, response = message.strip(';').split(':')
+    result = ''
+    state = {}
+
+    if response[0] == '#':
+        parameters = re.findall(r'[A-Za-z]+\d*\.*\d*', response)
+        for i in range(len(parameters)):
+            chars = re.search(r'[A-Za-z]+', parameters[i]).group()
+            nums = re.search(r'\d+\.*\d*', parameters[i])
+            if nums:
+                try:
+                    state[chars] = input_to_int(nums.group())
+                except ValueError:
+                    state[chars] = float(nums.group())
+            else:
+                state[i] = chars
+    else:
+        response = response.split('_')
+        result = response[0]
+        if len(response) == 2:
+            state[0] = response[1].strip('\'')
+
+    return {'command': command, 'result': result, 'state': state}
+
+
+def run_parse_benchmark(iterations=10000, messages=PARSE_MESSAGES):
+    """
+    Compare the time taken to parse replies with Robot.parse_message and with
+    the original parser.
+
+    Parameters
+    ----------
+    iterations : integer number of times each message is parsed
+    messages : iterable of messages to parse
+
+    Returns
+    -------
+    dict of the mean time per message (in seconds) for each parser and the
+    speedup of the current parser over the original one
+    """
+    results = {}
+    for name, parser in (('legacy', legacy_parse_message),
+                         ('current', Robot.parse_message)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for message in messages:
+                parser(message)
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed / (iterations * len(messages))
+    results['speedup'] = results['legacy'] / results['current']
+    return results
+
+
+def run_benchmarks(iterations=100, cycles=10, motion_time=0.0, modes=MODES):
+    """
+    Run all of the benchmarks against a local controller simulator.
+
+    Parameters
+    ----------
+    iterations : integer number of times each command is sent
+    cycles : integer number of mount/unmount cycles to run
+    motion_time : float time in seconds the simulator takes for each motion
+    modes : iterable of connection modes to benchmark ('per-message' opens a
+            new socket for each message; 'persistent' keeps one open)
+
+    Returns
+    -------
+    dict of results for each mode, with timings in seconds
+    """
+    results = {}
+    with ControllerSimulator(motion_time=motion_time) as simulator:
+        floor = summarise(raw_round_trips(simulator.address, 'getCoords;',
+                                          iterations))
+        results['raw socket'] = {'getCoords': floor}
+
+        for mode in modes:
+            robot = Robot(robot_host=simulator.host,
+                          robot_port=simulator.port,
+                          persistent=(mode == 'persistent'))
+            with contextlib.ExitStack() as stack:
+                if robot.persistent:
+                    stack.enter_context(robot)
+                send = summarise(time_calls(
+                    lambda: robot.send('getCoords;'), iterations))
+                # Alternate between two samples, as setting the coordinates
+                # already set is skipped without sending anything
+                samples = itertools.cycle((75, 76))
+                coords = summarise(time_calls(
+                    lambda: robot.set_sample_coords(next(samples)),
+                    iterations))
+                messages = len(simulator.received)
+                connections = simulator.connections
+                cycle = summarise(time_calls(
+                    lambda: exchange_cycle(robot, 75), cycles))
+                cycle['messages'] = (len(simulator.received)
+                                     - messages) / cycles
+                cycle['connections'] = (simulator.connections
+                                        - connections) / cycles
+
+            send['overhead'] = send['p50'] - floor['p50']
+            coords['overhead'] = coords['p50'] - floor['p50']
+            results[mode] = {'send': send,
+                             'set_sample_coords': coords,
+                             'mount+unmount': cycle,
+                             }
+    return results
+
+
+def format_results(results):
+    """
+    Format benchmark results as a table with timings in milliseconds
+    """
+    row = '{:<12} {:<18} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>9}'
+    lines = ['{:<12} {:<18} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+        'mode', 'operation', 'n', 'p50', 'p95', 'p99', 'overhead')]
+    for mode, operations in results.items():
+        for operation, stats in operations.items():
+            overhead = stats.get('overhead')
+            if overhead is None:
+                overhead = ''
+            else:
+                overhead = '{:.3f}'.format(overhead * 1e3)
+            lines.append(row.format(mode, operation, stats['n'],
+                                    stats['p50'] * 1e3, stats['p95'] * 1e3,
+                                    stats['p99'] * 1e3, overhead))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark E.M.A. client command latency')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--motion-time', type=float, default=0.0)
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='Connection mode to benchmark (default: all)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.iterations, args.cycles, args.motion_time,
+                             args.mode or MODES)
+    parse_results = run_parse_benchmark()
+    if args.json:
+        results['parse_message'] = parse_results
+        print(json.dumps(results, indent=2))
+    else:
+        print('Timings in ms')
+        print(format_results(results))
+        print('parse_message: {:.2f} us per message (original: {:.2f} us, '
+              'speedup x{:.1f})'.format(parse_results['current'] * 1e6,
+                                        parse_results['legacy'] * 1e6,
+                                        parse_results['speedup']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+Registry of the commands understood by the comm program on the robot
+controller (the switch command table in val3/comm.pgx).
+
+Each command is a Command object holding the message sent, the reply
+expected when it has completed and both encoded as bytes, so nothing needs
+to be formatted or encoded when a command is sent. The controller reads
+messages into a 32 byte buffer (asciiMessage in comm.pgx) and sends replies
+from a 64 byte buffer (asciiMessage in sendStatus.pgx), so messages and
+expected replies are checked against these limits when the commands are
+created.
+
+Commands with parameters (setCoords and setSpeed) are created by functions,
+which cache the commands they make. There are only as many different
+setCoords messages as there are positions in the magazine.
+
+check_program compares the registry with the comm program, so that changes
+to the controller program which the client doesn't know about are found
+before they are needed:
+
+python -m emacontrol.commands val3/comm.pgx
+"""
+import functools
+import os
+import re
+import sys
+
+# Size of the buffer the controller reads messages into, including the ;
+MESSAGE_SIZE = 32
+# Size of the buffer the controller sends replies from, including the ;
+REPLY_SIZE = 64
+
+
+class Command(object):
+    """
+    A message for the controller and the reply expected.
+
+    Parameters
+    ----------
+    message : String message to send, ending with ;
+    wait_for : String reply expected when the command completes (None if the
+               reply varies, e.g. for queries)
+
+    Raises
+    ------
+    ValueError : if the message or reply is too long for the controller
+    """
+    __slots__ = ('name', 'message', 'wait_for', 'data', 'reply_data')
+
+    def __init__(self, message, wait_for=None):
+        self.name = message.split(':', 1)[0].rstrip(';')
+        self.message = message
+        self.wait_for = wait_for
+        self.data = message.encode()
+        if len(self.data) > MESSAGE_SIZE:
+            raise ValueError('Message "{}" is longer than the {} bytes the '
+                             'controller reads'.format(message, MESSAGE_SIZE))
+        if wait_for is None:
+            self.reply_data = None
+        else:
+            self.reply_data = wait_for.encode()
+            if len(self.reply_data) > REPLY_SIZE:
+                raise ValueError('Reply "{}" is longer than the {} bytes the '
+                                 'controller sends'.format(wait_for,
+                                                           REPLY_SIZE))
+
+    def __repr__(self):
+        return 'Command({!r}, {!r})'.format(self.message, self.wait_for)
+
+
+def _done(name):
+    return Command('{};'.format(name), '{}:done;'.format(name))
+
+
+# Commands without parameters, in the order of the switch table
+COMMANDS = {command.name: command for command in (
+    Command('hello;', 'world;'),
+    # test only prints on the pendant and doesn't reply
+    Command('test;'),
+    Command('getCoords;'),
+    Command('getSpeed;'),
+    _done('powerOn'),
+    _done('powerOff'),
+    Command('getPowerState;'),
+    _done('interrupt'),
+    # The controller sends restart:done;; so the first ; is part of the reply
+    Command('restart;', 'restart:done;'),
+    Command('getGripperState;'),
+    _done('moveCoords'),
+    _done('moveGate'),
+    _done('moveHome'),
+    _done('moveSpinner'),
+    _done('moveOffside'),
+    _done('moveZero'),
+    _done('moveBin'),
+    _done('samplePick'),
+    _done('sampleRelease'),
+    _done('gripperOpen'),
+    _done('gripperClose'),
+)}
+
+# Commands which take parameters (see coords_command and speed_command)
+PARAMETER_COMMANDS = ('setCoords', 'setSpeed')
+
+
+def command(name):
+    """
+    Returns the command with the given name
+
+    Raises
+    ------
+    ValueError : if there is no such command (or it needs parameters)
+    """
+    try:
+        return COMMANDS[name]
+    except KeyError:
+        raise ValueError('Unknown command "{}"'.format(name))
+
+
+def command_for(message):
+    """
+    Returns the command for any message, with the reply expected if the
+    message is a command in the registry or a command with parameters (e.g.
+    a message recorded while the robot was running)
+    """
+    name = message.split(':', 1)[0].rstrip(';')
+    if name in COMMANDS and COMMANDS[name].message == message:
+        return COMMANDS[name]
+    if name in PARAMETER_COMMANDS:
+        return Command(message, '{}:done;'.format(name))
+    return Command(message)
+
+
+@functools.lru_cache(maxsize=1024)
+def coords_command(x_coord, y_coord):
+    """
+    Returns the command setting the magazine coordinates of the next sample
+    """
+    return Command('setCoords:#X{0:d}#Y{1:d};'.format(x_coord, y_coord),
+                   'setCoords:done;')
+
+
+@functools.lru_cache(maxsize=64)
+def speed_command(speed):
+    """
+    Returns the command setting the speed of the arm
+    """
+    return Command('setSpeed:#{:g};'.format(speed), 'setSpeed:done;')
+
+
+_CASE_RE = re.compile(r'^\s*case\s+"(\w+)"')
+_BLOCK_END_RE = re.compile(r'^\s*(case\s|default|endSwitch)')
+_STRING_RE = re.compile(r'"([^"]*)"')
+_REPLY_RE = re.compile(r'^\w*:(done|fail_)')
+
+
+def _program_lines(path):
+    with open(path, encoding='utf-8-sig') as program:
+        for line in program:
+            # Skip commented out code
+            if not line.strip().startswith('//'):
+                yield line
+
+
+def read_switch_table(path):
+    """
+    Read the switch command table of the comm program.
+
+    Parameters
+    ----------
+    path : String path of comm.pgx
+
+    Returns
+    -------
+    dict : of command names to the strings used in the code for each case
+    """
+    table = {}
+    strings = None
+    for line in _program_lines(path):
+        match = _CASE_RE.match(line)
+        if match:
+            strings = table.setdefault(match.group(1), [])
+            continue
+        if _BLOCK_END_RE.match(line):
+            strings = None
+        elif strings is not None:
+            strings.extend(_STRING_RE.findall(line))
+    return table
+
+
+def check_program(path):
+    """
+    Compare the command registry with the comm program on the controller.
+
+    The commands in the switch table must match the registry and fixed
+    replies in the table must be the ones expected. Replies in any of the
+    programs in the same directory must fit in the 64 byte reply buffer of
+    sendStatus, as otherwise the ; is cut off and the reply never ends.
+
+    Parameters
+    ----------
+    path : String path of comm.pgx
+
+    Returns
+    -------
+    list of Strings : describing each difference found (empty if none)
+    """
+    problems = []
+    table = read_switch_table(path)
+    known = set(COMMANDS) | set(PARAMETER_COMMANDS)
+    for name in sorted(set(table) - known):
+        problems.append('Command "{}" is not in the registry'.format(name))
+    for name in sorted(known - set(table)):
+        problems.append('Command "{}" is not in the program'.format(name))
+
+    for name, strings in sorted(table.items()):
+        wait_for = COMMANDS[name].wait_for if name in COMMANDS else None
+        for string in strings:
+            if (wait_for is None) or not string.startswith(name + ':done'):
+                continue
+            # sendStatus adds a ; and the reply ends at the first ;
+            reply = string.partition(';')[0] + ';'
+            if reply != wait_for:
+                problems.append('Command "{}" replies "{}", expected "{}"'
+                                .format(name, reply, wait_for))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.pgx'):
+            continue
+        for line in _program_lines(os.path.join(directory, filename)):
+            for string in _STRING_RE.findall(line):
+                if _REPLY_RE.match(string) and \
+                        len((string + ';').encode()) > REPLY_SIZE:
+                    problems.append('Reply "{}" in {} is longer than {} bytes'
+                                    .format(string, filename, REPLY_SIZE))
+    return problems
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join('val3',
+                                                              'comm.pgx')
+    problems = check_program(path)
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print('{} matches the command registry'.format(path))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+"""
+A daemon which owns the connection to the robot controller, so that several
+scripts (or a script and a GUI) can use the sample changer at the same time
+without getting in each other's way.
+
+The daemon is started with:
+
+emacontrol serve
+
+It keeps one persistent Robot, with its shadow of the controller state, and
+listens for requests on a local Unix socket. Scripts send requests with a
+DaemonClient, which connects straight away as there is no config to read or
+controller connection to make:
+
+client = DaemonClient()
+client.exchange(12)
+print(client.status())
+
+Requests and replies are single lines of JSON:
+
+{"id": 1, "method": "mount", "params": {"n": 12}}
+{"id": 1, "result": {...}}  or  {"id": 1, "error": {"type": ..., ...}}
+
+Requests wait in a priority queue. Aborts come first, then status queries
+(and restart), then everything which moves the robot or changes its setup,
+in the order they were received. Moves are run one at a time. Aborts and
+status queries are sent on the controller's second connection (see
+Robot.control_channel), so a separate worker handles them while a move is
+running and they are answered straight away.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import socket
+import sys
+
+from emacontrol.ema import Robot, default_config
+from emacontrol.operation import OperationCancelled
+from emacontrol.speed import get_profile
+
+default_socket = os.path.join(os.path.expanduser('~'), '.emacontrol.sock')
+
+# Priorities of the requests (lowest first)
+ABORT = 0
+QUERY = 1
+MOTION = 2
+
+# Priority of each method the daemon handles
+METHODS = {'abort': ABORT,
+           'ping': QUERY,
+           'status': QUERY,
+           'restart': QUERY,
+           'shutdown': QUERY,
+           'power_on': MOTION,
+           'power_off': MOTION,
+           'speed_profile': MOTION,
+           'mount': MOTION,
+           'unmount': MOTION,
+           'exchange': MOTION,
+           }
+
+
+def _gevent():
+    # gevent is only needed by the daemon, not by its clients
+    import gevent
+    import gevent.event
+    import gevent.lock
+    import gevent.server
+    import gevent.socket
+    return gevent
+
+
+class Request(object):
+    """
+    A request received by the daemon, with the connection to send the reply
+    on.
+    """
+    __slots__ = ('id', 'method', 'params', 'priority', '_reply')
+
+    def __init__(self, id, method, params, reply):
+        self.id = id
+        self.method = method
+        self.params = params
+        self.priority = METHODS[method]
+        self._reply = reply
+
+    def respond(self, result=None, error=None):
+        message = {'id': self.id}
+        if error is None:
+            message['result'] = result
+        else:
+            message['error'] = {'type': error.__class__.__name__,
+                                'message': str(error)}
+        self._reply(message)
+
+
+class RequestQueue(object):
+    """
+    Requests waiting to be handled. Requests are taken in order of priority
+    and, within a priority, in the order they were put on the queue.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._added = _gevent().event.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, request):
+        heapq.heappush(self._heap,
+                       (request.priority, next(self._counter), request))
+        self._added.set()
+
+    def get(self, max_priority=None):
+        """
+        Returns the next request, waiting for one if there isn't one.
+
+        Parameters
+        ----------
+        max_priority : integer only take requests with this priority or a
+                       higher one (lower number; None takes any request)
+        """
+        while True:
+            if self._heap and ((max_priority is None)
+                               or (self._heap[0][0] <= max_priority)):
+                return heapq.heappop(self._heap)[2]
+            self._added.clear()
+            self._added.wait()
+
+    def remove(self, priority):
+        """
+        Remove and return all the requests with the given priority
+        """
+        removed = [entry[2] for entry in self._heap if entry[0] == priority]
+        self._heap = [entry for entry in self._heap if entry[0] != priority]
+        heapq.heapify(self._heap)
+        return removed
+
+
+def _sequence_result(result):
+    if result is None:
+        # The robot didn't need to move
+        return None
+    return {'name': result.name,
+            'total': result.total,
+            'steps': [{'message': step.message, 'reply': step.reply,
+                       'duration': step.duration} for step in result.steps]}
+
+
+class RobotDaemon(object):
+    """
+    Serves requests for a robot on a local Unix socket.
+
+    Parameters
+    ----------
+    robot : Robot to control. It is kept connected while the daemon runs
+    socket_path : String path of the Unix socket to listen on
+    status_interval : float time in seconds between reads of the robot
+                      status in the background (None to not read it)
+    """
+
+    def __init__(self, robot, socket_path=default_socket,
+                 status_interval=None):
+        self.robot = robot
+        self.socket_path = socket_path
+        self.status_interval = status_interval
+        self.queue = RequestQueue()
+        self.operation = None
+        self._server = None
+        self._workers = []
+        self._stopped = None
+
+    def start(self):
+        """
+        Start listening for requests
+        """
+        gevent = _gevent()
+        self._stopped = gevent.event.Event()
+        listener = self._listen()
+        try:
+            self.robot.open()
+        except Exception:
+            listener.close()
+            os.unlink(self.socket_path)
+            raise
+        if self.status_interval is not None:
+            self.robot.start_status_polling(self.status_interval)
+        self._server = gevent.server.StreamServer(listener, self._serve)
+        self._server.start()
+        self._workers = [gevent.spawn(self._work),
+                         gevent.spawn(self._work, QUERY)]
+        return self
+
+    def serve_forever(self):
+        """
+        Handle requests until the daemon is stopped (e.g. by a shutdown
+        request)
+        """
+        if self._server is None:
+            self.start()
+        try:
+            self._stopped.wait()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop handling requests and close the connection to the robot
+        """
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.stop()
+        if self.operation is not None:
+            self.operation.cancel()
+        _gevent().killall(self._workers)
+        self._workers = []
+        self.robot.stop_status_polling()
+        self.robot.close_control_channel()
+        self.robot.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._stopped.set()
+
+    def _listen(self):
+        gevent = _gevent()
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # Left behind by a daemon which didn't stop cleanly
+                os.unlink(self.socket_path)
+            else:
+                raise RuntimeError('A daemon is already listening on {}'
+                                   .format(self.socket_path))
+            finally:
+                probe.close()
+        listener = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the daemon may send it requests. The socket
+        # is created without access for anyone else, rather than changed
+        # after it is bound, so there is no moment when others can connect
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen(16)
+        return listener
+
+    def _serve(self, conn, address):
+        lock = _gevent().lock.BoundedSemaphore()
+
+        def reply(message):
+            with lock:
+                conn.sendall(json.dumps(message).encode() + b'\n')
+
+        for line in conn.makefile('rb'):
+            try:
+                message = json.loads(line.decode())
+                request = Request(message.get('id'), message['method'],
+                                  message.get('params') or {}, reply)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                reply({'id': None,
+                       'error': {'type': 'ValueError',
+                                 'message': 'Invalid request: {!r}'
+                                            .format(line)}})
+                continue
+            self.queue.put(request)
+
+    def _work(self, max_priority=None):
+        while True:
+            request = self.queue.get(max_priority)
+            try:
+                result = getattr(self, '_' + request.method)(**request.params)
+            except Exception as err:
+                request.respond(error=err)
+            else:
+                request.respond(result)
+
+    def _check_started(self):
+        if self.robot.started is False:
+            raise RuntimeError('Robot not started. Send power_on first')
+
+    def _run(self, operation):
+        self.operation = operation
+        try:
+            return _sequence_result(operation.wait())
+        finally:
+            self.operation = None
+
+    def _abort(self):
+        dropped = self.queue.remove(MOTION)
+        for request in dropped:
+            request.respond(error=OperationCancelled('Aborted'))
+        cancelled = False
+        if self.operation is not None:
+            cancelled = self.operation.cancel()
+        return {'cancelled': cancelled, 'dropped': len(dropped)}
+
+    def _ping(self):
+        return 'pong'
+
+    def _status(self):
+        robot = self.robot
+        status = {'started': robot.started,
+                  'sample_index': robot.sample_index,
+                  'sample_mounted': robot.sample_mounted,
+                  'state': robot.state.as_dict(),
+                  'operation': None,
+                  'queued': len(self.queue),
+                  }
+        if self.operation is not None:
+            status['operation'] = {'name': self.operation.name,
+                                   'steps': len(self.operation.steps),
+                                   'total_steps': self.operation.total_steps}
+        if robot.status is not None:
+            status['status'] = dict(robot.status)
+            if status['status']['error'] is not None:
+                status['status']['error'] = str(status['status']['error'])
+        return status
+
+    def _restart(self):
+        self.robot.restart()
+
+    def _shutdown(self):
+        # Stop once the reply has been sent
+        _gevent().spawn_later(0.05, self.stop)
+
+    def _power_on(self):
+        self.robot.power_on()
+
+    def _power_off(self):
+        self.robot.power_off()
+
+    def _speed_profile(self, profile=None):
+        self.robot.speed_profile = get_profile(profile)
+
+    def _mount(self, n):
+        self._check_started()
+        return self._run(self.robot.start_mount(n))
+
+    def _unmount(self):
+        self._check_started()
+        return self._run(self.robot.start_unmount())
+
+    def _exchange(self, n):
+        self._check_started()
+        robot = self.robot
+        if not robot.sample_mounted:
+            return self._run(robot.start_mount(n))
+        if robot.sample_index == int(n):
+            robot.magazine.index_to_xy(n)
+            return None
+        return self._run(robot.start_exchange(n))
+
+
+class DaemonError(RuntimeError):
+    """
+    Raised by a DaemonClient when the daemon couldn't carry out a request.
+
+    Attributes
+    ----------
+    type : String name of the exception raised in the daemon
+    """
+
+    def __init__(self, type, message):
+        super().__init__('{}: {}'.format(type, message))
+        self.type = type
+
+
+class DaemonClient(object):
+    """
+    Sends requests to a RobotDaemon. The connection is made when the first
+    request is sent and kept open until close is called.
+
+    Parameters
+    ----------
+    socket_path : String path of the Unix socket the daemon listens on
+    timeout : float time in seconds to wait for each reply (None waits until
+              the request has been carried out)
+    """
+
+    def __init__(self, socket_path=default_socket, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = None
+
+    def call(self, method, **params):
+        """
+        Send a request and wait for the reply.
+
+        Returns
+        -------
+        the result of the request
+
+        Raises
+        ------
+        ValueError : if the request had a bad argument (e.g. sample index)
+        DaemonError : if the daemon couldn't carry out the request
+        """
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.socket_path)
+            self._file = self._sock.makefile('rb')
+        request_id = next(self._ids)
+        self._sock.sendall(json.dumps({'id': request_id, 'method': method,
+                                       'params': params}).encode() + b'\n')
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise ConnectionError('Daemon closed the connection')
+        reply = json.loads(line.decode())
+        if 'error' in reply:
+            error = reply['error']
+            if error['type'] == 'ValueError':
+                raise ValueError(error['message'])
+            raise DaemonError(error['type'], error['message'])
+        return reply['result']
+
+    def ping(self):
+        return self.call('ping')
+
+    def status(self):
+        """
+        Returns the state of the robot known to the daemon, with the
+        operation running and the number of requests waiting
+        """
+        return self.call('status')
+
+    def abort(self):
+        """
+        Cancel the operation running and all the moves waiting to be run
+        """
+        return self.call('abort')
+
+    def restart(self):
+        """
+        Continue a move stopped by abort
+        """
+        return self.call('restart')
+
+    def shutdown(self):
+        """
+        Stop the daemon
+        """
+        return self.call('shutdown')
+
+    def power_on(self):
+        return self.call('power_on')
+
+    def power_off(self):
+        return self.call('power_off')
+
+    def speed_profile(self, profile):
+        """
+        Set the speed profile of the robot (see emacontrol.speed)
+        """
+        return self.call('speed_profile', profile=profile)
+
+    def mount(self, n):
+        """
+        Mount the sample with index n. Returns the time taken by each step
+        """
+        return self.call('mount', n=n)
+
+    def unmount(self):
+        return self.call('unmount')
+
+    def exchange(self, n):
+        """
+        Exchange the sample on the spinner for the sample with index n (or
+        mount it if no sample is mounted)
+        """
+        return self.call('exchange', n=n)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='emacontrol',
+        description='Run or control the E.M.A. sample changer daemon')
+    parser.add_argument('--socket', default=default_socket,
+                        help='Unix socket of the daemon '
+                             '(default: %(default)s)')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve = commands.add_parser('serve', help='Run the daemon')
+    serve.add_argument('--config', default=default_config,
+                       help='Robot config file (default: %(default)s)')
+    serve.add_argument('--host', help='Address of the robot controller')
+    serve.add_argument('--port', type=int,
+                       help='Port of the robot controller')
+    serve.add_argument('--speed-profile',
+                       help='Speed profile to use (see emacontrol.speed)')
+    serve.add_argument('--status-interval', type=float, default=0.5,
+                       help='Seconds between status reads (0 to not read '
+                            'the status in the background)')
+    for name in ('status', 'abort', 'restart', 'shutdown'):
+        commands.add_parser(name, help='Send a {} request'.format(name))
+    args = parser.parse_args(argv)
+
+    if args.command != 'serve':
+        with DaemonClient(args.socket) as client:
+            print(json.dumps(client.call(args.command), indent=2))
+        return 0
+
+    robot = Robot(config_file=args.config, robot_host=args.host,
+                  robot_port=args.port, persistent=True,
+                  speed_profile=args.speed_profile)
+    daemon = RobotDaemon(robot, args.socket,
+                         status_interval=args.status_interval or None)
+    print('Listening on {}'.format(args.socket), flush=True)
+    daemon.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
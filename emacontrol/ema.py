@@ -1,8 +1,20 @@
+import contextlib
+import functools
 import os
 import re
+import time
 
+from emacontrol.commands import (COMMANDS, coords_command, speed_command)
+from emacontrol.instrumentation import command_name
+from emacontrol.journal import Journal, replay
+from emacontrol.magazine import Magazine
 from emacontrol.network import SocketConnector
-from emacontrol.utils import input_to_int
+from emacontrol.operation import Operation
+from emacontrol.sequence import (MOUNT, UNMOUNT, Sequence, SequenceError,
+                                 SequenceResult, StepResult)
+from emacontrol.speed import _check_speed, get_profile
+from emacontrol.state import ControllerState
+from emacontrol.status import StatusPoller
 
 # For Python >3.4, a more portable way to getting the home directory is:
 # from pathlib import Path
@@ -11,14 +23,90 @@ from emacontrol.utils import input_to_int
 # Windows...
 default_config = os.path.join(os.path.expanduser('~'), '.robot.ini')
 
+# Timeout in seconds for commands on the control channel, which the
+# controller answers straight away
+CONTROL_TIMEOUT = 5
+
+# Geometry used when converting sample indices without a robot
+default_magazine = Magazine()
+
+# Commands (with the replies expected) which mount a sample once its
+# coordinates have been set and which return it to the magazine again
+MOUNT_SEQUENCE = tuple((step.message, step.wait_for) for step in MOUNT)
+UNMOUNT_SEQUENCE = tuple((step.message, step.wait_for) for step in UNMOUNT)
+
 
 class Robot(SocketConnector):
+    """
+    Sends commands to the E.M.A. sample changer controller.
+
+    By default a new socket is opened for each message. A persistent session,
+    which keeps one socket open across calls to send, can be requested with
+    persistent=True, by calling open()/close() or by using the robot as a
+    context manager:
+
+    with Robot() as ema:
+        ema.send('moveGate;', wait_for='moveGate:done;')
+
+    The last known state of the controller is kept in state (see
+    emacontrol.state). Commands whose effect is already known (e.g. setting
+    the coordinates which are already set) are not sent again and queries
+    such as get_coords are answered from it. With strict=True, commands are
+    always sent and queries always go to the controller.
+
+    If a speed profile is given (see emacontrol.speed), the speed of the arm
+    is set for each move according to the profile.
+
+    If a journal is given (a Journal or the path of the journal file), every
+    message sent and reply received is recorded in it, so that the state of
+    the robot can be recovered after a crash (see recover and
+    emacontrol.journal).
+
+    If a TrafficRecorder is given, the traffic on every connection to the
+    controller is recorded, so that the session can be replayed (see
+    emacontrol.recorder and emacontrol.replay).
+    """
 
     def __init__(self, config_file=default_config, robot_host=None,
-                 robot_port=None, socket_timeout=60):
-        super().__init__(robot_host, robot_port, config_file=config_file)
+                 robot_port=None, socket_timeout=60, persistent=False,
+                 instrumentation=None, strict=False, speed_profile=None,
+                 journal=None, recorder=None):
+        super().__init__(robot_host, robot_port, config_file=config_file,
+                         socket_timeout=socket_timeout, persistent=persistent,
+                         instrumentation=instrumentation, recorder=recorder)
         self.sample_index = 1
+        self.sample_mounted = False
         self.started = False
+        self.strict = strict
+        self.speed_profile = get_profile(speed_profile)
+        self.state = ControllerState()
+        if isinstance(journal, str):
+            journal = Journal(journal)
+        self.journal = journal
+        # Preparation of the next sample, running in the background
+        self._preparation = None
+        # True while a socket opened by prepare_sample is kept for the next
+        # sequence
+        self._prepared_session = False
+        self._magazine = None
+        # Second connection for control commands (see control_channel) and
+        # the status read on it
+        self._control = None
+        self._status_poller = None
+
+    @property
+    def magazine(self):
+        """
+        Geometry of the sample magazines, read from the [magazine] section of
+        the config file when first needed (see emacontrol.magazine)
+        """
+        if self._magazine is None:
+            self._magazine = Magazine.from_config(self.config_file)
+        return self._magazine
+
+    @magazine.setter
+    def magazine(self, magazine):
+        self._magazine = magazine
 
     def _read_config(self):
         """
@@ -45,28 +133,398 @@ class Robot(SocketConnector):
         parse : Bool should received message be run through message_parser to
                      check for errors
         '''
-        recvd_msg = self.__send__(message)
-        if parse:
-            output = Robot.parse_message(recvd_msg)
-        else:
-            output = recvd_msg
+        return self._send(message, wait_for, parse)
 
-        # We want to stop the robot in case of a fail unless explicitly told
-        # not to with a wait for. Otherwise we don't know what the robot will
-        # do next
-        if ('fail' in recvd_msg) and (recvd_msg != wait_for):
-            # TODO Log: 'Robot failed on message "{}" with: {}'.format(message,
-            # output[state[0]])
-            msg = 'Robot failed while running message "{}"'.format(message)
-            raise RuntimeError(msg)
-        if (wait_for is not None) and (recvd_msg != wait_for):
-            # TODO Log: 'Robot response to "{}" was not as expected. Expected:
-            # {}. Received: {}'.format(message, wait_for, recvd_msg)
-            msg = 'Unexpected response from Robot: {}'.format(recvd_msg)
-            raise RuntimeError(msg)
+    def send_command(self, command, parse=True):
+        """
+        Send a command from the registry (see emacontrol.commands) and wait
+        for the reply it expects.
 
+        Parameters
+        ----------
+        command : Command to send
+        parse : Bool should received message be run through message_parser to
+                     check for errors
+        """
+        return self._send(command.message, command.wait_for, parse,
+                          command.data)
+
+    def _send(self, message, wait_for, parse, data=None):
+        if self.speed_profile is not None:
+            speed = self.speed_profile.speed_for(command_name(message))
+            if speed is not None:
+                self.set_speed(speed)
+        timing = self.instrumentation.begin(message)
+        try:
+            if self.journal is None:
+                recvd_msg = self.__send__(message, timing, data)
+            else:
+                recvd_msg = self._send_journalled(message, timing, data)
+            parse_start = time.perf_counter()
+            try:
+                parsed = Robot.parse_message(recvd_msg)
+            except ValueError:
+                if parse:
+                    raise
+                parsed = None
+            if parse:
+                output = parsed
+            else:
+                output = recvd_msg
+
+            Robot.check_reply(message, recvd_msg, wait_for)
+            self.state.update(message, recvd_msg, parsed)
+            timing.parse = time.perf_counter() - parse_start
+        except Exception:
+            timing.failed = True
+            # Whatever the controller did, it's no longer known
+            self.state.invalidate()
+            raise
+        finally:
+            self.instrumentation.record(timing)
         return output
 
+    def _send_journalled(self, message, timing, data):
+        # The message is recorded before it is sent, so a crash while waiting
+        # for the reply leaves it in the journal
+        self.journal.sent(message)
+        try:
+            recvd_msg = self.__send__(message, timing, data)
+        except Exception as err:
+            self.journal.failed(err)
+            raise
+        self.journal.received(recvd_msg)
+        return recvd_msg
+
+    def run_sequence(self, sequence, progress=None):
+        """
+        Send a sequence of commands one after the other on one connection,
+        checking each reply as it arrives. Stops at the first step which fails
+        (or gets an unexpected reply). Any preparation started by
+        prepare_sample is finished first.
+
+        Parameters
+        ----------
+        sequence : Sequence, or list of Steps or (message, wait_for) tuples
+                   (see emacontrol.sequence)
+        progress : function called after each step which succeeds, with the
+                   StepResult, the index of the step and the number of steps
+                   (optional)
+
+        Returns
+        -------
+        SequenceResult : with the reply to and time taken by each step
+
+        Raises
+        ------
+        SequenceError : reporting the step which failed and the time taken by
+                        each step up to and including it
+        """
+        self.wait_prepared()
+        if not isinstance(sequence, Sequence):
+            sequence = Sequence('sequence', sequence)
+        result = SequenceResult(sequence.name)
+        if self.journal is not None:
+            self.journal.begin(sequence)
+        with self.session():
+            for index, step in enumerate(sequence):
+                step_start = time.perf_counter()
+                try:
+                    reply = self.send_command(step, parse=False)
+                except Exception as err:
+                    result.steps.append(StepResult(
+                        step.message, None, time.perf_counter() - step_start,
+                        err))
+                    if self.journal is not None:
+                        self.journal.aborted(err)
+                    raise SequenceError(sequence.name, index, step, result,
+                                        err) from err
+                step_result = StepResult(step.message, reply,
+                                         time.perf_counter() - step_start)
+                result.steps.append(step_result)
+                if progress is not None:
+                    progress(step_result, index, len(sequence))
+        if self.journal is not None:
+            self.journal.end()
+        return result
+
+    def recover(self):
+        """
+        Replay the journal to find the state of the robot when it was last
+        written (e.g. before the software crashed). The sample index and
+        whether it is mounted are set from the journal, which is then
+        compacted. The state of the controller is not taken from the journal,
+        as the controller may have been restarted since.
+
+        Returns
+        -------
+        Recovery : the state found (see emacontrol.journal). Its unfinished
+                   property is True if a sequence was cut short, which can
+                   then be finished with resume. Its resumable property is
+                   True if it can be finished without checking the robot
+                   first
+
+        Raises
+        ------
+        RuntimeError : if the robot has no journal
+        """
+        if self.journal is None:
+            raise RuntimeError('Robot has no journal to recover from')
+        self.journal.close()
+        recovery = replay(self.journal.path, self.magazine)
+        if recovery.mounted is not None:
+            self.sample_index = recovery.mounted
+        self.sample_mounted = recovery.mounted is not None
+        if not recovery.unfinished:
+            self.journal.checkpoint(recovery)
+        return recovery
+
+    def resume(self, progress=None):
+        """
+        Finish the sequence which was cut short (see recover), starting from
+        the step which had no reply or which failed. A gripping step which
+        had no reply is skipped if the gripper shows it was carried out.
+        Unless the recovery is resumable, the robot should be checked before
+        calling this.
+
+        Returns
+        -------
+        SequenceResult : with the time taken by each step (None if there was
+                         nothing to finish)
+
+        Raises
+        ------
+        SequenceError : if a step fails
+        """
+        recovery = replay(self.journal.path, self.magazine)
+        if not recovery.unfinished:
+            return None
+        steps = recovery.sequence.steps[recovery.completed:]
+        gripping = {'samplePick': 'closed', 'sampleRelease': 'open'}
+        if steps and steps[0].name in gripping:
+            self.send_command(COMMANDS['getGripperState'])
+            if self.state.gripper == gripping[steps[0].name]:
+                self.journal.confirmed(steps[0].message)
+                recovery.apply('K', steps[0].message)
+        result = self.run_sequence(recovery.remaining(), progress)
+        self.recover()
+        return result
+
+    def _coords_sequence(self, n):
+        """
+        Returns the sequence setting the coordinates of sample n, which is
+        empty if they are known to be set already
+        """
+        self.wait_prepared()
+        x_coord, y_coord = self.magazine.index_to_xy(n)
+        if (not self.strict) and (self.state.coords == (x_coord, y_coord)):
+            return Sequence('setCoords')
+        return Sequence('setCoords', [coords_command(x_coord, y_coord)])
+
+    def mount(self, n, progress=None):
+        """
+        Mount the sample with index n on the spinner. See run_sequence for
+        progress.
+
+        Returns
+        -------
+        SequenceResult : with the time taken by each step
+
+        Raises
+        ------
+        ValueError : if n is not a valid sample index
+        SequenceError : if a step fails
+        """
+        sequence = self._coords_sequence(n) + MOUNT
+        self.sample_index = n
+        result = self.run_sequence(Sequence('mount', sequence), progress)
+        self.sample_mounted = True
+        return result
+
+    def unmount(self, progress=None):
+        """
+        Return the sample on the spinner to its position in the magazine. See
+        run_sequence for progress.
+
+        Returns
+        -------
+        SequenceResult : with the time taken by each step
+
+        Raises
+        ------
+        SequenceError : if a step fails
+        """
+        result = self.run_sequence(UNMOUNT, progress)
+        self.sample_mounted = False
+        return result
+
+    def exchange(self, n, progress=None):
+        """
+        Return the sample on the spinner to the magazine and mount the sample
+        with index n, as one sequence on one connection. See run_sequence for
+        progress.
+
+        Returns
+        -------
+        SequenceResult : with the time taken by each step
+
+        Raises
+        ------
+        ValueError : if n is not a valid sample index (checked before the
+                     robot moves)
+        SequenceError : if a step fails
+        """
+        x_coord, y_coord = self.magazine.index_to_xy(n)
+        self.wait_prepared()
+        # The coordinates of the mounted sample are needed for the unmount, so
+        # the new ones are set once it is back in the magazine
+        sequence = UNMOUNT + coords_command(x_coord, y_coord) + MOUNT
+        try:
+            result = self.run_sequence(Sequence('exchange', sequence),
+                                       progress)
+        except SequenceError as err:
+            if err.index >= len(UNMOUNT):
+                # The old sample was returned to the magazine
+                self.sample_mounted = False
+            raise
+        self.sample_index = n
+        self.sample_mounted = True
+        return result
+
+    def start_mount(self, n):
+        """
+        Start mounting the sample with index n in the background.
+
+        Returns
+        -------
+        Operation : handle to follow the progress of the mount, wait for it to
+                    finish or cancel it (see emacontrol.operation)
+
+        Raises
+        ------
+        ValueError : if n is not a valid sample index
+        """
+        self.magazine.index_to_xy(n)
+        return self._start('mount', self.mount, n)
+
+    def start_unmount(self):
+        """
+        Start returning the sample on the spinner to the magazine in the
+        background. See start_mount.
+        """
+        return self._start('unmount', self.unmount)
+
+    def start_exchange(self, n):
+        """
+        Start exchanging the sample on the spinner for the sample with index n
+        in the background. See start_mount.
+        """
+        self.magazine.index_to_xy(n)
+        return self._start('exchange', self.exchange, n)
+
+    def _start(self, name, method, *args):
+        # Connect the control channel now, so that cancelling doesn't have to
+        # wait for a connection to be made
+        self.control_channel()
+        return Operation(self, name, method, *args)
+
+    def control_channel(self):
+        """
+        Returns the connection to the controller used for control commands
+        (interrupt and restart) while a move is running. The controller
+        accepts two clients, so this is a second, persistent connection next
+        to the one which sends the moves.
+        """
+        if self._control is None:
+            self._control = SocketConnector(
+                self.peer[0], self.peer[1], config_file=self.config_file,
+                socket_timeout=CONTROL_TIMEOUT, persistent=True,
+                instrumentation=self.instrumentation, recorder=self.recorder)
+        if not self._control.is_connected():
+            self._control.open()
+        return self._control
+
+    def close_control_channel(self):
+        """
+        Close the control connection (if it is open)
+        """
+        if self._control is not None:
+            self._control.close()
+
+    def send_control(self, command):
+        """
+        Send a command on the control channel, so that it doesn't wait for
+        a move to finish, and check the reply.
+
+        Parameters
+        ----------
+        command : Command to send (see emacontrol.commands)
+
+        Returns
+        -------
+        dict : the parsed reply (see parse_message)
+        """
+        channel = self.control_channel()
+        try:
+            reply = channel.__send__(command.message, data=command.data)
+            output = Robot.parse_message(reply)
+            Robot.check_reply(command.message, reply, command.wait_for)
+        except Exception:
+            self.state.invalidate()
+            raise
+        self.state.update(command.message, reply, output)
+        return output
+
+    def start_status_polling(self, interval=0.5):
+        """
+        Start reading the status of the robot (power, coordinates, gripper and
+        speed) in the background on the control channel, so it is available
+        while the robot moves (see emacontrol.status).
+
+        Parameters
+        ----------
+        interval : float time in seconds between reads
+
+        Returns
+        -------
+        StatusPoller : with the latest status
+        """
+        if self._status_poller is None:
+            self._status_poller = StatusPoller(self, interval)
+        self._status_poller.interval = interval
+        return self._status_poller.start()
+
+    def stop_status_polling(self):
+        """
+        Stop reading the status in the background
+        """
+        if self._status_poller is not None:
+            self._status_poller.stop()
+
+    @property
+    def status(self):
+        """
+        The latest status read by the status poller (None if it hasn't been
+        started). See emacontrol.status.
+        """
+        if self._status_poller is None:
+            return None
+        return self._status_poller.latest
+
+    def interrupt(self):
+        """
+        Stop the robot part way through the current move. The move is paused,
+        not abandoned: it continues after restart (or when the next move is
+        started).
+        """
+        self.send_control(COMMANDS['interrupt'])
+
+    def restart(self):
+        """
+        Continue a move stopped by interrupt
+        """
+        self.send_control(COMMANDS['restart'])
+
     def set_sample_coords(self, n, verbose=False):
         """
         Sets the xy coordinates for the next sample to mount based on the index
@@ -77,29 +535,212 @@ class Robot(SocketConnector):
         n : integer index of the sample to pick
         verbose : boolean if true prints the sample coordinates to screen
         """
+        self.wait_prepared()
+        x_coord, y_coord = self.magazine.index_to_xy(n)
         self.sample_index = n
-        x_coord, y_coord = Robot.samplenr_to_xy(n)
-        # TODO Log: 'Setting sample coordinates for sample {} to ({}, {})'
-        # .format(n, x_coord, coord)
         if verbose:
             print('Sample coords: ({}, {})'.format(x_coord, y_coord))
-        self.send('setCoords:#X{0:d}#Y{1:d};'.format(x_coord, y_coord),
-                  wait_for='setCoords:done;')
+        if (not self.strict) and (self.state.coords == (x_coord, y_coord)):
+            # Already set (e.g. by prepare_sample)
+            return
+        # TODO Log: 'Setting sample coordinates for sample {} to ({}, {})'
+        # .format(n, x_coord, coord)
+        self.send_command(coords_command(x_coord, y_coord))
+
+    def prepare_sample(self, n):
+        """
+        Prepare to mount a sample in the background (e.g. while the current
+        sample is being measured), doing the setup which doesn't move the
+        robot. The sample index is checked immediately. Then, in a greenlet:
+        - the socket is opened. If the robot isn't in a persistent session,
+          the socket is kept open until the end of the next mount, unmount
+          or exchange
+        - if no sample is mounted, the coordinates of the sample are sent
+        - with a speed profile, the speed of the first move is set
+
+        If a sample is mounted, its coordinates are still needed to return it
+        to the magazine, so the new coordinates are only sent during the
+        exchange, after the mounted sample has been returned.
+
+        Parameters
+        ----------
+        n : integer index of the sample to be mounted next
+
+        Returns
+        -------
+        gevent.Greenlet : running the preparation. Mounting waits for this to
+                          finish and raises any error it raised.
+
+        Raises
+        ------
+        ValueError : if n is not a valid sample index
+        """
+        import gevent
+
+        self.magazine.index_to_xy(n)
+        self.wait_prepared()
+        self._preparation = gevent.spawn(self._prepare, n)
+        return self._preparation
+
+    def _prepare(self, n):
+        if not self.persistent:
+            self.persistent = True
+            self._prepared_session = True
+        with self._lock:
+            self._ensure_connected()
+        if self.sample_mounted:
+            first = UNMOUNT.steps[0]
+        else:
+            x_coord, y_coord = self.magazine.index_to_xy(n)
+            self.send_command(coords_command(x_coord, y_coord))
+            first = MOUNT.steps[0]
+        if self.speed_profile is not None:
+            speed = self.speed_profile.speed_for(first.name)
+            if speed is not None:
+                self.set_speed(speed)
+
+    @contextlib.contextmanager
+    def session(self):
+        if not self._prepared_session:
+            with super().session():
+                yield self
+            return
+        # The socket was opened by prepare_sample for this session only
+        self._prepared_session = False
+        try:
+            yield self
+        finally:
+            self.close()
+
+    def wait_prepared(self):
+        """
+        Wait for any preparation started by prepare_sample to finish, raising
+        any error which occurred during it.
+        """
+        preparation = self._preparation
+        if preparation is None:
+            return
+        self._preparation = None
+        preparation.get()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+        self.stop_status_polling()
+        self.close_control_channel()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _drop_connection(self):
+        # The controller may have been restarted while the connection was
+        # down, so nothing is known about its state any more
+        super()._drop_connection()
+        self.state.invalidate()
+
+    def power_on(self):
+        """
+        Switch on the power to the robot (unless it is known to be on already)
+        """
+        if self.strict or (self.state.power is not True):
+            self.send_command(COMMANDS['powerOn'])
+        self.started = True
+
+    def power_off(self):
+        """
+        Switch off the power to the robot (unless it is known to be off
+        already)
+        """
+        if self.strict or (self.state.power is not False):
+            self.send_command(COMMANDS['powerOff'])
+        self.started = False
+
+    def _query(self, field, name):
+        """
+        Returns a field of the controller state, asking the controller for it
+        (with the command name) if it isn't known (or in strict mode)
+        """
+        if self.strict or (getattr(self.state, field) is None):
+            self.send_command(COMMANDS[name])
+        return getattr(self.state, field)
+
+    def get_coords(self):
+        """
+        Returns the (X, Y) magazine coordinates set on the controller
+        """
+        return self._query('coords', 'getCoords')
+
+    def set_speed(self, speed):
+        """
+        Set the speed of the robot arm for moves, unless it is known to be set
+        already.
+
+        Parameters
+        ----------
+        speed : float speed as a percentage of the nominal speed
+
+        Raises
+        ------
+        ValueError : if the speed is not greater than 0 and at most 100
+        """
+        speed = _check_speed(speed)
+        if self.strict or (self.state.speed != speed):
+            self.send_command(speed_command(speed))
+
+    def get_speed(self):
+        """
+        Returns the speed of the robot arm
+        """
+        return self._query('speed', 'getSpeed')
+
+    def is_powered(self):
+        """
+        Returns True if the robot arm is powered
+        """
+        return self._query('power', 'getPowerState')
+
+    def get_gripper_state(self):
+        """
+        Returns the state of the gripper ('open' or 'closed')
+        """
+        return self._query('gripper', 'getGripperState')
+
+    @staticmethod
+    def check_reply(message, recvd_msg, wait_for=None):
+        """
+        Check the reply received from the robot controller, raising an error
+        if the robot failed or if the reply was not what was expected.
 
-    # def isPowered(self):
-    #     power_state = self.send('getPowerState;')
-    #     _, state, _ = Robot.message_parser(power_state)
-    #     if state.lower() == 'on':
-    #         return True
-    #     else:
-    #         return False
+        Parameters
+        ----------
+        message : String message sent to the controller
+        recvd_msg : String message received in reply
+        wait_for : String message which was expected back (optional)
+
+        Raises
+        ------
+        RuntimeError : if the reply was a fail (and this was not expected) or
+                       if the reply was not the one expected
+        """
+        # We want to stop the robot in case of a fail unless explicitly told
+        # not to with a wait for. Otherwise we don't know what the robot will
+        # do next
+        if ('fail' in recvd_msg) and (recvd_msg != wait_for):
+            # TODO Log: 'Robot failed on message "{}" with: {}'.format(message,
+            # output[state[0]])
+            msg = 'Robot failed while running message "{}"'.format(message)
+            raise RuntimeError(msg)
+        if (wait_for is not None) and (recvd_msg != wait_for):
+            # TODO Log: 'Robot response to "{}" was not as expected. Expected:
+            # {}. Received: {}'.format(message, wait_for, recvd_msg)
+            msg = 'Unexpected response from Robot: {}'.format(recvd_msg)
+            raise RuntimeError(msg)
 
     @staticmethod
     def samplenr_to_xy(n):
         """
         Convert the numerical index of the requested sample to xy coordinates
-        on the sample magazine. Performs check that the input is an integer
-        greater than zero.
+        on the sample magazine, using the default magazine geometry (use
+        Robot.magazine for the configured geometry). Performs check that the
+        input is an integer greater than zero.
 
         Parameters
         ----------
@@ -111,17 +752,11 @@ class Robot(SocketConnector):
 
         Raises
         ------
-        ValueError : if n is not greater than 0
-        """
-        n = input_to_int(n)
-        if n <= 0:
-            raise ValueError('Expecting value greater than 0')
-        # "Sample 1" is actually at position (0, 0). To make calculation
-        # easier, subtract 1 (i.e. "Sample 1" = "Sample 0"). We use "Sample 1"
-        # as this is easier to understand for users.
-        n = n - 1
-        coordinates = (n // 10, n % 10)
-        return coordinates
+        ValueError : if n is not greater than 0 or is outside the magazine
+        """
+        # "Sample 1" is actually at position (0, 0). We use "Sample 1" as this
+        # is easier to understand for users.
+        return default_magazine.index_to_xy(n)
 
     @staticmethod
     def parse_message(message):
@@ -143,30 +778,55 @@ class Robot(SocketConnector):
         -------
         dict containing three fields (command; result; status)
         """
-        command, response = message.strip(';').split(':')
-        result = ''
-        state = {}
-
-        # First handle the case we get some parameters back
-        if response[0] == '#':
-            parameters = re.findall(r'[A-Za-z]+\d*\.*\d*', response)
-            for i in range(len(parameters)):
-                chars = re.search(r'[A-Za-z]+', parameters[i]).group()
-                nums = re.search(r'\d+\.*\d*', parameters[i])
-
-                # Are these named parameters? If so separate values and names
-                if nums:
-                    try:
-                        state[chars] = input_to_int(nums.group())
-                    except ValueError:
-                        state[chars] = float(nums.group())
-                else:
-                    state[i] = chars
-        # Or is this just a string response?
-        else:
-            response = response.split('_')
-            result = response[0]
-            if len(response) == 2:
-                state[0] = response[1].strip('\'')
+        command, result, state = _parse_reply(message)
+        return {'command': command, 'result': result, 'state': dict(state)}
+
+
+# Named (e.g. X4, Z0.53) or unnamed (e.g. On) parameters in a reply
+_PARAMETER_RE = re.compile(r'([A-Za-z]+)(?:(\d+\.*\d*)|\.*(\d*))')
+_NUMBER_RE = re.compile(r'\d+(\.\d*)?')
 
-        return {'command': command, 'result': result, 'state': state}
+
+def _to_number(text):
+    if text.isdigit():
+        return int(text)
+    return float(text)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_reply(message):
+    """
+    Parse a message from the robot into a tuple of command, result and the
+    state as a tuple of (key, value) pairs. See Robot.parse_message.
+
+    The robot sends a small number of different messages (mostly
+    command:done;), so parsed messages are cached.
+    """
+    command, sep, response = message.strip(';').partition(':')
+    if (not sep) or (':' in response):
+        raise ValueError('Cannot parse message from robot: {}'
+                         .format(message))
+
+    # Most messages report that a command is done or that it failed
+    if response == 'done':
+        return command, 'done', ()
+    if not response.startswith('#'):
+        result, _, reason = response.partition('_')
+        if reason:
+            return command, result, ((0, reason.strip('\'')),)
+        return command, result, ()
+
+    # Otherwise we have some parameters back. A single unnamed number (e.g.
+    # getSpeed:#5) is returned with the key 0
+    if _NUMBER_RE.fullmatch(response[1:]):
+        return command, '', ((0, _to_number(response[1:])),)
+    state = []
+    for i, match in enumerate(_PARAMETER_RE.finditer(response)):
+        chars, nums, trailing_nums = match.groups()
+        nums = nums or trailing_nums
+        # Are these named parameters? If so separate values and names
+        if nums:
+            state.append((chars, _to_number(nums)))
+        else:
+            state.append((i, chars))
+    return command, '', tuple(state)
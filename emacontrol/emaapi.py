@@ -3,11 +3,14 @@ Robot class should create a socket and provide methods to use that socket to
 pass instructions through that socket to the robot. Methods on the module
 should then use an instance of this class to send commands to achieve tasks.
 
+By default the functions use the module level robot, ema. This is only
+created when it is first used, so importing this module is quick. Another
+robot (e.g. a second sample changer or a test controller) can be used by
+passing it to the functions with the robot argument, or by making it the
+default with set_robot.
+
     TODO
     - When does the homing procedure actually need to be run?
-    - Add recording of last mounted sample
-    - Add recording of last message sent
-    - Add state machine to allow recovery if software crashes
 
     NEEDED
     Clear sample(?)
@@ -16,47 +19,176 @@ should then use an instance of this class to send commands to achieve tasks.
 """
 # TODO Add logging!
 
+from emacontrol import planner
 from emacontrol.ema import Robot
+from emacontrol.speed import get_profile
+
+
+def set_robot(robot):
+    """
+    Set the robot used by the functions in this module when no robot is given
+    to them.
+
+    Parameters
+    ----------
+    robot : Robot to use by default
+    """
+    global ema
+    ema = robot
+
+
+class _DefaultRobot(object):
+    """
+    Stands in for the default robot, which is only created when one of its
+    attributes is first used
+    """
+
+    def __init__(self):
+        object.__setattr__(self, '_robot', None)
+
+    def get(self):
+        """
+        Returns the default robot, creating it if necessary
+        """
+        if self._robot is None:
+            object.__setattr__(self, '_robot', Robot())
+        return self._robot
 
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
 
-def robot_begin():
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.get(), name)
+
+
+def _get_robot(robot=None):
+    """
+    Returns the robot given or, if none was, the default robot (creating it if
+    necessary)
+    """
+    if robot is None:
+        robot = ema
+    if isinstance(robot, _DefaultRobot):
+        return robot.get()
+    return robot
+
+
+def robot_begin(robot=None, interactive=True):
     """
     Prepare the robot for a sample exchanging run. Opens the socket connection
     and then turns the power on to the robot.
+
+    If the robot has a journal (see emacontrol.journal), the state of the
+    robot is recovered from it. A mount, unmount or exchange which was cut
+    short by the software crashing while waiting for a reply is finished
+    from the step it stopped at. One which was aborted (by a step failing or
+    by being cancelled) is only finished if the user confirms it.
+
+    Parameters
+    ----------
+    robot : Robot to use (optional, defaults to the module robot)
+    interactive : boolean if true, waits for the user to confirm the reset
+                  button has been pressed. Unattended runs (e.g. emactl) must
+                  make sure of this some other way
+
+    Raises
+    ------
+    RuntimeError : if not interactive and an aborted sequence needs to be
+                   confirmed before it is finished
     """
+    ema = _get_robot(robot)
     # TODO Ideally this would check the interlock programmatically. But this
     # isn't an option yet.
-    input('Have you pressed the reset button?\nPress enter to continue...')
-    gotCoords = ema.send('getCoords;')
-    coords = gotCoords['state']
-    if coords != {'X': 0, 'Y': 0}:
-        sample = (coords['X'] * 10) + coords['Y'] + 1
-        ema.sample_index = sample
+    if interactive:
+        input('Have you pressed the reset button?\n'
+              'Press enter to continue...')
+    # Pressing the reset button (or restarting the controller) between runs
+    # changes the state of the controller, so nothing known about it from an
+    # earlier run can be relied on
+    ema.state.invalidate()
+    recovery = None
+    resume = False
+    if ema.journal is not None:
+        recovery = ema.recover()
+        print('Recovered from journal: {}'.format(recovery.describe()))
+        resume = recovery.unfinished and _confirm_resume(recovery,
+                                                         interactive)
+    if (recovery is None) or ((recovery.mounted is None)
+                              and (recovery.holding is None)
+                              and not recovery.unfinished):
+        # The journal may be new, or not be the one used last time
+        _check_start_coords(ema)
+
+    print('Starting E.M.A. sample changer... ', end='', flush=True)
+    ema.power_on()
+    print('Done')
+    if resume:
+        print('Resuming {}... '.format(recovery.sequence.name), end='',
+              flush=True)
+        ema.resume()
+        print('Done')
+
+
+def _confirm_resume(recovery, interactive):
+    """
+    Returns whether to finish the sequence which was cut short. Only one
+    which was waiting for a reply is finished without asking, as otherwise
+    the robot may not be where the sequence expects
+    """
+    if recovery.resumable:
+        return True
+    name = recovery.sequence.name
+    if not interactive:
+        raise RuntimeError('The {} was not finished. Check the robot, then '
+                           'finish it with resume() or by starting the robot '
+                           'interactively'.format(name))
+    answer = input('Check the robot. Finish the {}? [y/N] '.format(name))
+    if answer.strip().lower() == 'y':
+        return True
+    print('Not finishing the {}. Run resume() to finish it later'
+          .format(name))
+    return False
+
+
+def _check_start_coords(ema):
+    """
+    Warn if the coordinates set on the controller show that a sample may still
+    be mounted
+    """
+    coords = ema.get_coords()
+    if coords != (0, 0):
+        try:
+            sample = ema.magazine.xy_to_index(*coords)
+        except ValueError:
+            sample = 'at {}'.format(coords)
+        else:
+            ema.sample_index = sample
         # TODO Log: 'Sample coords at robot start are ({}, {}) (Sample {}).
-        # Should be (0, 0) for Sample 1'.format(coords['X'], coords['Y'],
-        # sample)
+        # Should be (0, 0) for Sample 1'.format(*coords, sample)
         print('WARNING: Current sample is {} (not 1!).'.format(sample))
         print('Is there a sample on the spinner? '
               + 'Run \'unmount_sample()\' immediately if there is!')
 
-    print('Starting E.M.A. sample changer... ', end='', flush=True)
-    ema.send('powerOn;', wait_for='powerOn:done;')
-    ema.started = True
-    print('Done')
 
-
-def robot_end():
+def robot_end(robot=None):
     """
     Function to call at the end of a sample exchanging run. Turns power off to
     the robot and then closes the socket connection.
+
+    Parameters
+    ----------
+    robot : Robot to use (optional, defaults to the module robot)
     """
+    ema = _get_robot(robot)
     print('Powering off E.M.A. sample changer... ', end='', flush=True)
-    ema.send('powerOff;', wait_for='powerOff:done;')
-    ema.started = False
+    ema.power_off()
     print('Done')
 
 
-def mount_sample(n, verbose=False):
+def mount_sample(n, verbose=False, robot=None):
     """
     Mount a sample with the requested index on the sample spinner.
 
@@ -68,26 +200,29 @@ def mount_sample(n, verbose=False):
     Parameters
     ----------
     n : integer index of the sample to be mounted
+    verbose : boolean if true prints the sample coordinates and the time
+              taken by each step
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Returns
+    -------
+    emacontrol.sequence.SequenceResult : with the time taken by each step
     """
-    if ema.started is False:
-        msg = 'Robot not started. Did you run the robot_begin() method?'
-        raise Exception(msg)
-    ema.set_sample_coords(n, verbose=verbose)
+    ema = _get_robot(robot)
+    _check_started(ema)
+    if verbose:
+        print('Sample coords: ({}, {})'.format(*ema.magazine.index_to_xy(n)))
     # TODO Log: 'Mounting sample {}'
     print('Mounting sample {}... '.format(n), end='', flush=True)
-
-    # Actually do the movements
-    ema.send('moveCoords;', wait_for='moveCoords:done;')
-    ema.send('samplePick;', wait_for='samplePick:done;')
-    ema.send('moveGate;', wait_for='moveGate:done;')
-    ema.send('moveSpinner;', wait_for='moveSpinner:done;')
-    ema.send('sampleRelease;', wait_for='sampleRelease:done;')
-    ema.send('moveOffside;', wait_for='moveOffside:done;')
+    result = ema.mount(n)
     # TODO Log: 'Successfully mounted sample {}'
     print('Done')
+    if verbose:
+        print(result.format())
+    return result
 
 
-def unmount_sample():
+def unmount_sample(verbose=False, robot=None):
     """
     Remove the sample currently on the diffractometer spinner and return it to
     its place in the sample magazine.
@@ -95,19 +230,173 @@ def unmount_sample():
     The robot takes the following series of commands to do this:
     go to spinner -> close gripper on sample (move in and close) ->
     -> go to gate -> go to sample on board -> release sample
+
+    Parameters
+    ----------
+    verbose : boolean if true prints the time taken by each step
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Returns
+    -------
+    emacontrol.sequence.SequenceResult : with the time taken by each step
     """
-    if ema.started is False:
-        msg = 'Robot not started. Did you run the robot_begin() method?'
-        raise Exception(msg)
+    ema = _get_robot(robot)
+    _check_started(ema)
     # TODO Log: 'Unmounting sample {}'
     print('Unmounting sample... ', end='', flush=True)
-    ema.send('moveSpinner;', wait_for='moveSpinner:done;')
-    ema.send('samplePick;', wait_for='samplePick:done;')
-    ema.send('moveGate;', wait_for='moveGate:done;')
-    ema.send('moveCoords;', wait_for='moveCoords:done;')
-    ema.send('sampleRelease;', wait_for='sampleRelease:done;')
+    result = ema.unmount()
     # TODO Log: 'Successfully Unmounted sample {}'
     print('Done')
+    if verbose:
+        print(result.format())
+    return result
+
+
+def exchange_sample(n, verbose=False, robot=None):
+    """
+    Return the sample currently on the spinner to the magazine and mount the
+    sample with the requested index in its place. This is equivalent to
+    unmount_sample() followed by mount_sample(n), but:
+    - the index of the next sample is checked before the current sample is
+      unmounted, so a bad index doesn't leave the spinner empty
+    - all the commands are sent on one socket
+    - if the requested sample is already mounted, the robot doesn't move
+    - if no sample is mounted, the next sample is just mounted
+
+    The robot takes the following series of commands to do this:
+    go to spinner -> close gripper on sample (move in and close) ->
+    -> go to gate -> go to sample on board -> release sample ->
+    -> go to next sample on board -> close gripper on sample ->
+    -> go to gate -> go to spinner -> release sample ->
+    -> go to offside position
+
+    Parameters
+    ----------
+    n : integer index of the sample to be mounted
+    verbose : boolean if true prints the sample coordinates and the time
+              taken by each step
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Returns
+    -------
+    emacontrol.sequence.SequenceResult : with the time taken by each step
+                                         (None if the robot didn't move)
+    """
+    ema = _get_robot(robot)
+    _check_started(ema)
+    # Raises an error if n isn't a valid sample index
+    coords = ema.magazine.index_to_xy(n)
+    if not ema.sample_mounted:
+        return mount_sample(n, verbose=verbose, robot=ema)
+    if ema.sample_index == int(n):
+        print('Sample {} is already mounted'.format(n))
+        return None
+
+    if verbose:
+        print('Sample coords: ({}, {})'.format(*coords))
+    # TODO Log: 'Exchanging sample {} for sample {}'
+    print('Exchanging sample {} for sample {}... '.format(ema.sample_index, n),
+          end='', flush=True)
+    result = ema.exchange(n)
+    # TODO Log: 'Successfully exchanged for sample {}'
+    print('Done')
+    if verbose:
+        print(result.format())
+    return result
+
+
+def validate_samples(samples, robot=None):
+    """
+    Check that every index in a list of samples (e.g. a plan for a run) can be
+    mounted, before starting to mount any of them.
+
+    Parameters
+    ----------
+    samples : iterable of integer sample indices
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Raises
+    ------
+    ValueError : listing all of the invalid indices
+    """
+    _get_robot(robot).magazine.validate(samples)
+
+
+def plan_run(samples, leg_cost=None, robot=None):
+    """
+    Reorder a list of samples so that the arm travels as little as possible
+    between the magazine slots when they are exchanged one after another. If a
+    sample is mounted, the run starts from its slot.
+
+    Parameters
+    ----------
+    samples : iterable of integer sample indices
+    leg_cost : function taking the indices of two samples (from, to) and
+               returning the time to move between their slots (optional,
+               see emacontrol.planner)
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Returns
+    -------
+    emacontrol.planner.RunPlan : with the order to mount the samples in and
+                                 the expected time saved
+    """
+    ema = _get_robot(robot)
+    start = ema.sample_index if ema.sample_mounted else None
+    return planner.plan_run(samples, magazine=ema.magazine, leg_cost=leg_cost,
+                            start=start)
+
+
+def use_speed_profile(profile, robot=None):
+    """
+    Set the speed profile used for the moves of the robot. Moves through free
+    space (e.g. to the gate) are made at one speed and moves to a sample
+    position (e.g. to the spinner) at another.
+
+    Parameters
+    ----------
+    profile : String name of a profile in emacontrol.speed.PROFILES (e.g.
+              'standard'), a SpeedProfile or None to stop setting the speed
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Raises
+    ------
+    ValueError : if there is no profile with the name given
+    """
+    _get_robot(robot).speed_profile = get_profile(profile)
+
+
+def prepare_sample(n, robot=None):
+    """
+    Prepare to mount a sample while the current one is still being measured.
+    The sample index is checked straight away and setup which doesn't move the
+    robot is done in the background: the socket is opened and kept for the
+    next mount_sample or exchange_sample, and with a speed profile the speed
+    of the first move is set. If no sample is mounted, the coordinates of the
+    sample are set as well.
+
+    If a sample is mounted, its coordinates are still needed to return it to
+    the magazine. The coordinates of the next sample are then only set during
+    the exchange, so less time is saved than when the spinner is empty.
+
+    Parameters
+    ----------
+    n : integer index of the sample to be mounted next
+    robot : Robot to use (optional, defaults to the module robot)
+
+    Returns
+    -------
+    gevent.Greenlet : running the preparation
+    """
+    ema = _get_robot(robot)
+    _check_started(ema)
+    return ema.prepare_sample(n)
+
+
+def _check_started(ema):
+    if ema.started is False:
+        msg = 'Robot not started. Did you run the robot_begin() method?'
+        raise Exception(msg)
 
 
-ema = Robot()
+ema = _DefaultRobot()
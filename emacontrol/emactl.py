@@ -0,0 +1,394 @@
+"""
+Unattended runs through a list of samples (a plan), e.g. overnight:
+
+emactl plan.ini
+
+A plan is a configuration file like the robot config. Only samples is
+required:
+
+[plan]
+samples = 1-10, 15, 20
+speed_profile = standard
+dwell = 60
+hook = measure --sample {sample}
+optimise = no
+unmount = yes
+
+[sample 15]
+dwell = 300
+
+Each sample in turn is exchanged for the one before it. The hook command is
+then run in a shell, with {sample}, {x} and {y} replaced by the index of the
+sample and its magazine coordinates. After the hook, the sample is left on
+the spinner for dwell seconds. The hook and dwell can be set for single
+samples in [sample N] sections. With optimise = yes the samples are
+reordered to reduce the travel of the arm (see emacontrol.planner). The last
+sample is returned to the magazine at the end of the run unless unmount = no.
+
+The whole run uses one connection to the controller. The time taken by each
+sample and the number of samples per hour are printed as the run goes.
+Progress is recorded in a file next to the plan (plan.ini.progress), so a run
+which stopped part way through can be continued with --resume. The commands
+sent to the robot are recorded in a journal (plan.ini.journal, see
+emacontrol.journal), so an exchange which was cut short by a crash is
+finished from the step it stopped at when the next run starts (one which
+failed must be finished by hand, or by confirming it in an interactive run).
+--dry-run
+checks the plan and prints what would be done without connecting to the
+robot.
+
+Nothing waits for the user during a run, so the reset button must be pressed
+before it is started.
+"""
+import argparse
+import configparser
+import os
+import subprocess
+import sys
+import time
+
+from emacontrol import emaapi
+from emacontrol.ema import Robot, default_config
+from emacontrol.speed import get_profile
+from emacontrol.utils import input_to_int
+
+
+def parse_samples(text):
+    """
+    Read a list of sample indices such as "1-5, 8, 10-12"
+
+    Returns
+    -------
+    list of integers : the indices in the order given
+
+    Raises
+    ------
+    ValueError : if an index or range isn't a positive integer
+    """
+    samples = []
+    for part in text.replace('\n', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = input_to_int(first.strip())
+        if last:
+            last = input_to_int(last.strip())
+            if last < first:
+                raise ValueError('Range "{}" goes backwards'.format(part))
+            samples.extend(range(first, last + 1))
+        else:
+            samples.append(first)
+    return samples
+
+
+class Plan(object):
+    """
+    The samples to run through and what to do with each.
+
+    Parameters
+    ----------
+    samples : list of integer sample indices
+    speed_profile : String name of the speed profile to use (None to leave
+                    the speed as it is)
+    dwell : float time in seconds to leave each sample on the spinner
+    hook : String shell command to run when each sample is mounted (None to
+           run nothing)
+    optimise : boolean reorder the samples to reduce the travel of the arm
+    unmount : boolean return the last sample to the magazine at the end
+    overrides : dict of sample indices to dicts of dwell and/or hook for that
+                sample
+    """
+
+    def __init__(self, samples, speed_profile=None, dwell=0.0, hook=None,
+                 optimise=False, unmount=True, overrides=None):
+        self.samples = list(samples)
+        self.speed_profile = get_profile(speed_profile)
+        self.dwell = float(dwell)
+        self.hook = hook
+        self.optimise = optimise
+        self.unmount = unmount
+        self.overrides = dict(overrides or {})
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Read a plan file (see the module docstring for its structure)
+
+        Raises
+        ------
+        ValueError : if the file has no samples or a value can't be read
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError('Cannot find plan file: {}'.format(path))
+        confparse = configparser.ConfigParser(interpolation=None)
+        confparse.read(path)
+        if not confparse.has_section('plan'):
+            raise ValueError('Plan file {} has no [plan] section'.format(path))
+        section = confparse['plan']
+        samples = parse_samples(section.get('samples', ''))
+        if not samples:
+            raise ValueError('Plan file {} lists no samples'.format(path))
+        overrides = {}
+        for name in confparse.sections():
+            if name.startswith('sample '):
+                sample = confparse[name]
+                override = overrides[input_to_int(name[7:].strip())] = {}
+                if 'dwell' in sample:
+                    override['dwell'] = sample.getfloat('dwell')
+                if 'hook' in sample:
+                    override['hook'] = sample.get('hook') or None
+        return cls(samples,
+                   speed_profile=section.get('speed_profile'),
+                   dwell=section.getfloat('dwell', 0.0),
+                   hook=section.get('hook') or None,
+                   optimise=section.getboolean('optimise', False),
+                   unmount=section.getboolean('unmount', True),
+                   overrides=overrides)
+
+    def dwell_for(self, n):
+        return self.overrides.get(n, {}).get('dwell', self.dwell)
+
+    def hook_for(self, n):
+        return self.overrides.get(n, {}).get('hook', self.hook)
+
+    def order(self, robot, skip=()):
+        """
+        Returns the samples in the order they will be mounted, checking that
+        all of them are in the magazine of the robot. With optimise, the tour
+        starts from the sample mounted on the robot (if any).
+
+        Parameters
+        ----------
+        robot : Robot to run the plan on
+        skip : collection of samples to leave out (e.g. those finished)
+        """
+        emaapi.validate_samples(self.samples, robot=robot)
+        samples = [n for n in self.samples if n not in skip]
+        if not self.optimise:
+            return samples
+        return emaapi.plan_run(samples, robot=robot).order
+
+
+class Progress(object):
+    """
+    Record of the samples mounted and finished, one line per event, so that
+    a run can be resumed.
+
+    Parameters
+    ----------
+    path : String path of the progress file
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """
+        Returns
+        -------
+        tuple : the set of samples finished and the sample left on the
+                spinner (None if no sample was mounted)
+        """
+        done = set()
+        mounted = None
+        if not os.path.exists(self.path):
+            return done, mounted
+        with open(self.path) as progress:
+            for line in progress:
+                event, _, sample = line.strip().partition(' ')
+                if event == 'mounted':
+                    mounted = int(sample)
+                elif event == 'done':
+                    done.add(int(sample))
+                elif event == 'unmounted':
+                    mounted = None
+        return done, mounted
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def record(self, event, n):
+        with open(self.path, 'a') as progress:
+            progress.write('{} {}\n'.format(event, n))
+
+
+class SampleTiming(object):
+    """
+    Time in seconds taken by each part of the run for one sample
+    """
+    __slots__ = ('sample', 'exchange', 'hook', 'dwell')
+
+    def __init__(self, sample, exchange, hook, dwell):
+        self.sample = sample
+        self.exchange = exchange
+        self.hook = hook
+        self.dwell = dwell
+
+    @property
+    def total(self):
+        return self.exchange + self.hook + self.dwell
+
+    def format(self):
+        return ('Sample {:>4d}: exchange {:7.1f} s, hook {:7.1f} s, '
+                'dwell {:7.1f} s, total {:7.1f} s'.format(
+                    self.sample, self.exchange, self.hook, self.dwell,
+                    self.total))
+
+
+class RunResult(object):
+    """
+    The samples run, with the time taken by each, and the total time.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Samples run per hour
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        return len(self.samples) * 3600 / self.elapsed
+
+    def format(self):
+        return 'Ran {:d} samples in {:.1f} s ({:.1f} samples per hour)'.format(
+            len(self.samples), self.elapsed, self.throughput)
+
+
+def _run_hook(hook, n, robot):
+    x_coord, y_coord = robot.magazine.index_to_xy(n)
+    command = hook.format(sample=n, x=x_coord, y=y_coord)
+    subprocess.run(command, shell=True, check=True)
+
+
+def dry_run(plan, robot):
+    """
+    Print what would be done for each sample of a plan, without connecting
+    to the robot
+
+    Raises
+    ------
+    ValueError : listing any samples which aren't in the magazine
+    """
+    order = plan.order(robot)
+    print('{:d} samples, speed profile: {}'.format(
+        len(order), plan.speed_profile.name if plan.speed_profile else None))
+    for n in order:
+        print('Sample {:>4d} at ({}, {}): dwell {:g} s, hook: {}'.format(
+            n, *robot.magazine.index_to_xy(n), plan.dwell_for(n),
+            plan.hook_for(n)))
+    return order
+
+
+def run_plan(plan, robot, progress, resume=False, interactive=True):
+    """
+    Run through the samples of a plan.
+
+    Parameters
+    ----------
+    plan : Plan to run
+    robot : Robot to use. It is kept connected for the whole run
+    progress : Progress to record the samples mounted and finished in
+    resume : boolean skip the samples already finished according to progress
+    interactive : boolean wait for the user to confirm the reset button has
+                  been pressed (see emaapi.robot_begin)
+
+    Returns
+    -------
+    RunResult : with the time taken for each sample
+    """
+    # Checked before the robot moves
+    emaapi.validate_samples(plan.samples, robot=robot)
+    if resume:
+        done, mounted = progress.read()
+    else:
+        progress.clear()
+        done, mounted = set(), None
+    robot.speed_profile = plan.speed_profile
+    result = RunResult()
+    started = time.monotonic()
+    with robot:
+        emaapi.robot_begin(robot, interactive=interactive)
+        if mounted is not None:
+            robot.sample_index = mounted
+            robot.sample_mounted = True
+        # Only ordered once the sample on the spinner is known (after
+        # recovering from the journal and applying the progress)
+        for n in plan.order(robot, skip=done):
+            sample_start = time.monotonic()
+            emaapi.exchange_sample(n, robot=robot)
+            progress.record('mounted', n)
+            hook_start = time.monotonic()
+            hook = plan.hook_for(n)
+            if hook is not None:
+                _run_hook(hook, n, robot)
+            dwell_start = time.monotonic()
+            time.sleep(plan.dwell_for(n))
+            progress.record('done', n)
+            timing = SampleTiming(n, hook_start - sample_start,
+                                  dwell_start - hook_start,
+                                  time.monotonic() - dwell_start)
+            result.samples.append(timing)
+            result.elapsed = time.monotonic() - started
+            print(timing.format())
+            print(result.format(), flush=True)
+        if plan.unmount and robot.sample_mounted:
+            emaapi.unmount_sample(robot=robot)
+            progress.record('unmounted', robot.sample_index)
+        emaapi.robot_end(robot)
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='emactl',
+        description='Run a plan of samples on the E.M.A. sample changer')
+    parser.add_argument('plan', help='Plan file')
+    parser.add_argument('--config', default=default_config,
+                        help='Robot config file (default: %(default)s)')
+    parser.add_argument('--host', help='Address of the robot controller')
+    parser.add_argument('--port', type=int,
+                        help='Port of the robot controller')
+    parser.add_argument('--speed-profile',
+                        help='Speed profile to use instead of the one in the '
+                             'plan')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Check the plan and show what would be done')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the samples finished by the last run')
+    parser.add_argument('-y', '--non-interactive', action='store_true',
+                        help="Don't ask whether the reset button has been "
+                             "pressed")
+    args = parser.parse_args(argv)
+
+    try:
+        plan = Plan.from_file(args.plan)
+        if args.speed_profile is not None:
+            plan.speed_profile = get_profile(args.speed_profile)
+        robot = Robot(config_file=args.config, robot_host=args.host,
+                      robot_port=args.port,
+                      journal=None if args.dry_run else args.plan + '.journal')
+        if args.dry_run:
+            dry_run(plan, robot)
+            return 0
+        result = run_plan(plan, robot, Progress(args.plan + '.progress'),
+                          resume=args.resume,
+                          interactive=not args.non_interactive)
+    except (OSError, ValueError, RuntimeError,
+            subprocess.CalledProcessError) as err:
+        print('Run stopped: {}'.format(err), file=sys.stderr)
+        if not args.dry_run:
+            print('Continue the run with --resume', file=sys.stderr)
+        return 1
+    print(result.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
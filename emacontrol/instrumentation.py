@@ -0,0 +1,214 @@
+"""
+Records how long the commands sent to the robot controller take and how
+often they fail, so that the time spent exchanging samples can be monitored.
+
+For each message sent the time taken is split into:
+- connect: opening a socket (or checking a persistent one is still alive)
+- send: sending the message
+- wait: waiting for the reply (i.e. the time the robot takes)
+- parse: parsing and checking the reply
+Retries (sends repeated after a socket error) and failures are also counted.
+Timings are aggregated by command name (e.g. moveCoords, samplePick).
+
+Functions can be registered to be called when a message is sent and when a
+reply has been received:
+
+ema = Robot()
+
+@ema.instrumentation.on_reply
+def report(timing):
+    print(timing.command, timing.total)
+
+Statistics can be exported as JSON or in the Prometheus text format.
+"""
+import collections
+import json
+import time
+
+PHASES = ('connect', 'send', 'wait', 'parse')
+
+
+def command_name(message):
+    """
+    Returns the name of the command in a message (e.g. setCoords for the
+    message setCoords:#X1#Y2;)
+    """
+    return str(message).split(':', 1)[0].rstrip(';')
+
+
+def _label_value(value):
+    """
+    Escape a label value for the Prometheus text format
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class CommandTiming(object):
+    """
+    Timings (in seconds) of a single message sent to the controller.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.command = command_name(message)
+        self.started = time.time()
+        self.connect = 0.0
+        self.send = 0.0
+        self.wait = 0.0
+        self.parse = 0.0
+        self.retries = 0
+        self.failed = False
+        self.reply = None
+
+    @property
+    def total(self):
+        return self.connect + self.send + self.wait + self.parse
+
+    def as_dict(self):
+        record = {'command': self.command,
+                  'message': self.message,
+                  'reply': self.reply,
+                  'started': self.started,
+                  'retries': self.retries,
+                  'failed': self.failed,
+                  'total': self.total,
+                  }
+        for phase in PHASES:
+            record[phase] = getattr(self, phase)
+        return record
+
+
+class Instrumentation(object):
+    """
+    Collects the timings of messages sent to the controller.
+
+    Parameters
+    ----------
+    history : integer number of individual timings to keep (older timings
+              are still included in the aggregated statistics)
+    """
+
+    def __init__(self, history=1000):
+        self.send_hooks = []
+        self.reply_hooks = []
+        self.history = collections.deque(maxlen=history)
+        self.stats = {}
+
+    def on_send(self, hook):
+        """
+        Register a function to be called with the CommandTiming of each message
+        just before it is sent. Can be used as a decorator.
+        """
+        self.send_hooks.append(hook)
+        return hook
+
+    def on_reply(self, hook):
+        """
+        Register a function to be called with the CommandTiming of each message
+        once the reply has been received and checked (or sending failed). Can
+        be used as a decorator.
+        """
+        self.reply_hooks.append(hook)
+        return hook
+
+    def begin(self, message):
+        """
+        Start timing a message which is about to be sent.
+
+        Returns
+        -------
+        CommandTiming : to be filled in and passed to record
+        """
+        timing = CommandTiming(message)
+        for hook in self.send_hooks:
+            hook(timing)
+        return timing
+
+    def record(self, timing):
+        """
+        Add the timing of a message to the statistics.
+        """
+        stats = self.stats.get(timing.command)
+        if stats is None:
+            stats = {'count': 0, 'failures': 0, 'retries': 0, 'max': 0.0}
+            for phase in PHASES:
+                stats[phase] = 0.0
+            self.stats[timing.command] = stats
+        stats['count'] += 1
+        stats['retries'] += timing.retries
+        if timing.failed:
+            stats['failures'] += 1
+        for phase in PHASES:
+            stats[phase] += getattr(timing, phase)
+        stats['max'] = max(stats['max'], timing.total)
+        self.history.append(timing)
+
+        for hook in self.reply_hooks:
+            hook(timing)
+
+    def reset(self):
+        """
+        Discard all statistics and history collected
+        """
+        self.history.clear()
+        self.stats = {}
+
+    def to_dict(self):
+        """
+        Returns the statistics for each command, with the total time (in
+        seconds) spent in each phase and the mean time per message.
+        """
+        output = {}
+        for command, stats in self.stats.items():
+            summary = dict(stats)
+            summary['total'] = sum(stats[phase] for phase in PHASES)
+            summary['mean'] = summary['total'] / stats['count']
+            output[command] = summary
+        return output
+
+    def to_json(self, history=False):
+        """
+        Export the statistics as JSON.
+
+        Parameters
+        ----------
+        history : bool if True, include the individual timings kept
+        """
+        output = {'commands': self.to_dict()}
+        if history:
+            output['history'] = [timing.as_dict() for timing in self.history]
+        return json.dumps(output)
+
+    def to_prometheus(self, prefix='emacontrol'):
+        """
+        Export the statistics in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix : String prefix for the metric names
+        """
+        metrics = (('commands_total', 'count',
+                    'Messages sent to the robot controller'),
+                   ('command_failures_total', 'failures',
+                    'Messages which failed or received an unexpected reply'),
+                   ('command_retries_total', 'retries',
+                    'Sends repeated after a socket error'),
+                   )
+        lines = []
+        for name, key, description in metrics:
+            lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            for command, stats in sorted(self.stats.items()):
+                lines.append('{}_{}{{command="{}"}} {}'.format(
+                    prefix, name, _label_value(command), stats[key]))
+
+        name = '{}_command_seconds_total'.format(prefix)
+        lines.append('# HELP {} Time spent on messages to the robot '
+                     'controller'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        for command, stats in sorted(self.stats.items()):
+            for phase in PHASES:
+                lines.append('{}{{command="{}",phase="{}"}} {!r}'.format(
+                    name, _label_value(command), phase, stats[phase]))
+        return '\n'.join(lines) + '\n'
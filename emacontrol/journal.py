@@ -0,0 +1,347 @@
+"""
+Write-ahead journal of the commands sent to the robot controller, so that
+after the software crashes the robot's state is known and an exchange which
+was cut short can be finished from the step it stopped at.
+
+Each message is written to the journal before it is sent and each reply (or
+error) when it arrives, one short line per record:
+
+B exchange moveSpinner; samplePick; ... moveOffside;
+S moveSpinner;
+R moveSpinner:done;
+S samplePick;
+F timed out
+A timed out
+
+B starts a sequence (with its steps) and D ends it. A ends a sequence which
+was stopped by a step failing (e.g. a fail reply) or by being cancelled: as
+the robot may not be where the sequence expects, it is only carried on with
+by an explicit resume. K records a step which had no reply but was found to
+have been carried out when the sequence was resumed. C records hold a
+snapshot of the state, written when the journal is compacted. Records are
+flushed to the operating system as they are written, so nothing is lost if
+the software crashes. They are only synced to disk (fsync) every few records
+or at the end of a sequence, as syncing each record would slow every
+command down. Only the commands sent on the motion connection are recorded,
+not those sent on the control channel.
+
+Replaying the journal (see replay and Robot.recover) finds the sample on the
+spinner or in the gripper, where the arm is and the steps left of a sequence
+which was cut short, e.g.:
+
+exchange stopped at step 3 of 12 (moveGate;): sample 37 picked, at gate
+"""
+import json
+import os
+import time
+
+from emacontrol.commands import command_for, coords_command
+from emacontrol.instrumentation import command_name
+from emacontrol.sequence import Sequence
+from emacontrol.state import ControllerState
+
+# Records written before fsync is called
+SYNC_EVERY = 32
+# Longest time in seconds records are left unsynced
+SYNC_INTERVAL = 1.0
+
+
+def _check_reply(message, reply, wait_for):
+    # ema imports this module, so Robot is imported when it is first needed
+    from emacontrol.ema import Robot
+    try:
+        parsed = Robot.parse_message(reply)
+    except ValueError:
+        parsed = None
+    try:
+        Robot.check_reply(message, reply, wait_for)
+    except RuntimeError:
+        return parsed, False
+    return parsed, True
+
+
+class Journal(object):
+    """
+    Append-only journal of the messages sent to the controller and the
+    replies received.
+
+    Parameters
+    ----------
+    path : String path of the journal file
+    sync_every : integer number of records written before syncing to disk
+    sync_interval : float longest time in seconds to leave records unsynced
+    """
+
+    def __init__(self, path, sync_every=SYNC_EVERY,
+                 sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _write(self, kind, text=''):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        # Keep every record on one line
+        text = ' '.join(str(text).split())
+        self._file.write('{} {}\n'.format(kind, text) if text else kind + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every) or \
+                (time.monotonic() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """
+        Make sure the records written have reached the disk
+        """
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def sent(self, message):
+        self._write('S', message)
+
+    def received(self, reply):
+        self._write('R', reply)
+
+    def failed(self, error):
+        self._write('F', error)
+
+    def confirmed(self, message):
+        self._write('K', message)
+
+    def begin(self, sequence):
+        self._write('B', ' '.join([sequence.name]
+                                  + [step.message for step in sequence]))
+
+    def end(self):
+        self._write('D')
+        self.sync()
+
+    def aborted(self, error):
+        self._write('A', error)
+        self.sync()
+
+    def checkpoint(self, recovery):
+        """
+        Replace the journal with a snapshot of a recovered state, so that it
+        doesn't grow without limit. The old journal is only replaced once the
+        snapshot is on disk.
+        """
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as snapshot:
+            snapshot.write('C {}\n'.format(json.dumps(recovery.snapshot())))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, self.path)
+
+
+class Recovery(object):
+    """
+    State machine which replays the records of a journal to find the state
+    of the robot when the journal was last written.
+
+    Parameters
+    ----------
+    magazine : Magazine used to find which sample is at the coordinates set
+
+    Attributes
+    ----------
+    state : ControllerState as it was when the journal was written
+    mounted : integer index of the sample on the spinner (None if empty)
+    holding : integer index of the sample in the gripper (None if empty)
+    sequence : Sequence which was running and not finished (None if none)
+    completed : integer number of steps of the sequence completed
+    in_flight : String message sent without a reply (None if none)
+    aborted : bool whether the sequence was stopped by a step failing or by
+              being cancelled (rather than cut short by a crash)
+    """
+
+    def __init__(self, magazine):
+        self.magazine = magazine
+        self.state = ControllerState()
+        self.mounted = None
+        self.holding = None
+        self.sequence = None
+        self.completed = 0
+        self.in_flight = None
+        self.aborted = False
+
+    @property
+    def unfinished(self):
+        """
+        True if a sequence was cut short
+        """
+        return self.sequence is not None
+
+    @property
+    def resumable(self):
+        """
+        True if the sequence was cut short while waiting for the reply to a
+        step, so can be finished without the robot being checked first. A
+        sequence which was aborted, or stopped between steps, is only
+        finished by an explicit resume.
+        """
+        return self.unfinished and (not self.aborted) and \
+            (self.in_flight is not None)
+
+    def apply(self, kind, text):
+        """
+        Update the state from a record of the journal
+        """
+        if kind == 'S':
+            self.in_flight = text
+        elif kind == 'R' and self.in_flight is not None:
+            message, self.in_flight = self.in_flight, None
+            self._completed(message, text)
+        elif kind == 'F' and self.in_flight is not None:
+            # The message may or may not have been carried out
+            message, self.in_flight = self.in_flight, None
+            self._keep_coords(message, self.state.invalidate)
+        elif kind == 'K':
+            self.in_flight = None
+            self._completed(text, command_for(text).wait_for)
+        elif kind == 'B':
+            name, *steps = text.split()
+            self.sequence = Sequence(name, [command_for(step)
+                                            for step in steps])
+            self.completed = 0
+            self.aborted = False
+        elif kind == 'D':
+            self.sequence = None
+        elif kind == 'A':
+            self.in_flight = None
+            self.aborted = True
+        elif kind == 'C':
+            snapshot = json.loads(text)
+            for field in ControllerState.FIELDS:
+                setattr(self.state, field, snapshot.get(field))
+            if self.state.coords is not None:
+                self.state.coords = tuple(self.state.coords)
+            self.mounted = snapshot.get('mounted')
+            self.holding = snapshot.get('holding')
+            self.sequence = None
+            self.aborted = False
+
+    def _completed(self, message, reply):
+        step = None
+        if self.sequence is not None and \
+                self.completed < len(self.sequence) and \
+                self.sequence.steps[self.completed].message == message:
+            step = self.sequence.steps[self.completed]
+        wait_for = step.wait_for if step is not None else None
+        parsed, done = _check_reply(message, reply, wait_for)
+        location = self.state.location
+        self._keep_coords(message, self.state.update, message, reply, parsed)
+        if not done:
+            return
+        if step is not None:
+            self.completed += 1
+        command = command_name(message)
+        if command == 'samplePick':
+            if location == 'spinner':
+                self.holding, self.mounted = self.mounted, None
+            elif location == 'magazine' and self.state.coords is not None:
+                self.holding = self.magazine.xy_to_index(*self.state.coords)
+        elif command == 'sampleRelease':
+            if location == 'spinner':
+                self.mounted = self.holding
+            self.holding = None
+
+    def _keep_coords(self, message, update, *args):
+        # Only setCoords changes the coordinates, so they are still known
+        # after other messages fail
+        coords = self.state.coords
+        update(*args)
+        if command_name(message) != 'setCoords' and self.state.coords is None:
+            self.state.coords = coords
+
+    def remaining(self):
+        """
+        Returns the Sequence of steps left to finish the sequence which was
+        cut short, starting with the step which had no reply. If the arm
+        still has to go to the magazine, the coordinates are set again before
+        it moves there, in case the controller has been restarted.
+        """
+        if self.sequence is None:
+            return None
+        steps = list(self.sequence.steps[self.completed:])
+        for index, step in enumerate(steps):
+            if step.name == 'setCoords':
+                break
+            if step.name == 'moveCoords':
+                if self.state.coords is not None:
+                    steps.insert(index, coords_command(*self.state.coords))
+                break
+        return Sequence(self.sequence.name, steps)
+
+    def describe(self):
+        """
+        Returns a description of the recovered state, e.g. "exchange stopped
+        at step 3 of 12 (moveGate;): sample 37 picked, at gate" (or "aborted
+        at" if the sequence was aborted)
+        """
+        parts = []
+        if self.holding is not None:
+            parts.append('sample {} picked'.format(self.holding))
+        if self.mounted is not None:
+            parts.append('sample {} on the spinner'.format(self.mounted))
+        elif self.holding is None:
+            parts.append('no sample on the spinner')
+        if self.state.location is not None:
+            parts.append('at {}'.format(self.state.location))
+        description = ', '.join(parts)
+        if self.sequence is None:
+            return description
+        step = self.sequence.steps[min(self.completed,
+                                       len(self.sequence) - 1)]
+        return '{} {} at step {} of {} ({}): {}'.format(
+            self.sequence.name, 'aborted' if self.aborted else 'stopped',
+            self.completed + 1, len(self.sequence), step.message, description)
+
+    def snapshot(self):
+        """
+        Returns the state as a dict, to be written to the journal
+        """
+        snapshot = self.state.as_dict()
+        snapshot['mounted'] = self.mounted
+        snapshot['holding'] = self.holding
+        return snapshot
+
+
+def replay(path, magazine):
+    """
+    Replay a journal.
+
+    Parameters
+    ----------
+    path : String path of the journal file
+    magazine : Magazine of the robot
+
+    Returns
+    -------
+    Recovery : with the state when the journal was last written (the
+               initial state if there is no journal)
+    """
+    recovery = Recovery(magazine)
+    if not os.path.exists(path):
+        return recovery
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            if not line.endswith('\n'):
+                # Cut off part way through by the crash
+                break
+            kind, _, text = line.rstrip('\n').partition(' ')
+            recovery.apply(kind, text)
+    return recovery
@@ -0,0 +1,219 @@
+"""
+Model of the sample magazines, which converts between sample indices (as
+used by users, starting at 1) and the (X, Y) magazine coordinates sent to the
+robot controller with setCoords.
+
+Samples are numbered along each row of the magazine: with 10 columns, sample 1
+is at (0, 0), sample 10 at (0, 9) and sample 11 at (1, 0). Further magazines
+follow on from the last row of the previous one. Slots which can't be used
+(e.g. broken or reserved positions) can be blocked.
+
+The geometry is read from the [magazine] section of the configuration file
+(see example_config.ini). The pitch is the distance between slots in mm. It
+must match the pitch used by setCoords in the controller program and is used
+to estimate the distance the arm travels between slots.
+
+Conversions for single samples use tables computed when the magazine is
+created. Whole lists of samples (e.g. the plan for a night's measurements)
+can be checked and converted in one go with NumPy.
+"""
+import configparser
+import os
+
+from emacontrol.utils import input_to_int
+
+
+def _numpy():
+    # NumPy is only needed for whole sample lists, so is imported on demand
+    import numpy
+    return numpy
+
+
+def _is_number(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class Magazine(object):
+    """
+    Geometry of the sample magazines.
+
+    Parameters
+    ----------
+    rows : integer number of rows (X coordinates) in each magazine
+    columns : integer number of columns (Y coordinates) in each magazine
+    pitch : tuple of floats distance between rows and between columns in mm
+    magazines : integer number of magazines
+    blocked : iterable of integer indices of samples which can't be used
+    """
+
+    def __init__(self, rows=30, columns=10, pitch=(17.03, 17.0), magazines=1,
+                 blocked=()):
+        for name, value in (('rows', rows), ('columns', columns),
+                            ('magazines', magazines)):
+            if input_to_int(value) <= 0:
+                raise ValueError('Expecting {} greater than 0'.format(name))
+        self.rows = int(rows)
+        self.columns = int(columns)
+        self.magazines = int(magazines)
+        self.pitch = (float(pitch[0]), float(pitch[1]))
+        self.capacity = self.rows * self.columns * self.magazines
+
+        # Lookup tables. Index 0 is not a sample, so the first entry is empty
+        self._index_to_xy = [None]
+        self._xy_to_index = {}
+        for i in range(self.capacity):
+            coords = (i // self.columns, i % self.columns)
+            self._index_to_xy.append(coords)
+            self._xy_to_index[coords] = i + 1
+
+        self.blocked = frozenset(self._check_index(n) for n in blocked)
+        self._numpy_tables = None
+
+    @classmethod
+    def from_config(cls, config_file):
+        """
+        Create a magazine from the [magazine] section of a configuration file.
+        If there is no such file or section, the default geometry is used.
+
+        Parameters
+        ----------
+        config_file : String path of the configuration file
+        """
+        if (config_file is None) or (not os.path.exists(config_file)):
+            return cls()
+        confparse = configparser.ConfigParser()
+        confparse.read(config_file)
+        if not confparse.has_section('magazine'):
+            return cls()
+        section = confparse['magazine']
+        blocked = [n.strip() for n in section.get('blocked', '').split(',')]
+        return cls(rows=section.get('rows', 30),
+                   columns=section.get('columns', 10),
+                   pitch=(section.getfloat('pitch_x', 17.03),
+                          section.getfloat('pitch_y', 17.0)),
+                   magazines=section.get('magazines', 1),
+                   blocked=[n for n in blocked if n])
+
+    def _check_index(self, n):
+        n = input_to_int(n)
+        if n <= 0:
+            raise ValueError('Expecting value greater than 0')
+        if n > self.capacity:
+            raise ValueError('Sample {} is outside the magazine (there are {} '
+                             'positions)'.format(n, self.capacity))
+        return n
+
+    def index_to_xy(self, n):
+        """
+        Convert the index of a sample to its xy coordinates on the magazine.
+
+        Parameters
+        ----------
+        n : integer index of the sample (starting at 1)
+
+        Returns
+        -------
+        tuple of integers : x & y coordinates
+
+        Raises
+        ------
+        ValueError : if n is not an integer, is outside the magazine or is a
+                     blocked slot
+        """
+        n = self._check_index(n)
+        if n in self.blocked:
+            raise ValueError('Sample position {} is blocked'.format(n))
+        return self._index_to_xy[n]
+
+    def xy_to_index(self, x, y):
+        """
+        Convert the xy coordinates of a position on the magazine to the index
+        of the sample at that position.
+
+        Raises
+        ------
+        ValueError : if there is no such position on the magazine
+        """
+        try:
+            return self._xy_to_index[(x, y)]
+        except KeyError:
+            raise ValueError('No sample position at ({}, {})'.format(x, y))
+
+    def _tables(self):
+        """
+        Returns NumPy versions of the lookup tables: an array of xy
+        coordinates for each index and a boolean array of usable indices
+        """
+        if self._numpy_tables is None:
+            np = _numpy()
+            xy = np.zeros((self.capacity + 1, 2), dtype=int)
+            xy[1:] = self._index_to_xy[1:]
+            usable = np.ones(self.capacity + 1, dtype=bool)
+            usable[0] = False
+            usable[list(self.blocked)] = False
+            self._numpy_tables = (xy, usable)
+        return self._numpy_tables
+
+    def validate(self, samples):
+        """
+        Check all the indices in a list of samples in one go.
+
+        Parameters
+        ----------
+        samples : iterable of integer sample indices
+
+        Returns
+        -------
+        numpy.ndarray : the sample indices
+
+        Raises
+        ------
+        ValueError : listing every index in the list which can't be used
+        """
+        np = _numpy()
+        samples = list(samples)
+        try:
+            samples = np.asarray(samples, dtype=float)
+        except (TypeError, ValueError):
+            problems = ', '.join('{!r} (position {})'.format(sample, i + 1)
+                                 for i, sample in enumerate(samples)
+                                 if not _is_number(sample))
+            raise ValueError('Expecting numeric sample indices. Got: {}'
+                             .format(problems))
+        if samples.size == 0:
+            return samples.astype(int)
+        not_integer = samples != np.round(samples)
+        _, usable = self._tables()
+        in_range = (samples >= 1) & (samples <= self.capacity)
+        ok = in_range & ~not_integer
+        ok[ok] = usable[samples[ok].astype(int)]
+        if not ok.all():
+            problems = ', '.join('{:g} (position {})'.format(samples[i], i + 1)
+                                 for i in np.flatnonzero(~ok))
+            raise ValueError('Invalid sample indices: {}'.format(problems))
+        return samples.astype(int)
+
+    def indices_to_xy(self, samples):
+        """
+        Convert a list of sample indices to xy coordinates.
+
+        Returns
+        -------
+        numpy.ndarray : of shape (number of samples, 2)
+        """
+        xy, _ = self._tables()
+        return xy[self.validate(samples)]
+
+    def positions(self, samples):
+        """
+        Positions of samples relative to sample 1 in mm, from the pitch.
+
+        Returns
+        -------
+        numpy.ndarray : of shape (number of samples, 2)
+        """
+        return self.indices_to_xy(samples) * _numpy().asarray(self.pitch)
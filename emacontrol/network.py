@@ -1,26 +1,234 @@
 import configparser
-import gevent
+import contextlib
+import errno
+import functools
+import select
 import socket
 import time
 import os
 
+from emacontrol.instrumentation import Instrumentation
 from emacontrol.utils import input_to_int
 
-try:
-    from gevent.coros import BoundedSemaphore
-except ImportError:
-    from gevent.lock import BoundedSemaphore
+# gevent is only imported once a connector is created. Scripts which only use
+# e.g. Robot.parse_message or Robot.samplenr_to_xy don't need it.
 
-_send_recv_semaphore = BoundedSemaphore()
+
+def _semaphore():
+    """
+    Returns a new gevent BoundedSemaphore
+    """
+    try:
+        from gevent.coros import BoundedSemaphore
+    except ImportError:
+        from gevent.lock import BoundedSemaphore
+    return BoundedSemaphore()
+
+
+def _sleep(seconds):
+    """
+    Sleep, letting other greenlets run
+    """
+    import gevent
+    gevent.sleep(seconds)
+
+
+def wait_read(fileno, timeout=None, timeout_exc=socket.timeout):
+    """
+    Wait until a file descriptor is readable, letting other greenlets run.
+    See gevent.socket.wait_read.
+    """
+    from gevent.socket import wait_read
+    wait_read(fileno, timeout=timeout, timeout_exc=timeout_exc)
+
+
+def wait_write(fileno, timeout=None, timeout_exc=socket.timeout):
+    """
+    Wait until a file descriptor is writable, letting other greenlets run.
+    See gevent.socket.wait_write.
+    """
+    from gevent.socket import wait_write
+    wait_write(fileno, timeout=timeout, timeout_exc=timeout_exc)
+
+
+# connect_ex results meaning a non-blocking connect is still going on
+_CONNECTING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def read_peer_config(config_file):
+    '''
+    Read the hostname/IP address and port of the robot controller from a
+    configuration file. See example_config.ini to see the structure of the
+    config.
+
+    Parameters
+    ----------
+    config_file : String path of the configuration file
+
+    Returns
+    -------
+    tuple : hostname and (integer) port
+    '''
+    # FIXME Make this non-robot specific
+    if not os.path.exists(config_file):
+        raise FileNotFoundError('Cannot find E.M.A. API config file: {}'
+                                .format(config_file))
+    # The file is only read again if it has been modified
+    return _read_peer_config(config_file, os.stat(config_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def _read_peer_config(config_file, mtime):
+    # TODO Log: 'Reading config file {}'.format(config_file)
+    confparse = configparser.ConfigParser()
+    confparse.read(config_file)
+
+    # Read values from config ensuring port is integer > 0
+    robot_host = confparse.get('robot', 'address')
+    robot_port = input_to_int(confparse.get('robot', 'port'))
+    if robot_port <= 0:
+        raise ValueError('Expecting value greater than 0')
+    return (robot_host, robot_port)
+
+
+class MessageFramer(object):
+    """
+    Splits the stream of bytes received from the controller into messages,
+    each terminated with a ;. Bytes are received into a preallocated buffer
+    and bytes following a complete message are kept for the next one. This
+    means messages split across several receives or several messages arriving
+    in a single receive are both handled.
+
+    The controller pads its messages with null bytes; these are discarded, as
+    are empty messages.
+
+    Parameters
+    ----------
+    size : integer size of the receive buffer in bytes
+    """
+
+    def __init__(self, size=1024):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Received bytes not yet returned as a message are buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def reset(self):
+        """
+        Discard any bytes received (e.g. when a new connection is made)
+        """
+        self.start = 0
+        self.end = 0
+
+    def receive(self, sock):
+        """
+        Receive bytes from a socket into the buffer.
+
+        Parameters
+        ----------
+        sock : socket to receive from
+
+        Returns
+        -------
+        integer : number of bytes received (0 if the socket was closed)
+        """
+        if self.start == self.end:
+            self.reset()
+        elif self.start > 0:
+            # Move the incomplete message to the start of the buffer, so
+            # there is as much space as possible to receive into
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        if self.end == len(self.buffer):
+            msg = 'No message delimiter in {} bytes received'.format(
+                len(self.buffer))
+            raise RuntimeError(msg)
+        nbytes = sock.recv_into(self.view[self.end:])
+        self.end += nbytes
+        return nbytes
+
+    def next_message(self):
+        """
+        Returns the next complete message received (including the ;), or None
+        if no complete message has been received yet.
+        """
+        while True:
+            # Skip null bytes left over from padding of the previous message
+            while (self.start < self.end) and (self.buffer[self.start] == 0):
+                self.start += 1
+            delim = self.buffer.find(b';', self.start, self.end)
+            if delim == -1:
+                return None
+            message = str(self.view[self.start:delim + 1], 'utf-8')
+            self.start = delim + 1
+            if message != ';':
+                return message
 
 
 class SocketConnector(object):
 
-    def __init__(self, host, port, config_file=None, socket_timeout=120):
+    def __init__(self, host, port, config_file=None, socket_timeout=120,
+                 persistent=False, instrumentation=None, recorder=None):
         self.peer = (host, port)
         self.sock = None
         self.socket_timeout = socket_timeout
         self.config_file = config_file
+        # In persistent mode a single socket is kept open between messages
+        # rather than being opened and closed for every message sent
+        self.persistent = persistent
+        # Each connection has its own lock, so that connections to different
+        # controllers can be used concurrently
+        self._lock = _semaphore()
+        self._framer = MessageFramer()
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        # Records the traffic on each socket (see emacontrol.recorder)
+        self.recorder = recorder
+        self._conn_id = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Start a persistent session with the controller. The socket is opened
+        immediately and is then kept open across calls to send until close is
+        called.
+        """
+        self.persistent = True
+        self._connect()
+
+    def close(self):
+        """
+        End a persistent session with the controller, closing the socket.
+        Subsequent messages are sent on a new socket per message.
+        """
+        self.persistent = False
+        self._disconnect()
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Keep one socket open for all the messages sent in a with-block. The
+        socket is opened when the first message is sent. If a persistent
+        session was already open, it is left open afterwards.
+        """
+        if self.persistent:
+            yield self
+            return
+        self.persistent = True
+        try:
+            yield self
+        finally:
+            self.close()
 
     def _read_config(self):
         '''
@@ -29,36 +237,48 @@ class SocketConnector(object):
         and the port are read from the config_file. See example_config.ini to
         see the structure of the config.
         '''
-        # FIXME Make this non-robot specific
-        # TODO Log: 'Reading config file {}'.format(self.config_file)
-        if not os.path.exists(self.config_file):
-            raise(FileNotFoundError('Cannot find E.M.A. API config file: {}'
-                                    .format(self.config_file)))
-        confparse = configparser.ConfigParser()
-        confparse.read(self.config_file)
-
-        # Read values from config ensuring port is integer > 0
-        robot_host = confparse.get('robot', 'address')
-        robot_port = input_to_int(confparse.get('robot', 'port'))
-        if robot_port <= 0:
-            raise ValueError('Expecting value greater than 0')
-        self.peer = (robot_host, robot_port)
+        self.peer = read_peer_config(self.config_file)
         # TODO Log: 'Socket peer for this connection set to "{}:{}"'
         # .format(*self.peer)
 
-    def _connect(self):
+    def _connect(self, deadline=None):
         '''
-        Connect a socket to the robot controller
+        Connect a socket to the robot controller. The socket is non-blocking,
+        so other greenlets run while the connection is made.
+
+        Parameters
+        ----------
+        deadline : float time (from time.monotonic) by which the connection
+                   must be made (default: socket_timeout from now)
         '''
         # TODO Log: 'Connecting socket...'
         if self.is_connected():
             # TODO Log: 'Socket already connected to "{}:{}"'
             # .format(*self.sock.getpeername()))
             return
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if deadline is None:
+            deadline = time.monotonic() + self.socket_timeout
         if (self.peer[0] is None) or (self.peer[1] is None):
             self._read_config()
-        self.sock.connect(self.peer)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._framer.reset()
+        self.sock.setblocking(False)
+        try:
+            err = self.sock.connect_ex(self.peer)
+            if err in _CONNECTING:
+                # Don't wait forever for a controller which isn't answering
+                self._wait(wait_write, deadline,
+                           'Connection to {}:{} not made before timeout'
+                           .format(*self.peer))
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+        except Exception:
+            self.sock.close()
+            self.sock = None
+            raise
+        if self.recorder is not None:
+            self._conn_id = self.recorder.opened(self.peer)
         # TODO Log: 'Socket connected to {}:{}'.format(self.address, self.port)
 
     def _disconnect(self):
@@ -70,9 +290,10 @@ class SocketConnector(object):
             # TODO socket_info = self.sock.getpeername()
             self.sock.close()
             self.sock = None
+            self._record_closed()
             # Sleep briefly to ensure the sock.close() has completed before
             # giving the system chance to open another socket!
-            gevent.sleep(0.1)
+            _sleep(0.1)
             # TODO Log: 'Closed socket to {}:{}'.format(*socket_info)
             return
         # TODO Log: 'Socket is already disconnected'
@@ -85,34 +306,93 @@ class SocketConnector(object):
         # print('sock: {} fileno: {}'.format(self.sock, self.sock.fileno()))
         if self.sock is None:
             return False
-        return self.sock.fileno() is not -1
+        return self.sock.fileno() != -1
+
+    def _peer_alive(self):
+        """
+        Checks whether the peer of a connected socket is still there. A socket
+        whose peer has gone away becomes readable and a read returns no data.
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            return self.sock.recv(1, socket.MSG_PEEK) != b''
+        except (OSError, ValueError):
+            return False
+
+    def _ensure_connected(self, deadline=None):
+        """
+        Make sure there is a usable socket before sending a message. In
+        persistent mode the existing socket is reused, unless the controller
+        has dropped the connection, in which case a new one is opened.
+        """
+        if self.persistent and self.is_connected() and not self._peer_alive():
+            # TODO Log: 'Connection to {}:{} lost. Reconnecting...'
+            # .format(*self.peer)
+            self._drop_connection()
+        self._connect(deadline)
 
-    def __send__(self, message):
+    def _drop_connection(self):
+        """
+        Close the socket without waiting. Used when the connection is known to
+        be unusable, so there is no point giving the close time to complete.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self._record_closed()
+
+    def _record_closed(self):
+        if self.recorder is not None and self._conn_id is not None:
+            self.recorder.closed(self._conn_id)
+            self._conn_id = None
+
+    def __send__(self, message, timing=None, data=None):
         """
         Send is a protected method which separates the handling of the socket
         interactions from the interpretation of the message. To send messages
         to the robot, use the send method.
+
+        If a CommandTiming is given, the time taken to connect, send and wait
+        for the reply are recorded in it. Otherwise the message is timed and
+        recorded here. If the encoded message has already been prepared, it
+        can be passed as data.
         """
-        self._connect()
+        if timing is None:
+            timing = self.instrumentation.begin(message)
+            try:
+                return self.__send__(message, timing, data)
+            except Exception:
+                timing.failed = True
+                raise
+            finally:
+                self.instrumentation.record(timing)
 
+        # All waiting (for the connection to be free, to send, for the reply)
+        # must be finished by this deadline, so a hung controller results in
+        # an error after at most socket_timeout seconds
+        deadline = time.monotonic() + self.socket_timeout
+
+        # Lock ensures no other send attempts happen simultaneously on this
+        # connection. Other connections are not affected.
+        if not self._lock.acquire(timeout=self.socket_timeout):
+            msg = 'Connection still in use by another message after timeout'
+            raise RuntimeError(msg)
         try:
-            # with-block ensures no other send attempts happen simultaneously
-            with _send_recv_semaphore:
-                msg_bytes = str(message).encode()
-                bytes_sent = 0
-                send_start = time.time()
-                while bytes_sent < len(msg_bytes):
-                    try:
-                        bytes_sent = bytes_sent + self.sock.send(msg_bytes)
-                        if (time.time() - send_start) > self.socket_timeout:
-                            # TODO Log: 'Failed to send message within timeout
-                            # ({})'.format(self.socket_timeout)
-                            msg = 'Message not sent before timeout'
-                            raise RuntimeError(msg)
-                        # TODO Log: 'Sent message "{}" on socket
-                    except socket.error:
-                        gevent.sleep(0.1)
-                        self._connect()
+            phase_start = time.perf_counter()
+            self._ensure_connected(deadline)
+            timing.connect = time.perf_counter() - phase_start
+
+            completed = False
+            try:
+                phase_start = time.perf_counter()
+                if data is None:
+                    data = str(message).encode()
+                self._send_bytes(data, deadline, timing)
+                timing.send = time.perf_counter() - phase_start
+                if self.recorder is not None:
+                    self.recorder.sent(self._conn_id, message)
 
                 # This is commented out as, although it is the 'correct' thing
                 # to do, it seems to have a detrimental effect on the stability
@@ -121,21 +401,86 @@ class SocketConnector(object):
                 # Message fully sent, so we indicate no further sends
                 # self.sock.shutdown(socket.SHUT_WR)
 
-                # Now we wait for a reply
-                msg_chunks = []
-                recv_start = time.time()
-                while True:
-                    chunk = self.sock.recv(1024)
-                    chunk = chunk.strip(b'\x00').decode('utf-8')
-                    msg_chunks.append(chunk)
-                    if chunk.count(';') == 1:
-                        break
-                    if (time.time() - recv_start) > self.socket_timeout:
-                        msg = 'No message delimiter received before timeout'
+                # Now we wait for a reply. This may already have been received
+                # along with the previous reply
+                phase_start = time.perf_counter()
+                reply = self._framer.next_message()
+                while reply is None:
+                    self._wait(wait_read, deadline,
+                               'No message delimiter received before timeout')
+                    try:
+                        received = self._framer.receive(self.sock)
+                    except BlockingIOError:
+                        # Woken up without anything to receive after all
+                        continue
+                    if received == 0:
+                        # The controller closed the connection on us
+                        msg = 'Connection closed before reply was received'
                         raise RuntimeError(msg)
+                    reply = self._framer.next_message()
+                timing.wait = time.perf_counter() - phase_start
+                timing.reply = reply
+                completed = True
+                if self.recorder is not None:
+                    self.recorder.received(self._conn_id, reply)
+            except Exception as err:
+                if self.recorder is not None and self._conn_id is not None:
+                    self.recorder.failed(self._conn_id, err)
+                raise
+            finally:
+                # We're done, close the socket. In persistent mode it stays
+                # open, unless the exchange went wrong and the socket can't be
+                # trusted
+                if not self.persistent:
+                    self._disconnect()
+                elif not completed:
+                    self._drop_connection()
         finally:
-            # We're done, close the socket
-            self._disconnect()
+            self._lock.release()
+
+        return reply
+
+    def _send_bytes(self, msg_bytes, deadline, timing):
+        """
+        Send all of a message before the deadline. If the socket fails, a new
+        connection is made and the whole message is sent again on it.
+        """
+        bytes_sent = 0
+        while bytes_sent < len(msg_bytes):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # TODO Log: 'Failed to send message within timeout
+                # ({})'.format(self.socket_timeout)
+                raise RuntimeError('Message not sent before timeout')
+            try:
+                bytes_sent += self.sock.send(msg_bytes[bytes_sent:])
+                # TODO Log: 'Sent message "{}" on socket
+            except BlockingIOError:
+                # The send buffer is full. Wait (letting other greenlets run)
+                # until there is space
+                self._wait(wait_write, deadline,
+                           'Message not sent before timeout')
+            except socket.error:
+                # Give the controller a moment (letting other greenlets run)
+                # before reconnecting and starting the message again
+                timing.retries += 1
+                self._drop_connection()
+                _sleep(min(0.1, remaining))
+                self._connect(deadline)
+                bytes_sent = 0
 
-        # Put the message back together and check it's what we expected
-        return "".join(msg_chunks)
+    def _wait(self, wait, deadline, msg):
+        """
+        Wait (with wait_read or wait_write) until the socket is ready or the
+        deadline is reached, in which case a RuntimeError with msg is raised.
+        Other greenlets run while waiting.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            try:
+                wait(self.sock.fileno(), timeout=remaining,
+                     timeout_exc=socket.timeout)
+                return
+            except socket.timeout:
+                pass
+        raise RuntimeError(msg)
@@ -0,0 +1,138 @@
+"""
+Operations (mounting, unmounting or exchanging a sample) which run in the
+background, so that the caller isn't blocked while the robot moves:
+
+operation = ema.start_exchange(12)
+operation.on_progress(lambda op, step: print(step.message, step.duration))
+...
+result = operation.wait()
+
+An operation can be cancelled at any time. Cancelling sends interrupt to the
+controller on the control channel (the controller's second connection), so
+the robot stops within milliseconds rather than when the current move ends.
+The connection waiting for the reply to the move is then dropped.
+
+The interrupted move is paused on the controller, not abandoned. It
+continues after Robot.restart or when the next move is started, so the
+robot needs to be checked before carrying on.
+"""
+
+
+def _gevent():
+    # gevent is only needed once an operation is started
+    import gevent
+    return gevent
+
+
+class OperationCancelled(RuntimeError):
+    """
+    Raised in an operation which has been cancelled (and by Operation.wait)
+    """
+
+
+class Operation(object):
+    """
+    Handle of an operation running in the background. Created by the
+    Robot.start_* methods.
+
+    Attributes
+    ----------
+    name : String name of the operation (e.g. mount)
+    steps : list of StepResults of the steps completed so far
+    total_steps : integer number of steps in the operation (None until the
+                  first step has completed)
+    cancelled : bool whether the operation was cancelled
+    """
+
+    def __init__(self, robot, name, method, *args):
+        self.robot = robot
+        self.name = name
+        self.steps = []
+        self.total_steps = None
+        self.cancelled = False
+        self._callbacks = []
+        self._error = None
+        self._greenlet = _gevent().spawn(self._run, method, args)
+
+    def __repr__(self):
+        if self.cancelled:
+            status = 'cancelled'
+        elif self.done():
+            status = 'done'
+        else:
+            status = '{}/{} steps'.format(len(self.steps),
+                                          self.total_steps or '?')
+        return '<Operation {} ({})>'.format(self.name, status)
+
+    def _run(self, method, args):
+        # Errors are kept to be raised by wait, rather than being reported by
+        # gevent as the greenlet failing
+        try:
+            return method(*args, progress=self._progress)
+        except Exception as err:
+            self._error = err
+
+    def _progress(self, step, index, total):
+        self.steps.append(step)
+        self.total_steps = total
+        for callback in self._callbacks:
+            callback(self, step)
+
+    def on_progress(self, callback):
+        """
+        Register a function to be called with the operation and the
+        StepResult each time a step completes. Can be used as a decorator.
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def done(self):
+        """
+        Returns True if the operation has finished (successfully or not)
+        """
+        return self._greenlet.ready()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the operation to finish.
+
+        Parameters
+        ----------
+        timeout : float maximum time to wait in seconds (None waits until the
+                  operation is finished)
+
+        Returns
+        -------
+        SequenceResult : with the time taken by each step
+
+        Raises
+        ------
+        OperationCancelled : if the operation was cancelled
+        SequenceError : if a step failed
+        gevent.Timeout : if the operation didn't finish within timeout
+        """
+        result = self._greenlet.get(timeout=timeout)
+        if self._error is None:
+            return result
+        if self.cancelled:
+            raise OperationCancelled('{} cancelled after {} steps'.format(
+                self.name.capitalize(), len(self.steps))) from self._error
+        raise self._error
+
+    def cancel(self):
+        """
+        Stop the operation: the robot is interrupted and the operation stops
+        waiting for the current move.
+
+        Returns
+        -------
+        bool : False if the operation had already finished
+        """
+        if self.done():
+            return False
+        self.cancelled = True
+        try:
+            self.robot.interrupt()
+        finally:
+            self._greenlet.kill(OperationCancelled('Cancelled'))
+        return True
@@ -0,0 +1,198 @@
+"""
+Plans the order in which a batch of samples is measured, so that the arm
+travels as little as possible.
+
+When samples are exchanged one after another, the moves between the spinner,
+the gate and each sample's slot are the same whatever order the samples are
+measured in. The only move which depends on the order is the one from the
+slot of the sample just returned to the magazine to the slot of the next
+sample (moveCoords). The planner chooses the order which minimises the total
+cost of these legs.
+
+By default the cost of a leg is the time taken to travel the straight line
+distance between the two slots (from the magazine pitch) at a constant speed.
+Any other cost can be used by passing a function, e.g. one based on measured
+moveCoords times:
+
+plan = plan_run([12, 250, 3, 101], leg_cost=lambda a, b: move_times[(a, b)])
+print(plan.order, plan.saving)
+
+The order is found with a nearest neighbour tour, which is then improved by
+2-opt (reversing sections of the run while this makes it cheaper).
+"""
+from emacontrol.magazine import Magazine, _numpy
+
+# Estimated speed of the arm over the magazine in mm/s
+DEFAULT_TRAVEL_SPEED = 50.0
+# Number of starting points tried for the nearest neighbour tour
+TOUR_STARTS = 8
+
+
+class RunPlan(object):
+    """
+    The order in which to measure a batch of samples.
+
+    Attributes
+    ----------
+    order : list of integer sample indices, in the order to measure them
+    expected_time : float total cost of the legs between slots in the planned
+                    order (in seconds for the default cost)
+    original_time : float total cost of the legs in the order given
+    """
+
+    def __init__(self, order, expected_time, original_time):
+        self.order = order
+        self.expected_time = expected_time
+        self.original_time = original_time
+
+    @property
+    def saving(self):
+        """
+        Expected reduction in cost compared to the order given
+        """
+        return self.original_time - self.expected_time
+
+    def __repr__(self):
+        return ('RunPlan(order={}, expected_time={:.2f}, saving={:.2f})'
+                .format(self.order, self.expected_time, self.saving))
+
+
+def travel_cost(magazine, speed=DEFAULT_TRAVEL_SPEED):
+    """
+    Returns a function giving the time taken to move between two slots at a
+    constant speed.
+
+    Parameters
+    ----------
+    magazine : Magazine with the positions of the slots
+    speed : float speed of the arm in mm/s
+    """
+    def cost(a, b):
+        pos_a, pos_b = magazine.positions([a, b])
+        return float(_numpy().hypot(*(pos_b - pos_a))) / speed
+    return cost
+
+
+def _cost_matrix(nodes, magazine, leg_cost, speed):
+    np = _numpy()
+    if leg_cost is None:
+        positions = magazine.positions(nodes)
+        diff = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        return np.hypot(diff[..., 0], diff[..., 1]) / speed
+    return np.array([[leg_cost(a, b) if i != j else 0.0
+                      for j, b in enumerate(nodes)]
+                     for i, a in enumerate(nodes)], dtype=float)
+
+
+def _path_cost(cost, path):
+    return float(cost[path[:-1], path[1:]].sum())
+
+
+def _nearest_neighbour(cost, start):
+    np = _numpy()
+    size = len(cost)
+    visited = np.zeros(size, dtype=bool)
+    path = [start]
+    visited[start] = True
+    for _ in range(size - 1):
+        row = np.where(visited, np.inf, cost[path[-1]])
+        nxt = int(np.argmin(row))
+        path.append(nxt)
+        visited[nxt] = True
+    return np.array(path)
+
+
+def _two_opt(cost, path, fixed_start):
+    """
+    Improve an open path by reversing sections of it. The change in cost
+    includes the legs inside the reversed section, which are travelled in the
+    opposite direction, so asymmetric costs are handled correctly.
+    """
+    np = _numpy()
+    first = 1 if fixed_start else 0
+    size = len(path)
+    improved = True
+    while improved:
+        improved = False
+        # Cumulative change in cost from travelling each leg backwards
+        reverse = np.concatenate(
+            ([0.0], np.cumsum(cost[path[1:], path[:-1]]
+                              - cost[path[:-1], path[1:]])))
+        for i in range(first, size - 1):
+            # Change in cost from reversing path[i:j + 1] for each j > i
+            j = np.arange(i + 1, size)
+            delta = reverse[j] - reverse[i]
+            if i > 0:
+                before = path[i - 1]
+                delta += cost[before, path[j]] - cost[before, path[i]]
+            has_after = j < size - 1
+            after = path[j[has_after] + 1]
+            delta[has_after] += (cost[path[i], after]
+                                 - cost[path[j[has_after]], after])
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                path = path.copy()
+                path[i:j[k] + 1] = path[i:j[k] + 1][::-1]
+                improved = True
+                break
+    return path
+
+
+def plan_run(samples, magazine=None, leg_cost=None, start=None,
+             speed=DEFAULT_TRAVEL_SPEED):
+    """
+    Reorder a batch of samples to minimise the cost of moving between their
+    slots.
+
+    Parameters
+    ----------
+    samples : iterable of integer sample indices
+    magazine : Magazine with the slot positions (default geometry if None)
+    leg_cost : function taking the indices of two samples (from, to) and
+               returning the cost of moving between their slots (optional,
+               defaults to the travel time at speed)
+    start : integer index of the sample on the spinner when the run starts.
+            The first leg is from its slot (optional)
+    speed : float speed of the arm in mm/s for the default cost
+
+    Returns
+    -------
+    RunPlan : the planned order with its expected cost and saving
+
+    Raises
+    ------
+    ValueError : if any of the samples (or start) can't be used
+    """
+    np = _numpy()
+    if magazine is None:
+        magazine = Magazine()
+    samples = [int(n) for n in magazine.validate(samples)]
+    if start is not None:
+        magazine.index_to_xy(start)
+        nodes = [int(start)] + samples
+    else:
+        nodes = samples
+    cost = _cost_matrix(nodes, magazine, leg_cost, speed)
+    original = np.arange(len(nodes))
+    original_time = _path_cost(cost, original)
+    if len(samples) < 2:
+        return RunPlan(samples, original_time, original_time)
+
+    # Without a fixed start, try tours from a few different first samples
+    if start is not None:
+        candidates = [0]
+    else:
+        step = max(1, len(nodes) // TOUR_STARTS)
+        candidates = range(0, len(nodes), step)
+    best_path, best_time = original, original_time
+    for first in candidates:
+        path = _two_opt(cost, _nearest_neighbour(cost, first),
+                        start is not None)
+        path_time = _path_cost(cost, path)
+        if path_time < best_time:
+            best_path, best_time = path, path_time
+
+    order = [nodes[i] for i in best_path]
+    if start is not None:
+        order = order[1:]
+    return RunPlan(order, best_time, original_time)
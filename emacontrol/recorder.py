@@ -0,0 +1,152 @@
+"""
+Records the traffic between the client and the robot controller, so that a
+session from a beamtime can be replayed later (see emacontrol.replay) to
+reproduce a failure or to measure a change in performance.
+
+Recording is switched on by giving a recorder to the robot:
+
+with TrafficRecorder('session.log') as recorder:
+    ema = Robot(recorder=recorder)
+    ...
+
+Each event is one line: the time in seconds since recording started (from
+the monotonic clock), the ID of the connection, the kind of event and its
+text:
+
+0.000000 1 O 192.168.0.2:10005
+0.000213 1 > moveGate;
+2.503117 1 < moveGate:done;
+2.503562 1 ! Connection closed before reply was received
+2.604190 1 C
+
+O and C are the connection being opened and closed, > a message sent, < a
+reply received and ! an error while waiting for a reply. Every socket opened
+gets a new ID, so reconnects and the control channel can be told apart. Logs
+whose path ends with .gz are compressed.
+
+Records are written in batches, except that errors and failed replies are
+flushed straight away, so that the events leading up to a failure are in the
+log even if the client is killed. The log is closed when Python exits.
+"""
+import atexit
+import gzip
+import itertools
+import time
+
+# Records written before the log is flushed
+FLUSH_EVERY = 64
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class TrafficRecorder(object):
+    """
+    Writes the messages sent to and replies received from the controller on
+    every connection to a log.
+
+    Parameters
+    ----------
+    path : String path of the log (compressed if it ends with .gz)
+    flush_every : integer number of records written before flushing the log
+    """
+
+    def __init__(self, path, flush_every=FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self._file = _open(path, 'w')
+        self._ids = itertools.count(1)
+        self._start = time.monotonic()
+        self._unflushed = 0
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, conn, kind, text='', flush=False):
+        if self._file is None:
+            return
+        # Keep every record on one line
+        text = ' '.join(str(text).split())
+        self._file.write('{:.6f} {} {} {}'.format(
+            time.monotonic() - self._start, conn, kind, text).rstrip() + '\n')
+        self._unflushed += 1
+        if flush or (self._unflushed >= self.flush_every):
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        self._unflushed = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            atexit.unregister(self.close)
+
+    def opened(self, peer):
+        """
+        Record a new connection to peer (host, port), returning its ID
+        """
+        conn = next(self._ids)
+        self._write(conn, 'O', '{}:{}'.format(*peer))
+        return conn
+
+    def closed(self, conn):
+        self._write(conn, 'C')
+
+    def sent(self, conn, message):
+        self._write(conn, '>', message)
+
+    def received(self, conn, reply):
+        self._write(conn, '<', reply, flush=':fail' in reply)
+
+    def failed(self, conn, error):
+        self._write(conn, '!', error, flush=True)
+
+
+class TrafficRecord(object):
+    """
+    An event read from a traffic log (see TrafficRecorder)
+    """
+    __slots__ = ('time', 'conn', 'kind', 'text')
+
+    def __init__(self, time, conn, kind, text):
+        self.time = time
+        self.conn = conn
+        self.kind = kind
+        self.text = text
+
+    def __repr__(self):
+        return 'TrafficRecord({:.6f}, {}, {!r}, {!r})'.format(
+            self.time, self.conn, self.kind, self.text)
+
+
+def read_log(path):
+    """
+    Read a traffic log.
+
+    Returns
+    -------
+    list of TrafficRecords : in the order they were recorded
+    """
+    records = []
+    with _open(path, 'r') as log:
+        for line in log:
+            if not line.endswith('\n'):
+                # Cut off part way through
+                break
+            fields = line.rstrip('\n').split(' ', 3)
+            if len(fields) < 3:
+                continue
+            text = fields[3] if len(fields) == 4 else ''
+            records.append(TrafficRecord(float(fields[0]), int(fields[1]),
+                                         fields[2], text))
+    return records
@@ -0,0 +1,347 @@
+"""
+Replays a session recorded with a TrafficRecorder (see emacontrol.recorder)
+through the client against a local stand-in for the controller, which gives
+the replies from the recording after the same delays. The messages are sent
+by a Robot, so the replies are parsed and checked as they were in the
+session, and failures seen at the beamline can be reproduced and debugged
+locally:
+
+python -m emacontrol.replay session.log
+
+The session is replayed at the speed it was recorded at (--speed 2 replays
+it twice as fast) or, with --fast, as fast as possible, to measure the time
+the client itself takes. Each connection of the session is replayed on a
+connection of its own, opened and closed in the same order. The replies
+received are compared with the recorded ones.
+"""
+import argparse
+import collections
+import json
+import sys
+import time
+
+from emacontrol.commands import command_for
+from emacontrol.ema import Robot
+from emacontrol.recorder import read_log
+from emacontrol.simulator import ControllerSimulator
+
+# Time in seconds allowed on top of the recorded delay for each reply
+REPLY_MARGIN = 5.0
+
+
+def _gevent():
+    # gevent is only needed once a session is replayed
+    import gevent
+    return gevent
+
+
+class Exchange(object):
+    """
+    A message sent on a connection and the reply (or error) which followed,
+    as recorded and as replayed.
+
+    Attributes
+    ----------
+    conn : integer ID of the recorded connection
+    message : String message sent
+    sent : float time (in seconds from the start of the session) the
+           message was sent
+    wait : float time in seconds until the reply (or error) was recorded
+    reply : String reply recorded (None if there wasn't one)
+    error : String error recorded (None if there wasn't one)
+    replayed_reply : String reply received when replayed
+    replayed_error : String error raised by the client when replayed
+    replayed_time : float time in seconds taken by the client to send the
+                    message and handle the reply when replayed
+    """
+
+    def __init__(self, conn, message, sent):
+        self.conn = conn
+        self.message = message
+        self.sent = sent
+        self.wait = 0.0
+        self.reply = None
+        self.error = None
+        self.replayed_reply = None
+        self.replayed_error = None
+        self.replayed_time = None
+
+    @property
+    def matches(self):
+        """
+        True if the reply received when replayed was the one recorded
+        """
+        return self.replayed_reply == self.reply
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in (
+            'conn', 'message', 'sent', 'wait', 'reply', 'error',
+            'replayed_reply', 'replayed_error', 'replayed_time', 'matches')}
+
+
+class Session(object):
+    """
+    The events of a recorded session grouped into exchanges.
+
+    Parameters
+    ----------
+    records : list of TrafficRecords (see emacontrol.recorder.read_log)
+
+    Attributes
+    ----------
+    events : list of (time, kind, conn, Exchange or None) in the order they
+             were recorded, where kind is open, close or send
+    exchanges : list of Exchanges in the order the messages were sent
+    duration : float time in seconds from the first to the last record
+    """
+
+    def __init__(self, records):
+        self.events = []
+        self.exchanges = []
+        waiting = {}
+        for record in records:
+            if record.kind == 'O':
+                self.events.append((record.time, 'open', record.conn, None))
+            elif record.kind == 'C':
+                self.events.append((record.time, 'close', record.conn, None))
+            elif record.kind == '>':
+                exchange = Exchange(record.conn, record.text, record.time)
+                waiting[record.conn] = exchange
+                self.exchanges.append(exchange)
+                self.events.append((record.time, 'send', record.conn,
+                                    exchange))
+            elif record.kind in '<!' and record.conn in waiting:
+                exchange = waiting.pop(record.conn)
+                exchange.wait = record.time - exchange.sent
+                if record.kind == '<':
+                    exchange.reply = record.text
+                else:
+                    exchange.error = record.text
+        self.duration = records[-1].time - records[0].time if records else 0.0
+
+    @classmethod
+    def from_log(cls, path):
+        return cls(read_log(path))
+
+
+class ReplayController(ControllerSimulator):
+    """
+    Stand-in for the controller which answers each connection with the
+    replies recorded on the connection it stands for.
+
+    Parameters
+    ----------
+    session : Session to replay
+    scale : float factor applied to the recorded delays (0 replies straight
+            away)
+    """
+
+    def __init__(self, session, scale=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.scale = scale
+        self._scripts = collections.defaultdict(collections.deque)
+        for exchange in session.exchanges:
+            self._scripts[exchange.conn].append(exchange)
+        self._expected = collections.deque()
+        self._slot_conn = {}
+        self._accepted = set()
+
+    def expect(self, conn):
+        """
+        The next connection accepted stands for the recorded connection conn
+        """
+        self._expected.append(conn)
+
+    def accepted(self, conn):
+        return conn in self._accepted
+
+    def _serve(self, slot, sock):
+        conn = self._expected.popleft() if self._expected else None
+        self._slot_conn[slot] = conn
+        self._accepted.add(conn)
+        super()._serve(slot, sock)
+
+    def _dispatch(self, slot, message):
+        message += ';'
+        self.received.append((slot, message))
+        script = self._scripts.get(self._slot_conn.get(slot))
+        if not script or script[0].message != message:
+            self._reply(slot, ":fail_'Not recorded'")
+            return
+        exchange = script.popleft()
+        if exchange.reply is not None:
+            self._spawn(self._recorded_reply, slot, exchange)
+        # Otherwise no reply was received in the session either
+
+    def _recorded_reply(self, slot, exchange):
+        time.sleep(exchange.wait * self.scale)
+        # The ; is added again when the reply is sent
+        self._reply(slot, exchange.reply[:-1])
+
+
+class ReplayReport(object):
+    """
+    Outcome of replaying a session
+
+    Parameters
+    ----------
+    session : Session replayed (with the replayed replies)
+    elapsed : float time in seconds taken to replay it
+    scale : float factor applied to the recorded timings
+    """
+
+    def __init__(self, session, elapsed, scale):
+        self.session = session
+        self.elapsed = elapsed
+        self.scale = scale
+
+    @property
+    def mismatches(self):
+        return [exchange for exchange in self.session.exchanges
+                if not exchange.matches]
+
+    @property
+    def client_time(self):
+        """
+        Time in seconds taken by the client beyond the recorded delays
+        """
+        return sum(max(0.0, exchange.replayed_time
+                       - exchange.wait * self.scale)
+                   for exchange in self.session.exchanges
+                   if exchange.replayed_time is not None)
+
+    def as_dict(self):
+        return {'messages': len(self.session.exchanges),
+                'mismatches': len(self.mismatches),
+                'recorded_duration': self.session.duration,
+                'replayed_duration': self.elapsed,
+                'client_time': self.client_time,
+                'exchanges': [exchange.as_dict()
+                              for exchange in self.session.exchanges]}
+
+    def format(self):
+        lines = ['{:d} messages replayed in {:.3f} s (recorded: {:.3f} s, '
+                 'client: {:.3f} s)'.format(
+                     len(self.session.exchanges), self.elapsed,
+                     self.session.duration, self.client_time)]
+        for exchange in self.session.exchanges:
+            if exchange.replayed_error is not None:
+                lines.append('  {} -> error: {}'.format(
+                    exchange.message, exchange.replayed_error))
+        for exchange in self.mismatches:
+            lines.append('  {} -> {} (recorded: {})'.format(
+                exchange.message, exchange.replayed_reply, exchange.reply))
+        lines.append('{:d} replies differ from the recording'.format(
+            len(self.mismatches)))
+        return '\n'.join(lines)
+
+
+def _replay_exchange(robot, exchange, scale):
+    command = command_for(exchange.message)
+    if exchange.reply is None:
+        # Wait as long as the client waited in the session
+        robot.socket_timeout = max(0.05, exchange.wait * scale)
+    else:
+        robot.socket_timeout = exchange.wait * scale + REPLY_MARGIN
+    start = time.perf_counter()
+    try:
+        exchange.replayed_reply = robot.send(command.message,
+                                             command.wait_for, parse=False)
+    except Exception as err:
+        exchange.replayed_error = str(err)
+        # The reply is kept even if the client rejected it
+        exchange.replayed_reply = robot.instrumentation.history[-1].reply
+    exchange.replayed_time = time.perf_counter() - start
+
+
+def replay_session(session, scale=1.0):
+    """
+    Replay a recorded session.
+
+    Parameters
+    ----------
+    session : Session to replay
+    scale : float factor applied to the recorded timings (1 replays at the
+            recorded speed, 0 as fast as possible)
+
+    Returns
+    -------
+    ReplayReport : comparing the replies with those recorded
+    """
+    gevent = _gevent()
+    robots = {}
+    running = {}
+    with ReplayController(session, scale) as controller:
+        start = time.monotonic()
+        first = session.events[0][0] if session.events else 0.0
+        for event_time, kind, conn, exchange in session.events:
+            gevent.sleep(max(0.0, start + (event_time - first) * scale
+                             - time.monotonic()))
+            if kind == 'open':
+                robots[conn] = robot = Robot(robot_host=controller.host,
+                                             robot_port=controller.port)
+                controller.expect(conn)
+                robot.open()
+                while not controller.accepted(conn):
+                    gevent.sleep(0.001)
+            elif kind == 'close' and conn in robots:
+                if conn in running:
+                    running.pop(conn).join()
+                robots.pop(conn).close()
+            elif kind == 'send' and conn in robots:
+                # Messages on one connection are sent one after the other
+                previous = running.get(conn)
+                running[conn] = gevent.spawn(_after, previous,
+                                             _replay_exchange, robots[conn],
+                                             exchange, scale)
+        gevent.joinall(list(running.values()))
+        elapsed = time.monotonic() - start
+        for robot in robots.values():
+            robot.close()
+    return ReplayReport(session, elapsed, scale)
+
+
+def _after(previous, function, *args):
+    if previous is not None:
+        previous.join()
+    function(*args)
+
+
+def _positive_float(value):
+    """
+    argparse type for a float greater than zero
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0.0
+    if not number > 0:
+        msg = '{} is not a positive number'.format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a recorded E.M.A. session against a local '
+                    'stand-in for the controller')
+    parser.add_argument('log', help='Traffic log (see emacontrol.recorder)')
+    parser.add_argument('--speed', type=_positive_float, default=1.0,
+                        help='Replay this many times faster than recorded')
+    parser.add_argument('--fast', action='store_true',
+                        help='Replay as fast as possible')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    scale = 0.0 if args.fast else 1.0 / args.speed
+    report = replay_session(Session.from_log(args.log), scale)
+    if args.json:
+        print(json.dumps(report.as_dict(), indent=2))
+    else:
+        print(report.format())
+    return 1 if report.mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Sequences of commands which are sent to the robot controller one after the
+other on a single connection (see Robot.run_sequence), with the reply to
+each checked as it arrives.
+
+Each step of a sequence is a Command: a message and the reply expected. The
+bytes sent for each step are computed once, when the step is created. The
+sequences to mount a sample from the magazine and to return it again are
+defined here and are combined to make the macros used by Robot.mount,
+Robot.unmount and Robot.exchange:
+
+exchange = UNMOUNT + coords_step(x, y) + MOUNT
+
+The commands are not pipelined: the controller reads messages in 32 byte
+chunks and runs each move as a separate task, so the next command is only
+sent once the reply to the previous one has arrived.
+
+If a step fails, running the sequence stops and a SequenceError is raised,
+reporting the step which failed and the time taken by each step.
+"""
+from emacontrol.commands import Command, command, coords_command
+
+
+# Steps are commands from the registry, or any other message and reply
+Step = Command
+
+
+def command_step(name):
+    """
+    Returns the step for a command without parameters (see
+    emacontrol.commands)
+    """
+    return command(name)
+
+
+# Setting the coordinates of the next sample is the only step of the macros
+# with parameters
+coords_step = coords_command
+
+
+class Sequence(object):
+    """
+    A named list of steps. Sequences can be added together to make longer
+    sequences, as can sequences and single steps.
+
+    Parameters
+    ----------
+    name : String name of the sequence, used when reporting errors
+    steps : iterable of Steps (Commands) or (message, wait_for) tuples
+    """
+
+    def __init__(self, name, steps=()):
+        self.name = name
+        self.steps = tuple(step if isinstance(step, Step) else Step(*step)
+                           for step in steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __add__(self, other):
+        if isinstance(other, Step):
+            return Sequence(self.name, self.steps + (other,))
+        return Sequence('{}+{}'.format(self.name, other.name),
+                        self.steps + tuple(other))
+
+    def __radd__(self, other):
+        if isinstance(other, Step):
+            return Sequence(self.name, (other,) + self.steps)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Sequence({!r}, {!r})'.format(self.name, list(self.steps))
+
+
+# Mount a sample once its coordinates have been set and return it to the
+# magazine again
+MOUNT = Sequence('mount', [command_step(name) for name in (
+    'moveCoords', 'samplePick', 'moveGate', 'moveSpinner', 'sampleRelease',
+    'moveOffside')])
+UNMOUNT = Sequence('unmount', [command_step(name) for name in (
+    'moveSpinner', 'samplePick', 'moveGate', 'moveCoords', 'sampleRelease')])
+
+
+class StepResult(object):
+    """
+    The outcome of a step of a sequence.
+
+    Attributes
+    ----------
+    message : String message sent
+    reply : String reply received (None if the step failed without a reply)
+    duration : float time in seconds taken by the step
+    error : Exception raised by the step (None if it succeeded)
+    """
+    __slots__ = ('message', 'reply', 'duration', 'error')
+
+    def __init__(self, message, reply, duration, error=None):
+        self.message = message
+        self.reply = reply
+        self.duration = duration
+        self.error = error
+
+
+class SequenceResult(object):
+    """
+    The steps of a sequence which have been run, with the time each took.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    @property
+    def total(self):
+        """
+        Total time in seconds taken by the steps
+        """
+        return sum(step.duration for step in self.steps)
+
+    def format(self):
+        """
+        Returns a table of the time taken by each step
+        """
+        lines = ['{} ({:d} steps, {:.3f} s)'.format(
+            self.name, len(self.steps), self.total)]
+        for i, step in enumerate(self.steps):
+            status = 'FAILED' if step.error is not None else ''
+            lines.append('{:>4d}  {:<24s}{:>9.3f} s  {}'.format(
+                i + 1, step.message, step.duration, status).rstrip())
+        return '\n'.join(lines)
+
+
+class SequenceError(RuntimeError):
+    """
+    Raised when a step of a sequence fails.
+
+    Attributes
+    ----------
+    name : String name of the sequence
+    index : integer index (from 0) of the step which failed
+    step : Step which failed
+    result : SequenceResult with the steps run, including the failed one
+    """
+
+    def __init__(self, name, index, step, result, cause):
+        super().__init__('Sequence "{}" failed at step {} ({}): {}'.format(
+            name, index + 1, step.message, cause))
+        self.name = name
+        self.index = index
+        self.step = step
+        self.result = result
@@ -0,0 +1,347 @@
+"""
+A stand-in for the E.M.A. robot controller which can be run locally, so that
+the client code can be tested and benchmarked without the robot.
+
+The simulator speaks the same protocol as the comm program in val3/comm.pgx:
+- messages are read in 32 byte chunks and must end with a ;
+- replies are the reply text plus a ;, padded with null bytes to 64 bytes
+  (the message array of sendStatus.pgx)
+- two clients can be connected at once (sioASCII[0] and sioASCII[1])
+- motion commands are run as separate tasks, so other commands (e.g.
+  interrupt or getCoords) can be handled while the robot is moving
+
+Robot motion is not simulated beyond waiting for a configurable amount of
+time. Failures can be injected to test how the client handles fail replies.
+
+The simulator can also be started from the command line:
+    python -m emacontrol.simulator --port 10005
+"""
+import argparse
+import socket
+import threading
+import time
+
+from emacontrol.state import MOVE_TARGETS
+
+BUFFER_SIZE = 32
+# Replies are built in the 64 character message array of sendStatus.pgx
+REPLY_SIZE = 64
+SLOTS = 2
+
+
+class ControllerSimulator(object):
+    """
+    Simulated robot controller listening on a local TCP socket.
+
+    Parameters
+    ----------
+    host : String address to listen on
+    port : integer port to listen on (0 picks a free port; see address)
+    motion_time : float default time in seconds taken by moves, gripping and
+                  power switching
+    durations : dict of command names to the time in seconds that command
+                takes (overrides motion_time)
+    speed : initial speed of the robot (mFastMov.vel)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, motion_time=0.0,
+                 durations=None, speed=5):
+        self.host = host
+        self.port = port
+        self.motion_time = motion_time
+        self.durations = dict(durations or {})
+
+        # Controller state
+        self.coords = [0, 0]
+        self.speed = speed
+        self.powered = False
+        self.gripper_closed = False
+        self.location = 'home'
+        self.received = []
+        # Number of connections accepted
+        self.connections = 0
+
+        self._failures = {}
+        self._dispatch_lock = threading.Lock()
+        self._not_interrupted = threading.Event()
+        self._not_interrupted.set()
+        self._server = None
+        self._slots = [None] * SLOTS
+        self._send_locks = [threading.Lock() for _ in range(SLOTS)]
+        self._threads = []
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        """
+        The (host, port) the simulator is listening on
+        """
+        return (self.host, self.port)
+
+    def start(self):
+        """
+        Open the listening socket and start accepting connections
+        """
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.port))
+        self._server.listen(SLOTS)
+        self.port = self._server.getsockname()[1]
+        self._running = True
+        self._spawn(self._accept)
+
+    def stop(self):
+        """
+        Close all connections and stop the simulator
+        """
+        self._running = False
+        # Release any paused motions so their threads can finish
+        self._not_interrupted.set()
+        if self._server is not None:
+            self._close_socket(self._server)
+            self._server = None
+        for slot, conn in enumerate(self._slots):
+            if conn is not None:
+                self._close_socket(conn)
+                self._slots[slot] = None
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(1)
+        self._threads = []
+
+    def inject_failure(self, command, reason='Simulated failure', times=1):
+        """
+        Make the next replies to a command fail. The reply sent is
+        command:fail_'reason'
+
+        Parameters
+        ----------
+        command : String name of the command to fail
+        reason : String reason reported in the fail reply
+        times : integer number of times the command should fail (None to
+                fail every time)
+        """
+        self._failures[command] = [reason, times]
+
+    def clear_failures(self):
+        """
+        Remove all injected failures
+        """
+        self._failures = {}
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _close_socket(sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            try:
+                slot = self._slots.index(None)
+            except ValueError:
+                # Both sioASCII connections are in use
+                self._close_socket(conn)
+                continue
+            self._slots[slot] = conn
+            self.connections += 1
+            self._spawn(self._serve, slot, conn)
+
+    def _serve(self, slot, conn):
+        while self._running:
+            try:
+                data = conn.recv(BUFFER_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            message = data.strip(b'\x00').decode('utf-8', 'replace')
+            if not message.endswith(';'):
+                self._reply(slot, ":fail_'No message end'")
+                continue
+            with self._dispatch_lock:
+                self._dispatch(slot, message[:-1])
+
+        if self._slots[slot] is conn:
+            self._slots[slot] = None
+        conn.close()
+
+    def _reply(self, slot, message):
+        """
+        Send a reply in the same way as sendStatus.pgx: text plus ; padded
+        with nulls to fill the 64 character message array
+        """
+        msg_bytes = (message + ';').encode()[:REPLY_SIZE]
+        msg_bytes = msg_bytes.ljust(REPLY_SIZE, b'\x00')
+        conn = self._slots[slot]
+        if conn is None:
+            return
+        with self._send_locks[slot]:
+            try:
+                conn.sendall(msg_bytes)
+            except OSError:
+                pass
+
+    def _duration(self, command):
+        return self.durations.get(command, self.motion_time)
+
+    def _pop_failure(self, command):
+        """
+        Returns the fail reply for a command if a failure was injected
+        """
+        failure = self._failures.get(command)
+        if failure is None:
+            return None
+        reason, times = failure
+        if times is not None:
+            if times <= 1:
+                del self._failures[command]
+            else:
+                failure[1] = times - 1
+        return "{}:fail_'{}'".format(command, reason)
+
+    def _wait(self, duration):
+        """
+        Wait for a motion to complete. While the robot is interrupted, the
+        motion does not progress.
+        """
+        remaining = duration
+        while remaining > 0 and self._running:
+            self._not_interrupted.wait()
+            step = min(remaining, 0.01)
+            time.sleep(step)
+            remaining -= step
+
+    def _dispatch(self, slot, message):
+        self.received.append((slot, message + ';'))
+        command, _, parameters = message.partition(':')
+
+        failure = self._pop_failure(command)
+        if failure is not None:
+            self._reply(slot, failure)
+            return
+
+        if command == 'hello':
+            self._reply(slot, 'world')
+        elif command == 'test':
+            # The test routine only prints on the pendant; there is no reply
+            pass
+        elif command == 'setCoords':
+            self._reply(slot, self._set_coords(parameters))
+        elif command == 'getCoords':
+            self._reply(slot, 'getCoords:#X{}#Y{}'.format(*self.coords))
+        elif command == 'setSpeed':
+            self._reply(slot, self._set_speed(parameters))
+        elif command == 'getSpeed':
+            self._reply(slot, 'getSpeed:#{:g}'.format(self.speed))
+        elif command in ('powerOn', 'powerOff'):
+            self._spawn(self._power_switch, slot, command)
+        elif command == 'getPowerState':
+            self._reply(slot, 'getPowerState:#{}'
+                        .format('On' if self.powered else 'Off'))
+        elif command == 'interrupt':
+            self._not_interrupted.clear()
+            self._reply(slot, 'interrupt:done')
+        elif command == 'restart':
+            self._not_interrupted.set()
+            # The controller program includes the ; in this reply, so the
+            # client receives two
+            self._reply(slot, 'restart:done;')
+        elif command == 'getGripperState':
+            self._reply(slot, 'getGripperState:{}'
+                        .format('closed' if self.gripper_closed else 'open'))
+        elif command in MOVE_TARGETS:
+            self._spawn(self._move, slot, command)
+        elif command in ('samplePick', 'sampleRelease'):
+            self._spawn(self._sample_gripping, slot, command)
+        elif command in ('gripperOpen', 'gripperClose'):
+            self.gripper_closed = (command == 'gripperClose')
+            self._reply(slot, command + ':done')
+        else:
+            self._reply(slot, ":fail_'Unrecognised Command!'")
+
+    def _set_coords(self, parameters):
+        x_index = parameters.find('#X')
+        y_index = parameters.find('#Y')
+        try:
+            x_coord = int(parameters[x_index + 2:y_index])
+        except ValueError:
+            return "setCoords:fail_'Invalid X'"
+        try:
+            y_coord = int(parameters[y_index + 2:])
+        except ValueError:
+            return "setCoords:fail_'Invalid Y'"
+        self.coords = [x_coord, y_coord]
+        return 'setCoords:done'
+
+    def _set_speed(self, parameters):
+        try:
+            self.speed = float(parameters[parameters.find('#') + 1:])
+        except ValueError:
+            return "setSpeed:fail_'Data is not a number'"
+        return 'setSpeed:done'
+
+    def _power_switch(self, slot, command):
+        self._wait(self._duration(command))
+        self.powered = (command == 'powerOn')
+        self._reply(slot, command + ':done')
+
+    def _move(self, slot, command):
+        # moveManager resets taskIsDone, which restarts interrupted motion
+        self._not_interrupted.set()
+        self._wait(self._duration(command))
+        self.location = MOVE_TARGETS[command]
+        self._reply(slot, command + ':done')
+
+    def _sample_gripping(self, slot, command):
+        pick = (command == 'samplePick')
+        # To pick a sample, the gripper must be open to start with
+        if pick and self.gripper_closed:
+            self.gripper_closed = False
+        self._wait(self._duration(command))
+        self.gripper_closed = pick
+        self._reply(slot, command + ':done')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a simulated E.M.A. robot controller')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10005)
+    parser.add_argument('--motion-time', type=float, default=0.0,
+                        help='Time in seconds taken by each motion')
+    args = parser.parse_args()
+
+    with ControllerSimulator(args.host, args.port,
+                             motion_time=args.motion_time) as simulator:
+        print('Simulated controller listening on {}:{}'
+              .format(*simulator.address))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Speed profiles, which set the speed of the robot arm (setSpeed) for each
+move, so that moves through free space can be made quickly while moves
+which end close to the spinner or the magazine are made slowly.
+
+On the controller, setSpeed sets mFastMov.vel, the speed (as a percentage
+of the nominal speed) used by all of the move commands. The vertical
+approach and retreat when picking or releasing a sample (samplePick and
+sampleRelease) always use the fixed mNomSpeed, so profiles can't change
+their speed.
+
+A profile is used by giving it to a Robot:
+
+ema = Robot(speed_profile='standard')
+
+or with emaapi.use_speed_profile. The robot only sends setSpeed when the
+speed needed for the next move differs from the current speed.
+"""
+
+# Moves which end clear of the spinner and the magazine
+FREE_SPACE_MOVES = frozenset(['moveGate', 'moveOffside', 'moveHome',
+                              'moveZero', 'moveBin'])
+# Moves which end just above a sample position (on the magazine or spinner)
+PRECISE_MOVES = frozenset(['moveCoords', 'moveSpinner'])
+
+MAX_SPEED = 100
+
+
+def _check_speed(speed):
+    speed = float(speed)
+    if not 0 < speed <= MAX_SPEED:
+        raise ValueError('Speed must be greater than 0 and at most {}. Got: {}'
+                         .format(MAX_SPEED, speed))
+    return speed
+
+
+class SpeedProfile(object):
+    """
+    Speeds to use for the different kinds of move.
+
+    Parameters
+    ----------
+    name : String name of the profile
+    free_space : float speed (% of nominal) for moves through free space
+    precise : float speed (% of nominal) for moves to a sample position
+    """
+
+    def __init__(self, name, free_space, precise):
+        self.name = name
+        self.free_space = _check_speed(free_space)
+        self.precise = _check_speed(precise)
+
+    def __repr__(self):
+        return 'SpeedProfile({!r}, free_space={:g}, precise={:g})'.format(
+            self.name, self.free_space, self.precise)
+
+    def speed_for(self, command):
+        """
+        Returns the speed to use for a command, or None if the command is not
+        a move
+        """
+        if command in FREE_SPACE_MOVES:
+            return self.free_space
+        if command in PRECISE_MOVES:
+            return self.precise
+        return None
+
+
+# The speed set on the controller when it starts is 5
+PROFILES = {'commissioning': SpeedProfile('commissioning', 5, 5),
+            'standard': SpeedProfile('standard', 30, 10),
+            'fast': SpeedProfile('fast', 60, 20),
+            }
+
+
+def get_profile(profile):
+    """
+    Returns a speed profile given either the profile or the name of one of
+    the profiles in PROFILES (None means no profile)
+
+    Raises
+    ------
+    ValueError : if there is no profile with the name given
+    """
+    if (profile is None) or isinstance(profile, SpeedProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown speed profile "{}". Expecting one of: {}'
+                         .format(profile, ', '.join(sorted(PROFILES))))
@@ -0,0 +1,133 @@
+"""
+Client-side model of the state of the robot controller, so that commands
+whose effect is already known (e.g. setting the coordinates which are
+already set) need not be sent again and simple queries can be answered
+without a round-trip to the controller.
+
+The model is only updated from successful replies. Anything which is not
+known is None. After a fail reply, an error while sending or a lost
+connection, nothing about the controller is known for certain any more, so
+the whole model is cleared.
+"""
+import re
+
+from emacontrol.instrumentation import command_name
+
+# Where each move command leaves the arm
+MOVE_TARGETS = {'moveCoords': 'magazine',
+                'moveGate': 'gate',
+                'moveHome': 'home',
+                'moveSpinner': 'spinner',
+                'moveOffside': 'offside',
+                'moveZero': 'zero',
+                'moveBin': 'bin',
+                }
+
+_COORDS_RE = re.compile(r'#X(\d+)#Y(\d+)')
+
+# Commands which don't change the state of the controller
+QUERIES = frozenset(['hello', 'test', 'getCoords', 'getSpeed',
+                     'getPowerState', 'getGripperState'])
+
+
+class ControllerState(object):
+    """
+    Last known state of the robot controller.
+
+    Attributes
+    ----------
+    power : bool whether the arm is powered
+    coords : tuple of integers (X, Y) magazine coordinates last set
+    speed : float speed of the arm (mFastMov.vel)
+    gripper : String 'open' or 'closed'
+    location : String where the last move left the arm (see MOVE_TARGETS)
+    """
+
+    FIELDS = ('power', 'coords', 'speed', 'gripper', 'location')
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget everything known about the controller
+        """
+        self.power = None
+        self.coords = None
+        self.speed = None
+        self.gripper = None
+        self.location = None
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def update(self, message, reply, parsed):
+        """
+        Update the model from a message sent to the controller and the reply
+        received.
+
+        Parameters
+        ----------
+        message : String message sent to the controller
+        reply : String reply received
+        parsed : dict reply parsed by Robot.parse_message (or None if the
+                 reply couldn't be parsed)
+        """
+        command = command_name(message)
+        if parsed is None:
+            # e.g. the reply to hello is just world;
+            if command not in QUERIES:
+                self.invalidate()
+            return
+        if parsed['result'] == 'fail':
+            self.invalidate()
+            return
+        state = parsed['state']
+        done = parsed['result'] == 'done'
+
+        if command == 'getCoords' and ('X' in state) and ('Y' in state):
+            self.coords = (state['X'], state['Y'])
+        elif command == 'getSpeed' and (0 in state):
+            self.speed = state[0]
+        elif command == 'getPowerState' and state:
+            self.power = (state[0] == 'On')
+        elif command == 'getGripperState' and parsed['result']:
+            self.gripper = parsed['result']
+        elif command in QUERIES:
+            pass
+        elif not done:
+            # Not a reply we understand, so the effect of the message is
+            # unknown
+            self.invalidate()
+        elif command == 'setCoords':
+            self.coords = _coords(message)
+        elif command == 'setSpeed':
+            self.speed = _number_after_hash(message)
+        elif command in ('powerOn', 'powerOff'):
+            self.power = (command == 'powerOn')
+        elif command in MOVE_TARGETS:
+            self.location = MOVE_TARGETS[command]
+        elif command in ('samplePick', 'gripperClose'):
+            self.gripper = 'closed'
+        elif command in ('sampleRelease', 'gripperOpen'):
+            self.gripper = 'open'
+        elif command in ('interrupt', 'restart'):
+            # The arm stops (or restarts) part way through its move
+            self.location = None
+        else:
+            self.invalidate()
+
+
+def _number_after_hash(text):
+    value = text.strip(';').partition('#')[2]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _coords(message):
+    match = _COORDS_RE.search(message)
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
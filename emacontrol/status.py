@@ -0,0 +1,125 @@
+"""
+Live status of the robot, read while it is moving.
+
+The controller accepts two clients, so the status is read on the robot's
+control channel (see Robot.control_channel), the second connection next to
+the one sending the moves. Status queries are answered by the controller
+straight away, so they don't wait for a move to finish and don't delay the
+commands sent for an exchange.
+
+A StatusPoller asks for the status at regular intervals in the background
+and keeps the latest answer:
+
+poller = ema.start_status_polling(interval=0.5)
+
+@poller.on_status
+def show(status):
+    print(status['coords'], status['gripper'])
+
+print(poller.latest)
+poller.stop()
+"""
+import time
+
+from emacontrol.commands import COMMANDS
+
+
+def _gevent():
+    # gevent is only needed once polling is started
+    import gevent
+    return gevent
+
+
+# The status queries and the field of the controller state each one reads
+STATUS_QUERIES = (('getPowerState', 'power'),
+                  ('getCoords', 'coords'),
+                  ('getGripperState', 'gripper'),
+                  ('getSpeed', 'speed'),
+                  )
+
+
+class StatusPoller(object):
+    """
+    Reads the status of the robot at regular intervals in the background.
+
+    Parameters
+    ----------
+    robot : Robot to read the status of
+    interval : float time in seconds between reads
+
+    Attributes
+    ----------
+    latest : dict the latest status read, with the fields power, coords,
+             gripper and speed (as read from the controller), location
+             (where the client last moved the arm), time (when the status was
+             read) and error (the error which stopped the last read, or None)
+    """
+
+    def __init__(self, robot, interval=0.5):
+        self.robot = robot
+        self.interval = interval
+        self.latest = None
+        self._callbacks = []
+        self._greenlet = None
+
+    def on_status(self, callback):
+        """
+        Register a function to be called with each new status read. Can be
+        used as a decorator.
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def read(self):
+        """
+        Read the status of the robot now, publishing it as latest.
+
+        Returns
+        -------
+        dict : the status (see latest)
+        """
+        state = self.robot.state
+        status = {'time': time.time(), 'error': None}
+        try:
+            for name, field in STATUS_QUERIES:
+                self.robot.send_control(COMMANDS[name])
+                # Read straight away, before a move can change the state
+                status[field] = getattr(state, field)
+        except Exception as err:
+            status['error'] = err
+            # A fresh connection is made for the next read
+            self.robot.close_control_channel()
+        for _, field in STATUS_QUERIES:
+            status.setdefault(field, None)
+        status['location'] = state.location
+        self.latest = status
+        for callback in self._callbacks:
+            callback(status)
+        return status
+
+    def _poll(self):
+        gevent = _gevent()
+        while True:
+            started = time.monotonic()
+            self.read()
+            gevent.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def start(self):
+        """
+        Start reading the status in the background
+        """
+        if not self.running:
+            self._greenlet = _gevent().spawn(self._poll)
+        return self
+
+    def stop(self):
+        """
+        Stop reading the status
+        """
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    @property
+    def running(self):
+        return (self._greenlet is not None) and not self._greenlet.ready()
@@ -17,6 +17,7 @@ VERSION = '1.1.0'
 # What packages are required for this module to be executed?
 REQUIRED = [
     'gevent',
+    'numpy',
 ]
 
 # What packages are optional?
@@ -64,10 +65,12 @@ setup(
     # If your package is a single module, use this instead of 'packages':
     # py_modules=['emaapi'],
     # # We don't want emaapi to be run as a script - it should be imported!
-    # # So there is no entry in entry_points
-    # entry_points={
-    #     'console_scripts': ['emacontrol=emacontrol:main'],
-    # },
+    # # The daemon which owns the connection to the robot and unattended runs
+    # # of sample plans are run as scripts
+    entry_points={
+        'console_scripts': ['emacontrol=emacontrol.daemon:main',
+                            'emactl=emacontrol.emactl:main'],
+    },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
     include_package_data=True,
@@ -0,0 +1,98 @@
+import asyncio
+from mock import patch
+import pytest
+
+from emacontrol.aio import AsyncRobot
+from emacontrol.simulator import ControllerSimulator
+
+
+def run(coroutine):
+    loop = asyncio.get_event_loop_policy().new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_send():
+    async def exchange(address):
+        ema = AsyncRobot(robot_host=address[0], robot_port=address[1])
+        reply = await ema.send('getCoords;')
+        assert ema.is_connected() is False
+
+        # Restart replies contain two delimiters. This shouldn't upset the
+        # next message
+        async with ema:
+            await ema.send('restart;', parse=False)
+            assert (await ema.send('hello;', parse=False)) == 'world;'
+        return reply
+
+    with ControllerSimulator() as simulator:
+        reply = run(exchange(simulator.address))
+    assert reply['state'] == {'X': 0, 'Y': 0}
+
+
+def test_mount_unmount():
+    async def exchange(address):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        async with AsyncRobot(robot_host=address[0],
+                              robot_port=address[1]) as ema:
+            with pytest.raises(Exception, match=r'.*not started.*'):
+                await ema.mount_sample(75)
+            await ema.power_on()
+
+            # Other tasks keep running while the robot moves
+            tick_task = asyncio.ensure_future(ticker())
+            await ema.mount_sample(75)
+            await ema.unmount_sample()
+            tick_task.cancel()
+        assert ticks > 0
+        assert ema.sample_index == 75
+
+    with ControllerSimulator(motion_time=0.01) as simulator:
+        run(exchange(simulator.address))
+        assert simulator.coords == [7, 4]
+        assert [msg for _, msg in simulator.received] == [
+            'powerOn;', 'setCoords:#X7#Y4;', 'moveCoords;', 'samplePick;',
+            'moveGate;', 'moveSpinner;', 'sampleRelease;', 'moveOffside;',
+            'moveSpinner;', 'samplePick;', 'moveGate;', 'moveCoords;',
+            'sampleRelease;']
+
+
+def test_failures():
+    async def exchange(address):
+        async with AsyncRobot(robot_host=address[0],
+                              robot_port=address[1],
+                              socket_timeout=0.2) as ema:
+            with pytest.raises(RuntimeError, match=r'.*failed.*'):
+                await ema.send('moveGate;', wait_for='moveGate:done;')
+            # test never replies
+            with pytest.raises(RuntimeError, match=r'.*timeout.*'):
+                await ema.send('test;')
+            assert ema.is_connected() is False
+
+    with ControllerSimulator() as simulator:
+        simulator.inject_failure('moveGate')
+        run(exchange(simulator.address))
+
+
+def test_connect_timeout():
+    async def never_connects(*args):
+        await asyncio.sleep(10)
+
+    async def exchange():
+        ema = AsyncRobot(robot_host='localhost', robot_port=1,
+                         socket_timeout=0.05)
+        with pytest.raises(RuntimeError, match=r'.*not made before timeout.*'):
+            await ema.send('getCoords;')
+        assert ema.is_connected() is False
+
+    with patch('asyncio.open_connection', never_connects):
+        run(exchange())
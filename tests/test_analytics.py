@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from emacontrol.analytics import CycleReport, Timings, main, robust_z
+from emacontrol.commands import COMMANDS
+from emacontrol.ema import Robot
+from emacontrol.recorder import TrafficRecorder
+from emacontrol.simulator import ControllerSimulator
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    """
+    Records the same run as a traffic log and as an instrumentation export:
+    a mount and two exchanges, with a pause between each
+    """
+    log = str(tmp_path / 'session.log')
+    export = tmp_path / 'timings.json'
+    with ControllerSimulator(motion_time=0.01,
+                             durations={'moveCoords': 0.05}) as simulator, \
+            TrafficRecorder(log) as recorder:
+        with Robot(robot_host=simulator.host, robot_port=simulator.port,
+                   recorder=recorder) as ema:
+            ema.power_on()
+            ema.mount(12)
+            for n in (37, 5):
+                ema.send_control(COMMANDS['getCoords'])
+                ema.exchange(n)
+            export.write_text(ema.instrumentation.to_json(history=True))
+    return [log, str(export)]
+
+
+def test_timings(sessions):
+    timings = Timings(sessions)
+    assert timings.sessions == sessions
+    assert len(timings) == 2 * len(timings.time[timings.session == 0])
+    moves = timings.of_command('moveCoords')
+    # To sample 12 for the mount, then back to 12 and on to 37, etc.
+    assert list(timings.slot[moves & (timings.session == 0)]) == [
+        12, 12, 37, 37, 5]
+    assert timings.duration[moves].min() >= 0.05
+    assert not timings.of_command('interrupt').any()
+
+    cycles = timings.cycles(idle_gap=60)
+    # Nothing separates the cycles, so each session is one
+    assert list(cycles['session']) == [0, 1]
+    cycles = timings.cycles(idle_gap=0)
+    assert len(cycles['total']) > 2
+    assert (cycles['communication'] >= 0).all()
+
+
+def test_report(sessions, capsys):
+    report = CycleReport(Timings(sessions), idle_gap=60)
+    assert report.samples_per_hour > 0
+    shares = [part['share'] for part in report.breakdown.values()]
+    assert sum(shares) == pytest.approx(1.0)
+    assert report.breakdown['motion']['seconds'] >= 2 * 5 * 0.05
+    assert set(report.slots) == {5, 12, 37}
+    assert report.slots[37]['moveCoords']['count'] == 4
+    assert report.commands['samplePick']['category'] == 'gripping'
+    assert report.commands['getCoords']['count'] == 4
+    assert 'takes the largest share of exchange time' in report.advice()
+
+    assert main(sessions + ['--config', 'none.ini']) == 0
+    output = capsys.readouterr().out
+    assert '2 sessions' in output
+    assert 'moveCoords' in output
+    assert main(sessions + ['--json', '--config', 'none.ini']) == 0
+    output = json.loads(capsys.readouterr().out)
+    assert output['slots']['12']['moveCoords']['count'] == 4
+
+
+def test_drift_and_outliers(tmp_path):
+    # moveGate gets slower by one second an hour, and once took far longer
+    lines = []
+    for i in range(20):
+        start = i * 360.0
+        wait = 1.0 + i * 0.1 + (5.0 if i == 10 else 0.0)
+        lines.append('{:.6f} 1 > moveGate;'.format(start))
+        lines.append('{:.6f} 1 < moveGate:done;'.format(start + wait))
+    path = tmp_path / 'session.log'
+    path.write_text('\n'.join(lines) + '\n')
+
+    report = CycleReport(Timings([str(path)]))
+    stats = report.commands['moveGate']
+    assert stats['count'] == 20
+    assert stats['outliers'] == 1
+    assert report.outliers[0]['time'] == 3600.0
+    assert stats['drift'] == pytest.approx(1.0, abs=0.3)
+    # Each move is a cycle of its own and nothing but motion
+    assert len(report.cycles['total']) == 20
+    assert report.breakdown['motion']['share'] == pytest.approx(1.0)
+    assert report.slots == {}
+
+    assert list(robust_z([1.0] * 5)) == [0] * 5
+    assert list(robust_z([1.0, 9.0])) == [0, 0]
@@ -0,0 +1,54 @@
+import pytest
+
+from emacontrol.benchmark import (PARSE_MESSAGES, format_results,
+                                  legacy_parse_message, percentile,
+                                  run_benchmarks, run_parse_benchmark,
+                                  summarise)
+from emacontrol.ema import Robot
+
+
+def test_percentile():
+    values = [4, 1, 3, 2, 5]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 0) == 1
+    assert percentile(values, 100) == 5
+    assert percentile(values, 95) == pytest.approx(4.8)
+    with pytest.raises(ValueError):
+        percentile([], 50)
+
+    stats = summarise(values)
+    assert stats['n'] == 5
+    assert stats['mean'] == 3
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(iterations=3, cycles=2)
+
+    assert set(results) == {'raw socket', 'per-message', 'persistent'}
+    assert set(results['persistent']) == {'send', 'set_sample_coords',
+                                          'mount+unmount'}
+    assert results['persistent']['mount+unmount']['n'] == 2
+    assert 'overhead' in results['persistent']['send']
+    assert 'persistent' in format_results(results)
+
+    # Each cycle sends the 11 steps of a mount and unmount, and setCoords
+    # unless the coordinates of the sample are already set
+    for mode in ('per-message', 'persistent'):
+        assert 11 <= results[mode]['mount+unmount']['messages'] <= 12
+    # Per message, each message has a socket of its own. In a persistent
+    # session none are opened
+    cycle = results['per-message']['mount+unmount']
+    assert cycle['connections'] == cycle['messages']
+    assert results['persistent']['mount+unmount']['connections'] == 0
+
+
+def test_run_parse_benchmark():
+    # The current parser gives the same results as the original
+    for message in PARSE_MESSAGES + ('getSAM:#X1.432#Y2.643#Z0.53;',
+                                     'getGripperState:closed;'):
+        assert Robot.parse_message(message) == legacy_parse_message(message)
+
+    # Parsing is about three times faster; the margin allows for noisy runs
+    results = run_parse_benchmark(iterations=1000)
+    assert set(results) == {'legacy', 'current', 'speedup'}
+    assert results['speedup'] > 1.5
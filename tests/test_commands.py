@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from emacontrol.commands import (COMMANDS, Command, check_program, command,
+                                 command_for, coords_command,
+                                 read_switch_table, speed_command)
+
+COMM_PROGRAM = os.path.join(os.path.dirname(__file__), '..', 'val3',
+                            'comm.pgx')
+
+
+def test_command():
+    gate = command('moveGate')
+    assert (gate.name, gate.message, gate.wait_for) == (
+        'moveGate', 'moveGate;', 'moveGate:done;')
+    assert (gate.data, gate.reply_data) == (b'moveGate;', b'moveGate:done;')
+    assert COMMANDS['getCoords'].wait_for is None
+    with pytest.raises(ValueError, match=r'Unknown command.*'):
+        command('moveMoon')
+
+    coords = coords_command(29, 9)
+    assert coords.data == b'setCoords:#X29#Y9;'
+    assert coords_command(29, 9) is coords
+    assert speed_command(12.5).data == b'setSpeed:#12.5;'
+
+    assert command_for('moveGate;') is gate
+    assert command_for('setSpeed:#30;').wait_for == 'setSpeed:done;'
+    assert command_for('moveMoon;').wait_for is None
+
+    with pytest.raises(ValueError, match=r'.*longer than the 32 bytes.*'):
+        Command('setCoords:#X1000000000#Y1000000000;')
+    # Replies are sent from a larger buffer than messages are read into
+    Command('moveGate;', 'moveGate:done_but_with_a_long_story;')
+    with pytest.raises(ValueError, match=r'.*longer than the 64 bytes.*'):
+        Command('moveGate;', 'moveGate:done_but_with_a_much_much_longer_'
+                             'story_than_that_one_was;')
+
+
+def test_check_program(tmp_path):
+    table = read_switch_table(COMM_PROGRAM)
+    assert 'setSAM' not in table  # Commented out
+    assert table['interrupt'][-1] == 'interrupt:done'
+
+    # The registry matches the program and every reply fits in the buffer
+    # of sendStatus
+    assert check_program(COMM_PROGRAM) == []
+
+    # Changes to the program are found
+    with open(COMM_PROGRAM, encoding='utf-8-sig') as program:
+        code = program.read()
+    code = code.replace('case "moveBin"', 'case "moveBinAway"')
+    changed = tmp_path / 'comm.pgx'
+    code = code.replace("'No message end'", "'No message end was found in "
+                                            "the data received from the "
+                                            "client'")
+    changed.write_text(code.replace('"interrupt:done"', '"interrupt:done!"'))
+    assert check_program(str(changed)) == [
+        'Command "moveBinAway" is not in the registry',
+        'Command "moveBin" is not in the program',
+        'Command "interrupt" replies "interrupt:done!;", expected '
+        '"interrupt:done;"',
+        'Reply ":fail_\'No message end was found in the data received from '
+        'the client\'" in comm.pgx is longer than 64 bytes']
@@ -0,0 +1,132 @@
+import os
+import stat
+import threading
+import time
+
+import pytest
+
+from emacontrol.daemon import (ABORT, MOTION, QUERY, DaemonClient,
+                               DaemonError, Request, RequestQueue,
+                               RobotDaemon, main)
+from emacontrol.ema import Robot
+from emacontrol.simulator import ControllerSimulator
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    """
+    Runs a daemon for a simulated controller in a thread of its own (with
+    its own gevent hub), so the test can use blocking clients
+    """
+    path = str(tmp_path / 'ema.sock')
+    with ControllerSimulator(durations={'moveGate': 0.3}) as simulator:
+        started = threading.Event()
+
+        def serve():
+            robot = Robot(robot_host=simulator.host,
+                          robot_port=simulator.port)
+            server = RobotDaemon(robot, path, status_interval=0.05).start()
+            started.set()
+            server.serve_forever()
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        assert started.wait(5)
+        yield path, simulator
+        if os.path.exists(path):
+            DaemonClient(path).shutdown()
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def test_request_queue():
+    queue = RequestQueue()
+    requests = [Request(i, method, {}, None) for i, method in enumerate(
+        ['mount', 'status', 'unmount', 'abort', 'ping'])]
+    for request in requests:
+        queue.put(request)
+    assert [request.priority for request in requests] == [
+        MOTION, QUERY, MOTION, ABORT, QUERY]
+
+    assert queue.get().method == 'abort'
+    assert queue.get(QUERY).method == 'status'
+    assert [request.id for request in queue.remove(MOTION)] == [0, 2]
+    assert len(queue) == 1
+    assert queue.get().method == 'ping'
+
+
+def test_daemon(daemon):
+    path, simulator = daemon
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with DaemonClient(path, timeout=10) as client:
+        assert client.ping() == 'pong'
+        with pytest.raises(DaemonError, match='Robot not started'):
+            client.mount(12)
+        client.power_on()
+        with pytest.raises(ValueError, match='0'):
+            client.exchange(0)
+
+        result = client.exchange(12)
+        assert result['name'] == 'mount'
+        assert [step['message'] for step in result['steps']][0] == \
+            'setCoords:#X1#Y1;'
+        assert client.exchange(12) is None
+
+        status = client.status()
+        assert status['sample_index'] == 12
+        assert status['sample_mounted'] is True
+        assert status['state']['power'] is True
+        assert status['operation'] is None
+        assert status['status']['error'] is None
+
+    # All the clients share one connection to the controller for the moves
+    motion = {slot for slot, msg in simulator.received
+              if msg.startswith('move')}
+    assert len(motion) == 1
+
+
+def test_daemon_abort(daemon):
+    path, simulator = daemon
+    DaemonClient(path).power_on()
+    errors = []
+
+    def exchange(n):
+        try:
+            DaemonClient(path).exchange(n)
+        except DaemonError as err:
+            errors.append(err.type)
+
+    moves = [threading.Thread(target=exchange, args=(n,)) for n in (12, 13)]
+    for thread in moves:
+        thread.start()
+        time.sleep(0.05)
+
+    with DaemonClient(path, timeout=1) as client:
+        # Status is answered while the robot moves
+        while simulator.location != 'magazine':
+            time.sleep(0.01)
+        status = client.status()
+        assert status['operation']['name'] == 'mount'
+        assert status['queued'] == 1
+
+        assert client.abort() == {'cancelled': True, 'dropped': 1}
+        for thread in moves:
+            thread.join(5)
+        assert sorted(errors) == ['OperationCancelled'] * 2
+        assert client.status()['operation'] is None
+        assert 'interrupt;' in [msg for _, msg in simulator.received]
+
+
+def test_main(daemon, capsys):
+    path, _ = daemon
+    # Only one daemon can listen on a socket
+    with pytest.raises(RuntimeError, match='already listening'):
+        RobotDaemon(Robot(), path).start()
+
+    assert main(['--socket', path, 'status']) == 0
+    assert '"sample_mounted": false' in capsys.readouterr().out
+    main(['--socket', path, 'shutdown'])
+    deadline = time.monotonic() + 5
+    while os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not os.path.exists(path)
@@ -1,11 +1,17 @@
 
+import io
 import os
 import pytest
+import socket
 import sys
 
+from contextlib import redirect_stdout
 from mock import patch
 
+from emacontrol.commands import coords_command
 from emacontrol.ema import Robot
+from emacontrol.emaapi import exchange_sample, mount_sample
+from emacontrol.simulator import ControllerSimulator
 
 pathlib_path = False  # As this doesn't work with python < 3.6
 if sys.version_info[0] >= 3:
@@ -56,11 +62,14 @@ def test_send(send_mock):
 
 
 def test_set_sample_coords():
-    with patch('emacontrol.emaapi.Robot.send') as send_mock:
+    with patch('emacontrol.emaapi.Robot.send_command') as send_mock:
         ema = Robot()
         ema.set_sample_coords(75)
-        send_mock.assert_called_with('setCoords:#X7#Y4;',
-                                     wait_for='setCoords:done;')
+        command = send_mock.call_args[0][0]
+        assert command.message == 'setCoords:#X7#Y4;'
+        assert command.wait_for == 'setCoords:done;'
+        # The command is made once for each position
+        assert command is coords_command(7, 4)
 
 
 # Method supports set_sample_coords
@@ -79,6 +88,18 @@ def test_sample_to_coords():
 
     with pytest.raises(ValueError, match=r".*greater than 0"):
         Robot.samplenr_to_xy(0)
+    with pytest.raises(ValueError, match=r".*outside the magazine.*"):
+        Robot.samplenr_to_xy(301)
+
+
+def test_magazine(tmp_path):
+    config_file = tmp_path / 'robot.ini'
+    config_file.write_text('[magazine]\ncolumns = 8\n')
+    ema = Robot(config_file=str(config_file))
+    assert ema.magazine.columns == 8
+    with patch.object(Robot, 'send_command') as send_mock:
+        ema.set_sample_coords(75)
+        send_mock.assert_called_with(coords_command(9, 2))
 
 
 # Method supports send
@@ -108,3 +129,181 @@ def test_message_parser():
     assert output == {'command': 'getSAM',
                       'result': '',
                       'state': {'X': 1.432, 'Y': 2.643, 'Z': 0.53}}
+
+    output = Robot.parse_message('getGripperState:closed;')
+    assert output == {'command': 'getGripperState',
+                      'result': 'closed',
+                      'state': {}}
+
+    # Replies are cached, but changing one output doesn't change the next
+    output['state']['X'] = 7
+    assert Robot.parse_message('getGripperState:closed;')['state'] == {}
+
+    output = Robot.parse_message('getSpeed:#5;')
+    assert output == {'command': 'getSpeed',
+                      'result': '',
+                      'state': {0: 5}}
+    assert Robot.parse_message('getSpeed:#12.5;')['state'] == {0: 12.5}
+
+    with pytest.raises(ValueError, match=r'Cannot parse.*'):
+        Robot.parse_message('squirrel;')
+
+
+@patch('socket.socket')
+def test_persistent_session(sock_mock):
+    sock_mock().fileno.return_value = 11
+    sock_mock().connect_ex.return_value = 0
+    with Robot(robot_host='127.0.0.3', robot_port=10006) as ema:
+        assert ema.persistent is True
+        assert ema.is_connected() is True
+    assert ema.persistent is False
+    assert ema.is_connected() is False
+    assert Robot(persistent=True).persistent is True
+
+
+def test_prepare_sample():
+    with ControllerSimulator(motion_time=0.01) as simulator:
+        with Robot(robot_host=simulator.host,
+                   robot_port=simulator.port) as ema:
+            ema.started = True
+            with pytest.raises(ValueError):
+                ema.prepare_sample(0)
+
+            # Nothing mounted: coordinates can be sent straight away...
+            preparation = ema.prepare_sample(75)
+            preparation.join()
+            assert simulator.coords == [7, 4]
+            # ...and aren't sent again when mounting
+            with redirect_stdout(io.StringIO()):
+                mount_sample(75, robot=ema)
+            sent = [msg for _, msg in simulator.received]
+            assert sent.count('setCoords:#X7#Y4;') == 1
+
+            # Mounted: current coordinates are needed for the unmount
+            ema.prepare_sample(12).join()
+            assert simulator.coords == [7, 4]
+            with redirect_stdout(io.StringIO()):
+                exchange_sample(12, robot=ema)
+            sent = [msg for _, msg in simulator.received]
+            assert sent[-7:-6] == ['setCoords:#X1#Y1;']
+            assert ema.sample_index == 12
+
+            # Errors in preparation are raised when mounting
+            simulator.inject_failure('setCoords')
+            ema.sample_mounted = False
+            ema.prepare_sample(13)
+            with pytest.raises(RuntimeError, match=r'.*failed.*'):
+                ema.set_sample_coords(13)
+
+
+def test_prepare_sample_while_mounted():
+    with ControllerSimulator(motion_time=0.01) as simulator:
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port,
+                    speed_profile='standard')
+        ema.started = True
+        ema.mount(37)
+        assert ema.is_connected() is False
+
+        # The mounted sample's coordinates are kept, but the socket is
+        # opened and the speed of the first move set
+        del simulator.received[:]
+        ema.prepare_sample(12).join()
+        assert [msg for _, msg in simulator.received] == ['setSpeed:#10;']
+        assert ema.is_connected() is True
+        assert simulator.coords == [3, 6]
+
+        # The exchange uses the socket opened, which is closed afterwards
+        with patch('emacontrol.network.socket.socket',
+                   wraps=socket.socket) as socket_mock:
+            exchange_sample(12, robot=ema)
+        assert socket_mock.call_count == 0
+        sent = [msg for _, msg in simulator.received]
+        assert sent[1] == 'moveSpinner;'
+        assert ema.is_connected() is False
+        assert ema.persistent is False
+        assert ema.sample_index == 12
+
+        # The unmount waits for the preparation too, and raises its errors
+        simulator.inject_failure('setSpeed')
+        preparation = ema.prepare_sample(37)
+        del simulator.received[:]
+        with pytest.raises(RuntimeError, match=r'.*failed.*'):
+            ema.unmount()
+        assert preparation.ready()
+        assert [msg for _, msg in simulator.received] == ['setSpeed:#10;']
+        ema.unmount()
+        assert simulator.received[-1][1] == 'sampleRelease;'
+
+
+def test_shadow_state():
+    with ControllerSimulator() as simulator:
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port)
+        ema.power_on()
+        ema.set_sample_coords(12)
+        ema.send('samplePick;', wait_for='samplePick:done;')
+        ema.send('moveGate;', wait_for='moveGate:done;')
+        assert ema.state.as_dict() == {'power': True, 'coords': (1, 1),
+                                       'speed': None, 'gripper': 'closed',
+                                       'location': 'gate'}
+
+        # Known state is not sent again or asked for
+        del simulator.received[:]
+        ema.power_on()
+        ema.set_sample_coords(12)
+        assert ema.get_coords() == (1, 1)
+        assert ema.is_powered() is True
+        assert ema.get_gripper_state() == 'closed'
+        assert simulator.received == []
+        assert ema.get_speed() == 5
+        assert simulator.received == [(0, 'getSpeed;')]
+
+        # A fail means the state is no longer known
+        simulator.inject_failure('moveSpinner')
+        with pytest.raises(RuntimeError):
+            ema.send('moveSpinner;', wait_for='moveSpinner:done;')
+        assert set(ema.state.as_dict().values()) == {None}
+        del simulator.received[:]
+        ema.set_sample_coords(12)
+        assert simulator.received == [(0, 'setCoords:#X1#Y1;')]
+
+        # In strict mode, everything goes to the controller
+        ema.strict = True
+        ema.set_sample_coords(12)
+        assert ema.get_coords() == (1, 1)
+        assert [msg for _, msg in simulator.received[1:]] == [
+            'setCoords:#X1#Y1;', 'getCoords;']
+
+        # So does a lost connection
+        ema.strict = False
+        ema._drop_connection()
+        assert ema.state.coords is None
+
+
+def test_speed_profile():
+    with ControllerSimulator() as simulator:
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port,
+                    speed_profile='standard')
+        ema.started = True
+        ema.sample_mounted = True
+        ema.sample_index = 3
+        with redirect_stdout(io.StringIO()):
+            exchange_sample(4, robot=ema)
+        sent = [msg for _, msg in simulator.received]
+        # Speed is only set when it changes
+        assert sent == ['setSpeed:#10;', 'moveSpinner;', 'samplePick;',
+                        'setSpeed:#30;', 'moveGate;',
+                        'setSpeed:#10;', 'moveCoords;', 'sampleRelease;',
+                        'setCoords:#X0#Y3;', 'moveCoords;', 'samplePick;',
+                        'setSpeed:#30;', 'moveGate;',
+                        'setSpeed:#10;', 'moveSpinner;', 'sampleRelease;',
+                        'setSpeed:#30;', 'moveOffside;']
+        assert simulator.speed == 30
+        assert ema.get_speed() == 30
+
+        ema.speed_profile = None
+        del simulator.received[:]
+        ema.set_speed(30)
+        ema.set_speed(12.5)
+        assert simulator.received == [(0, 'setSpeed:#12.5;')]
+        with pytest.raises(ValueError, match=r'Speed must be.*'):
+            ema.set_speed(0)
@@ -1,57 +1,113 @@
+import io
 import pytest
-from mock import call, patch
+import subprocess
+import sys
+from contextlib import redirect_stdout
+from mock import ANY, call, patch
 
+import emacontrol.emaapi
+from emacontrol.commands import COMMANDS
+from emacontrol.ema import Robot
+from emacontrol.sequence import SequenceError
 from emacontrol.emaapi import (robot_begin, robot_end, mount_sample,
-                               unmount_sample, ema)
+                               unmount_sample, exchange_sample, plan_run,
+                               set_robot, use_speed_profile, ema)
+
+# Importing emaapi (measured in a fresh interpreter) should take no longer than
+# this many seconds. It currently takes ~0.02 s.
+IMPORT_BUDGET = 0.25
+
+
+def test_import_startup():
+    script = ('import sys, time\n'
+              't = time.perf_counter()\n'
+              'import emacontrol.emaapi\n'
+              'print(time.perf_counter() - t)\n'
+              'print("gevent" in sys.modules)\n'
+              'print(emacontrol.emaapi.ema._robot is not None)\n')
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     universal_newlines=True).split()
+    assert float(output[0]) < IMPORT_BUDGET
+    # No gevent and no robot until they are needed
+    assert output[1:] == ['False', 'False']
 
 
 # These tests are for the  basic start-up/shutdown methods
-@patch('emacontrol.emaapi.ema.send')
+@patch('emacontrol.emaapi.ema.__send__')
 def test_robot_begin(send_mock):
     assert ema.started is False
+    ema.state.invalidate()
     # This is what we would get if we do a getCoords with the sample set to 43
-    getCoords_reply = {'command': 'getCoords',
-                       'result': '',
-                       'state': {'X': 4, 'Y': 2}}
-    send_mock.return_value = getCoords_reply
+    send_mock.side_effect = ['getCoords:#X4#Y2;', 'powerOn:done;']
 
-    with patch('builtins.input'):
+    with patch('builtins.input'), redirect_stdout(io.StringIO()) as output:
         robot_begin()
-    send_calls = [call('getCoords;'),
-                  call('powerOn;',
-                       wait_for='powerOn:done;')]
-    send_mock.assert_has_calls(send_calls)
-
+    assert send_mock.call_args_list == [call('getCoords;', ANY, b'getCoords;'),
+                                        call('powerOn;', ANY, b'powerOn;')]
+    assert 'Current sample is 43 (not 1!)' in output.getvalue()
     assert ema.started is True
+    assert ema.sample_index == 43
+    assert ema.state.power is True
 
+    # The controller may have been reset since, so the power is switched on
+    # again even though it is known to be on
+    send_mock.reset_mock()
+    send_mock.side_effect = ['getCoords:#X0#Y0;', 'powerOn:done;']
+    with patch('builtins.input') as input_mock, \
+            redirect_stdout(io.StringIO()):
+        robot_begin(interactive=False)
+    assert send_mock.call_args_list == [call('getCoords;', ANY, b'getCoords;'),
+                                        call('powerOn;', ANY, b'powerOn;')]
+    input_mock.assert_not_called()
+    ema.sample_index = 1
 
-@patch('emacontrol.emaapi.ema.send')
-def test_robot_end(ema_mock):
+
+@patch('emacontrol.emaapi.ema.__send__')
+def test_robot_end(send_mock):
     ema.started = True
+    ema.state.invalidate()
+    send_mock.return_value = 'powerOff:done;'
     robot_end()
-    assert ema_mock.mock_calls == [call('powerOff;',
-                                        wait_for='powerOff:done;')]
+    assert send_mock.call_args_list == [call('powerOff;', ANY, b'powerOff;')]
     assert ema.started is False
+    assert ema.state.power is False
+
+
+def done_reply(message, timing=None, data=None):
+    """
+    Side effect for a mocked __send__: the controller completes every command
+    """
+    assert data == message.encode()
+    return '{}:done;'.format(message.split(':')[0].rstrip(';'))
+
+
+def sent(send_mock):
+    return [args[0] for args, _ in send_mock.call_args_list]
+
+
+MOUNT_MESSAGES = ['moveCoords;', 'samplePick;', 'moveGate;', 'moveSpinner;',
+                  'sampleRelease;', 'moveOffside;']
+UNMOUNT_MESSAGES = ['moveSpinner;', 'samplePick;', 'moveGate;', 'moveCoords;',
+                    'sampleRelease;']
 
 
 # The following tests are for functions which wait for a message to return from
 # the robot before continuing
-@patch('emacontrol.emaapi.ema.send')
-@patch('emacontrol.emaapi.ema.set_sample_coords')
-def test_mount_sample(coords_mock, send_mock):
+@patch('emacontrol.emaapi.ema.__send__', side_effect=done_reply)
+def test_mount_sample(send_mock):
     # Mount a sample. This should set the coordinates and then do the mount
     ema.started = True
-    mount_sample(75,)
-
-    coords_mock.assert_called_with(75, verbose=False)
-    send_calls = [call('moveCoords;', wait_for='moveCoords:done;'),
-                  call('samplePick;', wait_for='samplePick:done;'),
-                  call('moveGate;', wait_for='moveGate:done;'),
-                  call('moveSpinner;', wait_for='moveSpinner:done;'),
-                  call('sampleRelease;', wait_for='sampleRelease:done;'),
-                  call('moveOffside;', wait_for='moveOffside:done;')
-                  ]
-    send_mock.assert_has_calls(send_calls)
+    ema.state.invalidate()
+    with redirect_stdout(io.StringIO()) as output:
+        result = mount_sample(75, verbose=True)
+    assert sent(send_mock) == ['setCoords:#X7#Y4;'] + MOUNT_MESSAGES
+    assert 'Sample coords: (7, 4)' in output.getvalue()
+    assert 'mount (7 steps' in output.getvalue()
+    assert [step.reply for step in result.steps][-1] == 'moveOffside:done;'
+    assert ema.sample_index == 75
+    assert ema.sample_mounted is True
+    # Session is closed again afterwards
+    assert ema.persistent is False
 
     # And if we don't run robot begin:
     ema.started = False
@@ -59,21 +115,118 @@ def test_mount_sample(coords_mock, send_mock):
         mount_sample(75)
 
 
-@patch('emacontrol.emaapi.ema.send')
+@patch('emacontrol.emaapi.ema.__send__', side_effect=done_reply)
 def test_unmount_sample(send_mock):
     # Unmount the sample. Just takes the current sample back to its old
     # position in the magazine
     ema.started = True
+    ema.sample_mounted = True
     unmount_sample()
-    send_calls = [call('moveSpinner;', wait_for='moveSpinner:done;'),
-                  call('samplePick;', wait_for='samplePick:done;'),
-                  call('moveGate;', wait_for='moveGate:done;'),
-                  call('moveCoords;', wait_for='moveCoords:done;'),
-                  call('sampleRelease;', wait_for='sampleRelease:done;')
-                  ]
-    send_mock.assert_has_calls(send_calls)
+    assert sent(send_mock) == UNMOUNT_MESSAGES
+    assert ema.sample_mounted is False
+
+    # A failure stops the sequence, reporting the step which failed
+    send_mock.side_effect = ['moveSpinner:done;', 'samplePick:done;',
+                             "moveGate:fail_'Stopped';"]
+    send_mock.reset_mock()
+    ema.sample_mounted = True
+    with pytest.raises(SequenceError) as err:
+        unmount_sample()
+    assert str(err.value).startswith(
+        'Sequence "unmount" failed at step 3 (moveGate;): Robot failed')
+    assert err.value.index == 2
+    assert [step.reply for step in err.value.result.steps] == [
+        'moveSpinner:done;', 'samplePick:done;', None]
+    assert len(sent(send_mock)) == 3
+    assert ema.sample_mounted is True
 
     # And if we don't run robot begin:
     ema.started = False
     with pytest.raises(Exception, match=r".*Did you run the robot_begin.*"):
         unmount_sample()
+
+
+def test_robot_selection():
+    other = Robot(robot_host='127.0.0.3', robot_port=10006)
+    other.started = True
+    with patch.object(other, '__send__',
+                      side_effect=done_reply) as other_send, \
+            patch('emacontrol.emaapi.ema.__send__') as ema_send:
+        unmount_sample(robot=other)
+        assert other_send.call_count == 5
+        ema_send.assert_not_called()
+
+    # Make a different robot the default one
+    set_robot(other)
+    try:
+        assert emacontrol.emaapi.ema is other
+        with patch.object(other, 'send_command') as other_send:
+            robot_end()
+            other_send.assert_called_with(COMMANDS['powerOff'])
+        assert other.started is False
+    finally:
+        set_robot(ema)
+
+
+@patch('emacontrol.emaapi.ema.__send__', side_effect=done_reply)
+def test_exchange_sample(send_mock):
+    ema.started = True
+    ema.sample_mounted = True
+    ema.sample_index = 12
+    ema.state.invalidate()
+
+    exchange_sample(75)
+    assert sent(send_mock) == (UNMOUNT_MESSAGES + ['setCoords:#X7#Y4;']
+                               + MOUNT_MESSAGES)
+    assert ema.sample_mounted is True
+    assert ema.sample_index == 75
+    # Session is closed again afterwards
+    assert ema.persistent is False
+
+    # A bad index is found before the robot moves
+    send_mock.reset_mock()
+    with pytest.raises(ValueError):
+        exchange_sample(0)
+    # Already mounted
+    exchange_sample(75)
+    assert send_mock.call_count == 0
+
+    # Nothing mounted: just mount
+    ema.sample_mounted = False
+    exchange_sample(12)
+    assert sent(send_mock) == ['setCoords:#X1#Y1;'] + MOUNT_MESSAGES
+    assert ema.sample_mounted is True
+
+    # Failing after the old sample was returned leaves nothing mounted
+    send_mock.side_effect = (['{}:done;'.format(m[:-1])
+                              for m in UNMOUNT_MESSAGES]
+                             + ["setCoords:fail_'Invalid X';"])
+    with pytest.raises(SequenceError, match=r'.*step 6 \(setCoords.*'):
+        exchange_sample(75)
+    assert ema.sample_mounted is False
+    assert ema.sample_index == 12
+
+    ema.started = False
+    with pytest.raises(Exception, match=r".*Did you run the robot_begin.*"):
+        exchange_sample(75)
+
+
+def test_plan_run():
+    samples = [291, 1, 151, 31]
+    ema.sample_mounted = False
+    assert plan_run(samples).order in ([1, 31, 151, 291], [291, 151, 31, 1])
+
+    # The run starts from the slot of the mounted sample
+    ema.sample_mounted = True
+    ema.sample_index = 2
+    assert plan_run(samples).order == [1, 31, 151, 291]
+    ema.sample_mounted = False
+
+
+def test_use_speed_profile():
+    use_speed_profile('fast')
+    assert ema.speed_profile.name == 'fast'
+    use_speed_profile(None)
+    assert ema.speed_profile is None
+    with pytest.raises(ValueError):
+        use_speed_profile('ludicrous')
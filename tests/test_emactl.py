@@ -0,0 +1,128 @@
+import socket
+
+import pytest
+from mock import call, patch
+
+from emacontrol.emactl import Plan, Progress, main, parse_samples
+from emacontrol.simulator import ControllerSimulator
+
+PLAN = """
+[plan]
+samples = 12, 3-4
+speed_profile = fast
+hook = echo {sample} {x} {y} >> {hooks}
+
+[sample 3]
+dwell = 0.1
+hook =
+"""
+
+
+@pytest.fixture
+def plan_file(tmp_path):
+    path = tmp_path / 'plan.ini'
+    path.write_text(PLAN.replace('{hooks}', str(tmp_path / 'hooks.txt')))
+    return str(path)
+
+
+def test_parse_samples():
+    assert parse_samples('1-3, 8,\n10-11') == [1, 2, 3, 8, 10, 11]
+    with pytest.raises(ValueError, match='backwards'):
+        parse_samples('5-3')
+    with pytest.raises(ValueError):
+        parse_samples('1, a')
+
+
+def test_plan(plan_file, tmp_path):
+    plan = Plan.from_file(plan_file)
+    assert plan.samples == [12, 3, 4]
+    assert plan.speed_profile.name == 'fast'
+    assert plan.dwell_for(3) == 0.1
+    assert plan.dwell_for(4) == 0.0
+    assert plan.hook_for(3) is None
+    assert plan.hook_for(4).startswith('echo {sample}')
+    assert plan.unmount is True
+
+    (tmp_path / 'empty.ini').write_text('[plan]\n')
+    with pytest.raises(ValueError, match='no samples'):
+        Plan.from_file(str(tmp_path / 'empty.ini'))
+
+
+def test_progress(tmp_path):
+    progress = Progress(str(tmp_path / 'progress'))
+    assert progress.read() == (set(), None)
+    for event, n in [('mounted', 12), ('done', 12), ('mounted', 3)]:
+        progress.record(event, n)
+    assert progress.read() == ({12}, 3)
+    progress.record('unmounted', 3)
+    assert progress.read() == ({12}, None)
+    progress.clear()
+    assert progress.read() == (set(), None)
+
+
+def test_dry_run(plan_file, capsys):
+    # Nothing is sent, so no controller is needed
+    assert main([plan_file, '--dry-run', '--host', '127.0.0.1',
+                 '--port', '1']) == 0
+    output = capsys.readouterr().out
+    assert '3 samples, speed profile: fast' in output
+    assert 'Sample   12 at (1, 1): dwell 0 s' in output
+    assert 'Sample    3 at (0, 2): dwell 0.1 s, hook: None' in output
+
+
+def test_run(plan_file, tmp_path, capsys):
+    with ControllerSimulator() as simulator:
+        options = ['--host', simulator.host, '--port', str(simulator.port),
+                   '--non-interactive']
+        with patch('emacontrol.network.socket.socket',
+                   wraps=socket.socket) as socket_mock:
+            assert main([plan_file] + options) == 0
+        # One connection for the whole run (the others are made by the
+        # simulator accepting it)
+        assert [c for c in socket_mock.call_args_list
+                if 'fileno' not in c[1]] == [call(socket.AF_INET,
+                                                  socket.SOCK_STREAM)]
+        output = capsys.readouterr().out
+        assert 'Ran 3 samples in' in output
+        assert 'samples per hour' in output
+        assert 'Sample    3: exchange' in output
+        assert (tmp_path / 'hooks.txt').read_text().split('\n') == [
+            '12 1 1', '4 0 3', '']
+        assert simulator.location == 'magazine'
+        assert simulator.powered is False
+        assert Progress(plan_file + '.progress').read() == ({12, 3, 4}, None)
+
+        # Resume after the run stopped with sample 3 on the spinner
+        progress = Progress(plan_file + '.progress')
+        progress.clear()
+        for event, n in [('mounted', 12), ('done', 12), ('mounted', 3)]:
+            progress.record(event, n)
+        simulator.received.clear()
+        assert main([plan_file, '--resume'] + options) == 0
+        output = capsys.readouterr().out
+        assert 'Sample 3 is already mounted' in output
+        assert 'Ran 2 samples in' in output
+        assert 'Sample   12' not in output
+
+        # Failures stop the run
+        simulator.inject_failure('moveGate')
+        assert main([plan_file] + options) == 1
+        assert 'continue the run with --resume' in \
+            capsys.readouterr().err.lower()
+
+
+def test_resume_optimised(tmp_path, capsys):
+    path = tmp_path / 'plan.ini'
+    path.write_text('[plan]\nsamples = 1, 2, 39, 40\noptimise = yes\n')
+    plan_file = str(path)
+    progress = Progress(plan_file + '.progress')
+    progress.record('mounted', 40)
+    with ControllerSimulator() as simulator:
+        assert main([plan_file, '--resume', '--non-interactive', '--host',
+                     simulator.host, '--port', str(simulator.port)]) == 0
+        coords = [msg for _, msg in simulator.received
+                  if msg.startswith('setCoords')]
+    # The tour starts from sample 40 on the spinner
+    assert 'Sample 40 is already mounted' in capsys.readouterr().out
+    assert coords == ['setCoords:#X3#Y8;', 'setCoords:#X0#Y1;',
+                      'setCoords:#X0#Y0;']
@@ -0,0 +1,82 @@
+import json
+import pytest
+
+from emacontrol.ema import Robot
+from emacontrol.instrumentation import (CommandTiming, Instrumentation,
+                                        command_name)
+from emacontrol.simulator import ControllerSimulator
+
+
+def test_command_name():
+    assert command_name('moveGate;') == 'moveGate'
+    assert command_name('setCoords:#X7#Y4;') == 'setCoords'
+
+
+def test_record_and_export():
+    instrumentation = Instrumentation(history=2)
+    sent = []
+    replied = []
+    instrumentation.on_send(sent.append)
+    instrumentation.on_reply(replied.append)
+
+    for wait, failed in ((1.0, False), (2.0, True), (3.0, False)):
+        timing = instrumentation.begin('moveGate;')
+        timing.connect = 0.5
+        timing.wait = wait
+        timing.failed = failed
+        instrumentation.record(timing)
+    assert len(sent) == len(replied) == 3
+    assert replied[0].total == 1.5
+    # Only the most recent timings are kept...
+    assert len(instrumentation.history) == 2
+    # ...but the statistics include all of them
+    stats = instrumentation.to_dict()['moveGate']
+    assert stats['count'] == 3
+    assert stats['failures'] == 1
+    assert stats['connect'] == 1.5
+    assert stats['wait'] == 6.0
+    assert stats['max'] == 3.5
+    assert stats['mean'] == 2.5
+
+    output = json.loads(instrumentation.to_json(history=True))
+    assert output['commands']['moveGate']['count'] == 3
+    assert output['history'][-1]['wait'] == 3.0
+
+    prometheus = instrumentation.to_prometheus()
+    assert '# TYPE emacontrol_commands_total counter' in prometheus
+    assert 'emacontrol_commands_total{command="moveGate"} 3' in prometheus
+    assert ('emacontrol_command_seconds_total{command="moveGate",'
+            'phase="wait"} 6.0') in prometheus
+
+    # Label values are escaped
+    instrumentation.record(CommandTiming('say "hi"\\there\nnow;'))
+    prometheus = instrumentation.to_prometheus()
+    assert ('emacontrol_commands_total{command="say \\"hi\\"\\\\there\\nnow"} '
+            '1') in prometheus
+    assert all(line.startswith(('#', 'emacontrol_'))
+               for line in prometheus.splitlines())
+
+    instrumentation.reset()
+    assert instrumentation.to_dict() == {}
+
+
+def test_robot_send_timings():
+    with ControllerSimulator(durations={'moveGate': 0.05}) as simulator:
+        simulator.inject_failure('moveGate')
+        with Robot(robot_host=simulator.host,
+                   robot_port=simulator.port) as ema:
+            ema.send('getCoords;')
+            with pytest.raises(RuntimeError):
+                ema.send('moveGate;', wait_for='moveGate:done;')
+            ema.send('moveGate;', wait_for='moveGate:done;')
+
+    stats = ema.instrumentation.stats
+    assert stats['getCoords']['count'] == 1
+    assert stats['moveGate']['count'] == 2
+    assert stats['moveGate']['failures'] == 1
+
+    timing = ema.instrumentation.history[-1]
+    assert isinstance(timing, CommandTiming)
+    assert timing.reply == 'moveGate:done;'
+    assert timing.wait >= 0.05
+    assert timing.parse > 0
@@ -0,0 +1,143 @@
+import io
+from contextlib import redirect_stdout
+
+import pytest
+from mock import patch
+
+from emacontrol.ema import Robot
+from emacontrol.emaapi import robot_begin
+from emacontrol.journal import Journal, replay
+from emacontrol.magazine import Magazine
+from emacontrol.sequence import SequenceError
+from emacontrol.simulator import ControllerSimulator
+
+
+def test_journal_sync(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = Journal(path, sync_every=3, sync_interval=60)
+    with patch('emacontrol.journal.os.fsync') as fsync_mock:
+        journal.sent('moveGate;')
+        journal.received('moveGate:done;')
+        # Records reach the file straight away, but are synced in batches
+        assert open(path).read() == 'S moveGate;\nR moveGate:done;\n'
+        assert fsync_mock.call_count == 0
+        journal.sent('moveHome;')
+        assert fsync_mock.call_count == 1
+        journal.failed(OSError('timed\nout'))
+        journal.close()
+        assert fsync_mock.call_count == 2
+    assert open(path).read().splitlines()[-1] == 'F timed out'
+
+
+def test_replay(tmp_path):
+    path = tmp_path / 'journal'
+    path.write_text('C {"coords": [3, 6], "mounted": 37, "location": '
+                    '"offside"}\n'
+                    'B unmount moveSpinner; samplePick; moveGate; '
+                    'moveCoords; sampleRelease;\n'
+                    'S moveSpinner;\nR moveSpinner:done;\n'
+                    'S samplePick;\nR samplePick:done;\n'
+                    'S moveGate;\nR moveGate:do')
+    recovery = replay(str(path), Magazine())
+    # The last record was cut off by the crash
+    assert recovery.describe() == ('unmount stopped at step 3 of 5 '
+                                   '(moveGate;): sample 37 picked, at spinner')
+    assert recovery.in_flight == 'moveGate;'
+    assert [step.message for step in recovery.remaining()] == [
+        'moveGate;', 'setCoords:#X3#Y6;', 'moveCoords;', 'sampleRelease;']
+    assert recovery.resumable is True
+
+    # Aborted after the move failed: the same steps are left, but only to be
+    # finished once the robot has been checked
+    path.write_text(path.read_text().rpartition('\n')[0]
+                    + "\nR moveGate:fail_'Blocked';\nA moveGate failed\n")
+    recovery = replay(str(path), Magazine())
+    assert recovery.describe().startswith('unmount aborted at step 3 of 5')
+    assert (recovery.unfinished, recovery.resumable) == (True, False)
+    assert recovery.remaining().steps[0].message == 'moveGate;'
+
+    path.write_text('S moveGate;\nR moveGate:done;\n')
+    recovery = replay(str(path), Magazine())
+    assert recovery.unfinished is False
+    assert recovery.remaining() is None
+    assert recovery.describe() == 'no sample on the spinner, at gate'
+    assert replay(str(tmp_path / 'none'), Magazine()).state.location is None
+
+
+def test_recover_and_resume(tmp_path):
+    path = str(tmp_path / 'journal')
+    with ControllerSimulator() as simulator:
+        with Robot(robot_host=simulator.host, robot_port=simulator.port,
+                   journal=path) as ema:
+            ema.power_on()
+            ema.mount(37)
+            simulator.inject_failure('moveGate')
+            with pytest.raises(SequenceError):
+                ema.exchange(12)
+
+        # The software is restarted. The exchange was aborted by the failure,
+        # so isn't finished unless the user says so
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port,
+                    journal=path)
+        recovery = ema.recover()
+        assert recovery.describe() == ('exchange aborted at step 3 of 12 '
+                                       '(moveGate;): sample 37 picked')
+        assert recovery.resumable is False
+        assert ema.sample_mounted is False
+        simulator.received.clear()
+        with redirect_stdout(io.StringIO()):
+            with pytest.raises(RuntimeError, match='exchange was not '):
+                robot_begin(ema, interactive=False)
+            with patch('builtins.input', side_effect=['', 'n']):
+                robot_begin(ema)
+        assert [msg for _, msg in simulator.received] == ['powerOn;']
+
+        simulator.received.clear()
+        result = ema.resume()
+        assert result.steps[0].message == 'moveGate;'
+        # The coordinates of sample 37 are set again before moving to it
+        assert [msg for _, msg in simulator.received][:4] == [
+            'moveGate;', 'setCoords:#X3#Y6;', 'moveCoords;', 'sampleRelease;']
+        assert ema.sample_index == 12
+        assert ema.sample_mounted is True
+        assert ema.resume() is None
+        # The journal is compacted once nothing is left to finish
+        assert len(open(path).readlines()) == 1
+        assert replay(path, Magazine()).mounted == 12
+
+        # The software crashed waiting for a reply to samplePick, which the
+        # robot carried out
+        with open(path, 'a') as journal:
+            journal.write('B unmount moveSpinner; samplePick; moveGate; '
+                          'moveCoords; sampleRelease;\n'
+                          'S moveSpinner;\nR moveSpinner:done;\n'
+                          'S samplePick;\n')
+        simulator.gripper_closed = True
+        simulator.received.clear()
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port,
+                    journal=path)
+        with redirect_stdout(io.StringIO()) as output:
+            robot_begin(ema, interactive=False)
+        assert ('Recovered from journal: unmount stopped at step 2 of 5 '
+                '(samplePick;): sample 12 on the spinner') in output.getvalue()
+        assert [msg for _, msg in simulator.received] == [
+            'powerOn;', 'getGripperState;', 'moveGate;', 'setCoords:#X1#Y1;',
+            'moveCoords;', 'sampleRelease;']
+        assert ema.sample_mounted is False
+        assert replay(path, Magazine()).describe() == \
+            'no sample on the spinner, at magazine'
+
+
+def test_begin_with_new_journal(tmp_path):
+    # Nothing is known from the journal, so the coordinates set on the
+    # controller are checked for a sample left on the spinner
+    with ControllerSimulator() as simulator:
+        simulator.coords = [4, 2]
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port,
+                    journal=str(tmp_path / 'journal'))
+        with redirect_stdout(io.StringIO()) as output:
+            robot_begin(ema, interactive=False)
+        assert 'Current sample is 43 (not 1!)' in output.getvalue()
+        assert ema.sample_index == 43
+        assert [msg for _, msg in simulator.received] == [
+            'getCoords;', 'powerOn;']
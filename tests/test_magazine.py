@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from emacontrol.magazine import Magazine
+
+
+def test_lookup_tables():
+    magazine = Magazine(rows=3, columns=4, magazines=2, blocked=[5])
+    assert magazine.capacity == 24
+    assert magazine.index_to_xy(1) == (0, 0)
+    assert magazine.index_to_xy(4) == (0, 3)
+    assert magazine.index_to_xy(13) == (3, 0)  # First row of 2nd magazine
+    assert magazine.index_to_xy(24) == (5, 3)
+    for n in (1, 7, 13, 24):
+        assert magazine.xy_to_index(*magazine.index_to_xy(n)) == n
+
+    with pytest.raises(ValueError, match=r'.*greater than 0'):
+        magazine.index_to_xy(0)
+    with pytest.raises(ValueError, match=r'.*outside the magazine.*'):
+        magazine.index_to_xy(25)
+    with pytest.raises(ValueError, match=r'.*blocked'):
+        magazine.index_to_xy(5)
+    with pytest.raises(ValueError, match=r'Expecting integer.*'):
+        magazine.index_to_xy(1.5)
+    with pytest.raises(ValueError, match=r'No sample position.*'):
+        magazine.xy_to_index(6, 0)
+
+
+def test_validate():
+    magazine = Magazine(blocked=[5])
+    plan = list(range(1, 5)) + list(range(6, 300))
+    assert (magazine.validate(plan) == plan).all()
+
+    # Every problem is reported at once
+    with pytest.raises(ValueError) as err:
+        magazine.validate([1, 5, 0, 301, 2.5, 3.0])
+    assert 'Invalid sample indices: 5 (position 2), 0 (position 3), ' \
+        '301 (position 4), 2.5 (position 5)' in str(err.value)
+    # Anything which converts to a number is checked as one...
+    assert magazine.validate(['1', np.int64(2), 3.0]).tolist() == [1, 2, 3]
+    # ...and every entry which doesn't is reported
+    with pytest.raises(ValueError) as err:
+        magazine.validate([1, 'a', None, '4'])
+    assert "Expecting numeric sample indices. Got: 'a' (position 2), " \
+        'None (position 3)' in str(err.value)
+
+    xy = magazine.indices_to_xy([1, 2, 11, 300])
+    assert xy.tolist() == [[0, 0], [0, 1], [1, 0], [29, 9]]
+    assert np.allclose(magazine.positions([1, 12]),
+                       [[0, 0], [17.03, 17.0]])
+
+
+def test_from_config(tmp_path):
+    assert Magazine.from_config(str(tmp_path / 'missing.ini')).capacity == 300
+    assert Magazine.from_config('./example_config.ini').capacity == 300
+
+    config_file = tmp_path / 'robot.ini'
+    config_file.write_text('[magazine]\nrows = 5\ncolumns = 8\n'
+                           'magazines = 2\npitch_x = 20\nblocked = 3, 4\n')
+    magazine = Magazine.from_config(str(config_file))
+    assert magazine.capacity == 80
+    assert magazine.pitch == (20.0, 17.0)
+    assert magazine.blocked == {3, 4}
+    assert magazine.index_to_xy(9) == (1, 0)
@@ -1,17 +1,69 @@
+import errno
+import os
 import pytest
-from mock import call, patch
+import socket
+import time
+from mock import ANY, call, patch
 
-from emacontrol.network import SocketConnector
+from emacontrol.network import (MessageFramer, SocketConnector,
+                                read_peer_config)
 
 
-def test_read_config():
+def recv_into_chunks(*chunks):
+    """
+    Side effect for a mocked socket recv_into, which receives each of the
+    given chunks in turn (repeating the last one)
+    """
+    chunks = list(chunks)
+
+    def recv_into(buffer, nbytes=0):
+        chunk = chunks.pop(0) if len(chunks) > 1 else chunks[0]
+        chunk = chunk[:len(buffer)]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
+
+
+@pytest.fixture(autouse=True)
+def wait_read_mock():
+    # Mocked sockets can't be waited on, so treat them as always readable
+    with patch('emacontrol.network.wait_read') as wait_mock:
+        yield wait_mock
+
+
+@pytest.fixture(autouse=True)
+def wait_write_mock():
+    # ... and always writable
+    with patch('emacontrol.network.wait_write') as wait_mock:
+        yield wait_mock
+
+
+def connects(sock_mock):
+    # A mocked non-blocking socket which connects straight away
+    sock_mock().connect_ex.return_value = 0
+    return sock_mock
+
+
+def test_read_config(tmp_path):
     sock_conn = SocketConnector(None, None, config_file='./example_config.ini')
     sock_conn._read_config()
     assert sock_conn.peer == ('127.0.0.2', 10005)
 
+    # Config is cached, but only until the file is changed
+    config_file = tmp_path / 'robot.ini'
+    config_file.write_text('[robot]\naddress = 127.0.0.4\nport = 10007\n')
+    assert read_peer_config(str(config_file)) == ('127.0.0.4', 10007)
+    with patch('configparser.ConfigParser') as parser_mock:
+        assert read_peer_config(str(config_file)) == ('127.0.0.4', 10007)
+        parser_mock.assert_not_called()
+    config_file.write_text('[robot]\naddress = 127.0.0.4\nport = 10008\n')
+    os.utime(str(config_file), ns=(0, 0))
+    assert read_peer_config(str(config_file)) == ('127.0.0.4', 10008)
+
 
 @patch('socket.socket')
 def test_is_connected(sock_mock):
+    connects(sock_mock)
     sock_conn = SocketConnector(host='127.0.0.3', port=10006)
 
     assert sock_conn.is_connected() is False
@@ -29,6 +81,7 @@ def test_is_connected(sock_mock):
 
 @patch('socket.socket')
 def test__connect__disconnect(sock_mock):
+    connects(sock_mock)
     sock_conn = SocketConnector(host='127.0.0.3', port=10006)
 
     # A normal connection
@@ -44,6 +97,7 @@ def test__connect__disconnect(sock_mock):
 
 @patch('socket.socket')
 def test__send__FullMessages(sock_mock):
+    connects(sock_mock)
     # The test assume that the socket is always correctly connected when
     # fileno is queried
     sock_mock().fileno.return_value = 11
@@ -51,16 +105,18 @@ def test__send__FullMessages(sock_mock):
     message = 'ACommandWithParameters:#P1#P2;'
     msg_reply = 'ACommandWithParameters:done;'
     sock_mock().send.return_value = len(message)
-    sock_mock().recv.return_value = msg_reply.encode()
+    sock_mock().recv_into.side_effect = recv_into_chunks(msg_reply.encode())
 
     sock_conn = SocketConnector(host='127.0.0.3', port=10006)
     reply = sock_conn.__send__(message)
 
     assert reply == msg_reply
-    sock_calls = [call.connect(('127.0.0.3', 10006)),
+    sock_calls = [call.setblocking(False),
+                  call.connect_ex(('127.0.0.3', 10006)),
                   call.send(message.encode()),
                   # call.shutdown(socket.SHUT_WR),
-                  call.recv(1024),
+                  call.fileno(),  # This from waiting for the reply
+                  call.recv_into(ANY),
                   call.fileno(),  # This from is_connected()
                   call.close()]
     sock_mock().assert_has_calls(sock_calls)
@@ -68,6 +124,7 @@ def test__send__FullMessages(sock_mock):
 
 @patch('socket.socket')
 def test__send__PartialMessages(sock_mock):
+    connects(sock_mock)
     # The test assume that the socket is always correctly connected when
     # fileno is queried
     sock_mock().fileno.return_value = 11
@@ -76,27 +133,193 @@ def test__send__PartialMessages(sock_mock):
 
     # Same again, but now the messages are sent and received in pieces
     sock_mock().send.side_effect = [5, 10, 7, 8]
-    sock_mock().recv.side_effect = [b'ACommandWithP',
-                                    b'arameters:',
-                                    b'done;']
+    sock_mock().recv_into.side_effect = recv_into_chunks(b'ACommandWithP',
+                                                         b'arameters:',
+                                                         b'done;')
 
     sock_conn = SocketConnector(host='127.0.0.3', port=10006)
     reply = sock_conn.__send__(message)
 
     assert reply == msg_reply
+    sent = [args[0] for _, args, _ in sock_mock().send.mock_calls]
+    assert sent == [message.encode(), message[5:].encode(),
+                    message[15:].encode(), message[22:].encode()]
 
 
 @patch('socket.socket')
 def test__send__NoDelimMessage(sock_mock):
+    connects(sock_mock)
     # The test assume that the socket is always correctly connected when
     # fileno is queried
     sock_mock().fileno.return_value = 11
     message = 'ACommandWithParameters:#P1#P2;'
     msg_reply = 'ACommandWithParameters:done'  # N.B. Removed delimiter
     sock_mock().send.return_value = len(message)
-    sock_mock().recv.return_value = msg_reply.encode()
+    sock_mock().recv_into.side_effect = recv_into_chunks(msg_reply.encode())
 
     sock_conn = SocketConnector(host='127.0.0.3', port=10006,
                                 socket_timeout=0.5)
     with pytest.raises(RuntimeError, match=r".*delimiter.*"):
         sock_conn.__send__(message)
+
+
+@patch('select.select')
+@patch('socket.socket')
+def test__send__Persistent(sock_mock, select_mock):
+    connects(sock_mock)
+    sock_mock().fileno.return_value = 11
+    select_mock.return_value = ([], [], [])
+    message = 'ACommandWithParameters:#P1#P2;'
+    msg_reply = 'ACommandWithParameters:done;'
+    sock_mock().send.return_value = len(message)
+    sock_mock().recv_into.side_effect = recv_into_chunks(msg_reply.encode())
+    sock_mock.reset_mock()
+
+    sock_conn = SocketConnector(host='127.0.0.3', port=10006,
+                                persistent=True)
+    assert sock_conn.__send__(message) == msg_reply
+    assert sock_conn.__send__(message) == msg_reply
+
+    # One connection for both messages and it is still open afterwards
+    assert sock_mock().connect_ex.call_count == 1
+    sock_mock().close.assert_not_called()
+    assert sock_conn.is_connected() is True
+
+    sock_conn.close()
+    sock_mock().close.assert_called_once_with()
+    assert sock_conn.is_connected() is False
+    assert sock_conn.persistent is False
+
+
+@patch('select.select')
+@patch('socket.socket')
+def test__send__PersistentReconnect(sock_mock, select_mock):
+    connects(sock_mock)
+    sock_mock().fileno.return_value = 11
+    message = 'ACommandWithParameters:#P1#P2;'
+    msg_reply = 'ACommandWithParameters:done;'
+    sock_mock().send.return_value = len(message)
+    sock_mock().recv_into.side_effect = recv_into_chunks(msg_reply.encode())
+    sock_mock.reset_mock()
+
+    with SocketConnector(host='127.0.0.3', port=10006) as sock_conn:
+        assert sock_conn.persistent is True
+        assert sock_mock().connect_ex.call_count == 1
+
+        # Controller went away: socket is readable, but there's no data
+        select_mock.return_value = ([sock_conn.sock], [], [])
+        sock_mock().recv.return_value = b''
+        assert sock_conn.__send__(message) == msg_reply
+        assert sock_mock().connect_ex.call_count == 2
+        sock_mock().recv.assert_any_call(1, socket.MSG_PEEK)
+
+    assert sock_conn.is_connected() is False
+
+
+@patch('select.select')
+@patch('socket.socket')
+def test__send__PersistentClosedByPeer(sock_mock, select_mock):
+    connects(sock_mock)
+    sock_mock().fileno.return_value = 11
+    select_mock.return_value = ([], [], [])
+    message = 'ACommandWithParameters:#P1#P2;'
+    sock_mock().send.return_value = len(message)
+    sock_mock().recv_into.return_value = 0
+
+    sock_conn = SocketConnector(host='127.0.0.3', port=10006,
+                                persistent=True)
+    with pytest.raises(RuntimeError, match=r'.*closed.*'):
+        sock_conn.__send__(message)
+    # A broken connection is not kept
+    assert sock_conn.sock is None
+
+
+def test_connection_locks():
+    # Each connection has its own lock
+    first = SocketConnector(host='127.0.0.3', port=10006)
+    second = SocketConnector(host='127.0.0.4', port=10006)
+    assert first._lock is not second._lock
+
+
+def test_message_framer():
+    class FakeSocket(object):
+        def __init__(self, *chunks):
+            self.recv_into = recv_into_chunks(*chunks)
+
+    framer = MessageFramer(size=32)
+    assert framer.next_message() is None
+
+    # Two messages in one chunk, with null padding
+    framer.receive(FakeSocket(b'moveGate:done;\x00\x00\x00getCoords:#X'))
+    assert framer.next_message() == 'moveGate:done;'
+    assert framer.next_message() is None
+
+    # Rest of the message arrives, so the start of the buffer is reused
+    framer.receive(FakeSocket(b'1#Y2;;\x00\x00'))
+    assert framer.next_message() == 'getCoords:#X1#Y2;'
+    # Empty messages are skipped
+    assert framer.next_message() is None
+    assert framer.start == framer.end
+
+    framer.receive(FakeSocket(b'x' * 32))
+    with pytest.raises(RuntimeError, match=r'No message delimiter.*'):
+        framer.receive(FakeSocket(b'x'))
+
+
+@patch('socket.socket')
+def test__send__Timeouts(sock_mock, wait_read_mock):
+    connects(sock_mock)
+    sock_mock().fileno.return_value = 11
+    message = 'ACommandWithParameters:#P1#P2;'
+    sock_mock().send.return_value = len(message)
+    sock_conn = SocketConnector(host='127.0.0.3', port=10006,
+                                socket_timeout=0.2)
+
+    # Nothing arrives before the deadline
+    wait_read_mock.side_effect = socket.timeout
+    with pytest.raises(RuntimeError, match=r'.*delimiter.*timeout'):
+        sock_conn.__send__(message)
+
+    # The socket keeps failing: retries stop at the deadline
+    sock_mock().send.side_effect = socket.error
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match=r'.*not sent.*timeout'):
+        sock_conn.__send__(message)
+    assert time.monotonic() - start < 0.5
+    assert sock_conn.instrumentation.stats['ACommandWithParameters'][
+        'retries'] > 0
+
+
+@patch('socket.socket')
+def test__send__NonBlocking(sock_mock, wait_write_mock):
+    connects(sock_mock)
+    sock_mock().fileno.return_value = 11
+    message = 'ACommandWithParameters:#P1#P2;'
+    msg_reply = 'ACommandWithParameters:done;'
+    sock_mock().recv_into.side_effect = recv_into_chunks(msg_reply.encode())
+    sock_conn = SocketConnector(host='127.0.0.3', port=10006,
+                                socket_timeout=0.2)
+
+    # The connection is still being made, so the connector waits (letting
+    # other greenlets run) until the deadline
+    sock_mock().connect_ex.return_value = errno.EINPROGRESS
+    sock_mock().getsockopt.return_value = 0
+    # The send buffer is full at first
+    sock_mock().send.side_effect = [BlockingIOError, len(message)]
+    assert sock_conn.__send__(message) == msg_reply
+    assert wait_write_mock.call_count == 2
+    for _, args, kwargs in wait_write_mock.mock_calls:
+        assert 0 < kwargs['timeout'] <= 0.2
+
+    # A controller which never accepts the connection
+    wait_write_mock.side_effect = socket.timeout
+    with pytest.raises(RuntimeError, match=r'Connection .* not made before '
+                                           r'timeout'):
+        sock_conn.__send__(message)
+    assert sock_conn.sock is None
+
+    # Or refuses it
+    wait_write_mock.side_effect = None
+    sock_mock().getsockopt.return_value = errno.ECONNREFUSED
+    with pytest.raises(ConnectionRefusedError):
+        sock_conn.__send__(message)
@@ -0,0 +1,67 @@
+import time
+
+import gevent
+import pytest
+
+from emacontrol.ema import Robot
+from emacontrol.operation import OperationCancelled
+from emacontrol.sequence import SequenceError
+from emacontrol.simulator import ControllerSimulator
+
+
+def test_operation():
+    with ControllerSimulator(motion_time=0.01) as simulator:
+        with Robot(robot_host=simulator.host,
+                   robot_port=simulator.port) as ema:
+            with pytest.raises(ValueError):
+                ema.start_mount(0)
+
+            operation = ema.start_mount(12)
+            progress = []
+            operation.on_progress(
+                lambda op, step: progress.append((step.message, len(op.steps),
+                                                  op.total_steps)))
+            assert operation.done() is False
+            result = operation.wait(timeout=5)
+            assert operation.done() is True
+            assert [step.message for step in result.steps] == [
+                message for message, _, _ in progress]
+            assert progress[0] == ('setCoords:#X1#Y1;', 1, 7)
+            assert progress[-1] == ('moveOffside;', 7, 7)
+            assert ema.sample_mounted is True
+            assert operation.cancel() is False
+
+            # Errors are raised when waiting
+            simulator.inject_failure('samplePick')
+            operation = ema.start_exchange(13)
+            with pytest.raises(SequenceError, match=r'.*samplePick.*'):
+                operation.wait(timeout=5)
+        assert ema._control.is_connected() is False
+
+
+def test_cancel():
+    with ControllerSimulator(durations={'moveGate': 1}) as simulator:
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port)
+        operation = ema.start_mount(12)
+        while simulator.location != 'magazine' or not simulator.gripper_closed:
+            gevent.sleep(0.01)
+        gevent.sleep(0.05)
+        assert simulator.received[-1][1] == 'moveGate;'
+
+        # The robot is interrupted without waiting for the move
+        start = time.perf_counter()
+        assert operation.cancel() is True
+        with pytest.raises(OperationCancelled,
+                           match=r'Mount cancelled after 3 steps'):
+            operation.wait(timeout=1)
+        assert time.perf_counter() - start < 0.3
+        assert simulator.received[-1] == (0, 'interrupt;')
+        assert ema.sample_mounted is False
+        assert ema.state.location is None
+        assert repr(operation) == '<Operation mount (cancelled)>'
+
+        # The move continues after a restart
+        ema.restart()
+        while simulator.location != 'gate':
+            gevent.sleep(0.01)
+        ema.close_control_channel()
@@ -0,0 +1,65 @@
+import itertools
+
+import pytest
+
+from emacontrol.magazine import Magazine
+from emacontrol.planner import plan_run, travel_cost
+
+
+def brute_force(samples, cost, start=None):
+    best = None
+    for order in itertools.permutations(samples):
+        path = ([start] if start is not None else []) + list(order)
+        total = sum(cost(a, b) for a, b in zip(path[:-1], path[1:]))
+        if best is None or total < best:
+            best = total
+    return best
+
+
+def test_plan_run():
+    magazine = Magazine()
+    cost = travel_cost(magazine)
+    assert cost(1, 2) == pytest.approx(17.0 / 50)
+    assert cost(1, 11) == pytest.approx(17.03 / 50)
+
+    # Samples along one column, given in a scrambled order
+    samples = [291, 1, 151, 31, 261, 91, 211, 61]
+    plan = plan_run(samples)
+    assert plan.order in (sorted(samples), sorted(samples, reverse=True))
+    assert plan.expected_time == pytest.approx(29 * 17.03 / 50)
+    assert plan.original_time == pytest.approx(
+        sum(cost(a, b) for a, b in zip(samples[:-1], samples[1:])))
+    assert plan.saving > 0
+
+    # With a starting sample, the run begins next to it
+    plan = plan_run(samples, start=281)
+    assert plan.order == sorted(samples, reverse=True)
+
+    for samples in ([5, 123, 77, 300, 18, 240], [7, 7, 150, 2]):
+        plan = plan_run(samples, start=40)
+        assert sorted(plan.order) == sorted(samples)
+        assert plan.expected_time == pytest.approx(
+            brute_force(samples, cost, start=40))
+
+    assert plan_run([]).order == []
+    assert plan_run([42], start=41).expected_time == pytest.approx(17.0 / 50)
+    with pytest.raises(ValueError, match=r'Invalid sample indices: 301.*'):
+        plan_run([1, 301])
+
+
+def test_plan_run_leg_cost():
+    # Moving towards higher indices is slower than moving back
+    def leg_cost(a, b):
+        return abs(b - a) + (5.0 if b > a else 0.0)
+
+    samples = [3, 9, 1, 6, 4]
+    plan = plan_run(samples, leg_cost=leg_cost)
+    assert plan.order == [9, 6, 4, 3, 1]
+    assert plan.expected_time == 8.0
+    assert plan.original_time == 31.0
+    assert plan.saving == 23.0
+    assert plan.expected_time == brute_force(samples, leg_cost)
+
+    big = Magazine(rows=40, columns=20, magazines=2)
+    plan = plan_run(range(1, 1601, 7), magazine=big)
+    assert plan.saving >= 0
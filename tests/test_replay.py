@@ -0,0 +1,132 @@
+import pytest
+
+from emacontrol.commands import COMMANDS
+from emacontrol.ema import Robot
+from emacontrol.recorder import TrafficRecorder, read_log
+from emacontrol.replay import (ReplayController, Session, main,
+                               replay_session)
+from emacontrol.simulator import ControllerSimulator
+
+
+@pytest.fixture
+def session_log(tmp_path):
+    """
+    Records a session: a mount, a failed move and a status read on the
+    control channel
+    """
+    path = str(tmp_path / 'session.log.gz')
+    with ControllerSimulator(durations={'moveGate': 0.2}) as simulator, \
+            TrafficRecorder(path) as recorder:
+        with Robot(robot_host=simulator.host, robot_port=simulator.port,
+                   recorder=recorder) as ema:
+            ema.power_on()
+            ema.mount(12)
+            simulator.inject_failure('moveHome', 'Blocked')
+            with pytest.raises(RuntimeError, match='failed'):
+                ema.send('moveHome;', 'moveHome:done;')
+            ema.send_control(COMMANDS['getCoords'])
+    return path
+
+
+def test_recorder(session_log):
+    records = read_log(session_log)
+    assert [(r.conn, r.kind, r.text) for r in records[:3]] == [
+        (1, 'O', '127.0.0.1:{}'.format(records[0].text.split(':')[1])),
+        (1, '>', 'powerOn;'), (1, '<', 'powerOn:done;')]
+    assert all(a.time <= b.time for a, b in zip(records, records[1:]))
+    assert (1, '<', "moveHome:fail_'Blocked';") in [
+        (r.conn, r.kind, r.text) for r in records]
+    # The control channel is a second connection
+    assert [(r.conn, r.kind) for r in records if r.text == 'getCoords;'] == [
+        (2, '>')]
+    assert {(r.conn, r.kind) for r in records if r.kind in 'OC'} == {
+        (1, 'O'), (2, 'O'), (1, 'C'), (2, 'C')}
+
+    session = Session(records)
+    moves = [e for e in session.exchanges if e.message == 'moveGate;']
+    assert moves[0].wait >= 0.2
+
+
+def test_recorder_flush(tmp_path):
+    path = str(tmp_path / 'session.log')
+    recorder = TrafficRecorder(path)
+    recorder.sent(1, 'moveGate;')
+    assert read_log(path) == []
+    # Failures are written straight away
+    recorder.received(1, "moveGate:fail_'Blocked';")
+    recorder.failed(1, 'Connection closed before reply was received')
+    assert [r.kind for r in read_log(path)] == ['>', '<', '!']
+    recorder.close()
+
+
+def test_replay(session_log, capsys):
+    session = Session.from_log(session_log)
+    report = replay_session(session, scale=0)
+    assert report.mismatches == []
+    assert report.elapsed < session.duration
+    # The failure of the session is seen by the client again
+    errors = [(e.message, e.replayed_error) for e in session.exchanges
+              if e.replayed_error is not None]
+    assert errors == [('moveHome;',
+                       'Robot failed while running message "moveHome;"')]
+
+    # At the recorded speed, the moves take as long as they did
+    session = Session.from_log(session_log)
+    report = replay_session(session)
+    assert report.elapsed >= 0.2
+    assert report.mismatches == []
+
+    assert main([session_log, '--fast']) == 0
+    output = capsys.readouterr().out
+    assert 'replayed in' in output
+    assert '0 replies differ from the recording' in output
+
+    for speed in ('0', '-2', 'fast'):
+        with pytest.raises(SystemExit):
+            main([session_log, '--speed', speed])
+
+
+def test_replay_timeout(tmp_path):
+    # The controller never replied and the client gave up
+    path = tmp_path / 'session.log'
+    path.write_text('0.000000 1 O 127.0.0.1:10005\n'
+                    '0.010000 1 > moveGate;\n'
+                    '0.110000 1 ! No message delimiter received before '
+                    'timeout\n'
+                    '0.110100 1 C\n'
+                    '0.120000 2 O 127.0.0.1:10005\n'
+                    '0.130000 2 > getCoords;\n'
+                    '0.131000 2 < getCoords:#X1#Y1;\n')
+    session = Session.from_log(str(path))
+    report = replay_session(session)
+    assert report.mismatches == []
+    assert 'timeout' in session.exchanges[0].replayed_error
+    assert session.exchanges[1].replayed_reply == 'getCoords:#X1#Y1;'
+
+
+def test_replay_controller(tmp_path):
+    path = tmp_path / 'session.log'
+    path.write_text('0.000000 1 O 127.0.0.1:10005\n'
+                    '0.010000 1 > getCoords;\n'
+                    '0.011000 1 < getCoords:#X1#Y1;\n')
+    with ReplayController(Session.from_log(str(path)), 0) as controller:
+        controller.expect(1)
+        with Robot(robot_host=controller.host,
+                   robot_port=controller.port) as ema:
+            # Messages which aren't in the recording are failed
+            with pytest.raises(RuntimeError, match='failed'):
+                ema.send('getSpeed;')
+            assert ema.send('getCoords;', parse=False) == 'getCoords:#X1#Y1;'
+
+
+def test_replay_long_reply(tmp_path):
+    # Replies longer than 32 bytes are replayed whole
+    path = tmp_path / 'session.log'
+    path.write_text('0.000000 1 O 127.0.0.1:10005\n'
+                    '0.010000 1 > setCoords:#X1#Y1;\n'
+                    "0.011000 1 < setCoords:fail_'Could not convert "
+                    "position to joint';\n")
+    session = Session.from_log(str(path))
+    report = replay_session(session, scale=0)
+    assert report.mismatches == []
+    assert 'failed' in session.exchanges[0].replayed_error
@@ -0,0 +1,56 @@
+import pytest
+
+from emacontrol.ema import Robot
+from emacontrol.sequence import (MOUNT, UNMOUNT, Sequence, SequenceError,
+                                 Step, command_step, coords_step)
+from emacontrol.simulator import ControllerSimulator
+
+
+def test_sequence():
+    step = command_step('moveGate')
+    assert (step.message, step.wait_for) == ('moveGate;', 'moveGate:done;')
+    assert step.data == b'moveGate;'
+
+    sequence = UNMOUNT + coords_step(7, 4) + MOUNT
+    assert sequence.name == 'unmount+mount'
+    assert len(sequence) == 12
+    assert [s.message for s in sequence][4:7] == [
+        'sampleRelease;', 'setCoords:#X7#Y4;', 'moveCoords;']
+    assert (coords_step(1, 2) + MOUNT).name == 'mount'
+    assert len(Sequence('test', [('hello;', 'world;'), step])) == 2
+
+
+def test_run_sequence():
+    sequence = Sequence('test', [Step('hello;', 'world;'),
+                                 coords_step(3, 9),
+                                 command_step('moveCoords'),
+                                 command_step('samplePick'),
+                                 command_step('moveGate')])
+    with ControllerSimulator(durations={'samplePick': 0.05}) as simulator:
+        ema = Robot(robot_host=simulator.host, robot_port=simulator.port)
+        result = ema.run_sequence(sequence)
+        assert [msg for _, msg in simulator.received] == [
+            step.message for step in sequence]
+        assert [step.reply for step in result.steps] == [
+            'world;', 'setCoords:done;', 'moveCoords:done;',
+            'samplePick:done;', 'moveGate:done;']
+        assert result.steps[3].duration >= 0.05
+        assert result.total == pytest.approx(
+            sum(step.duration for step in result.steps))
+        assert result.format().startswith('test (5 steps, ')
+        assert simulator.location == 'gate'
+        # All sent on one connection, which was then closed
+        assert ema.persistent is False
+        assert ema.instrumentation.stats['hello']['connect'] < 0.1
+
+        # Stops at the first failure
+        del simulator.received[:]
+        simulator.inject_failure('moveCoords')
+        with pytest.raises(SequenceError) as err:
+            ema.run_sequence(sequence)
+        assert err.value.index == 2
+        assert err.value.step.message == 'moveCoords;'
+        assert len(err.value.result.steps) == 3
+        assert 'FAILED' in err.value.result.format().splitlines()[-1]
+        assert len(simulator.received) == 3
+        assert isinstance(err.value, RuntimeError)
@@ -0,0 +1,140 @@
+import gevent
+import pytest
+import socket
+import threading
+import time
+
+from emacontrol.ema import Robot
+from emacontrol.simulator import ControllerSimulator
+
+
+@pytest.fixture
+def simulator():
+    with ControllerSimulator() as sim:
+        yield sim
+
+
+def raw_exchange(address, message):
+    with socket.create_connection(address, timeout=5) as sock:
+        sock.sendall(message)
+        return sock.recv(1024)
+
+
+def test_reply_framing(simulator):
+    # Replies fill the 64 byte message array of sendStatus
+    reply = raw_exchange(simulator.address, b'hello;')
+    assert reply == b'world;'.ljust(64, b'\x00')
+
+    reply = raw_exchange(simulator.address, b'hello')
+    assert reply.strip(b'\x00') == b":fail_'No message end';"
+
+    reply = raw_exchange(simulator.address, b'squirrel;')
+    assert reply.strip(b'\x00') == b":fail_'Unrecognised Command!';"
+
+
+def test_robot_commands(simulator):
+    with Robot(robot_host=simulator.host,
+               robot_port=simulator.port) as ema:
+        ema.send('powerOn;', wait_for='powerOn:done;')
+        assert ema.send('getPowerState;')['state'] == {0: 'On'}
+
+        ema.set_sample_coords(75)
+        assert ema.send('getCoords;')['state'] == {'X': 7, 'Y': 4}
+        assert simulator.coords == [7, 4]
+
+        ema.send('moveCoords;', wait_for='moveCoords:done;')
+        ema.send('samplePick;', wait_for='samplePick:done;')
+        assert simulator.location == 'magazine'
+        assert ema.send('getGripperState;')['result'] == 'closed'
+
+    assert simulator.received[0] == (0, 'powerOn;')
+
+
+def test_failure_injection(simulator):
+    simulator.inject_failure('moveGate', 'Blocked', times=2)
+    with Robot(robot_host=simulator.host,
+               robot_port=simulator.port) as ema:
+        for _ in range(2):
+            with pytest.raises(RuntimeError, match=r'.*failed.*'):
+                ema.send('moveGate;', wait_for='moveGate:done;')
+        ema.send('moveGate;', wait_for='moveGate:done;')
+        assert simulator.location == 'gate'
+
+
+def test_long_failure_reply(simulator):
+    # Longer than the 32 byte buffer messages are received into, but replies
+    # are sent from the 64 byte buffer of sendStatus
+    reason = 'Could not convert position to joint'
+    simulator.inject_failure('setCoords', reason)
+    with Robot(robot_host=simulator.host, robot_port=simulator.port,
+               socket_timeout=2) as ema:
+        with pytest.raises(RuntimeError, match='failed'):
+            ema.send('setCoords:#X1#Y1;', 'setCoords:done;')
+        reply = ema.instrumentation.history[-1].reply
+    assert reply == "setCoords:fail_'{}';".format(reason)
+
+
+def test_second_connection_interrupts_motion():
+    with ControllerSimulator(durations={'moveHome': 0.3}) as simulator:
+        motion = socket.create_connection(simulator.address, timeout=5)
+        motion.sendall(b'moveHome;')
+        time.sleep(0.05)
+
+        # The second slot is free while the first is waiting for the move
+        reply = raw_exchange(simulator.address, b'interrupt;')
+        assert reply.strip(b'\x00') == b'interrupt:done;'
+        motion.settimeout(0.5)
+        with pytest.raises(socket.timeout):
+            motion.recv(1024)
+
+        reply = raw_exchange(simulator.address, b'restart;')
+        assert reply.strip(b'\x00') == b'restart:done;;'
+        assert motion.recv(1024).strip(b'\x00') == b'moveHome:done;'
+        motion.close()
+
+
+def test_robots_exchange_concurrently():
+    # Two robots on two controllers can move at the same time
+    with ControllerSimulator(motion_time=0.1) as sim_a, \
+            ControllerSimulator(motion_time=0.1) as sim_b:
+        robots = [Robot(robot_host=sim.host, robot_port=sim.port,
+                        persistent=True) for sim in (sim_a, sim_b)]
+
+        def move(robot):
+            for _ in range(3):
+                robot.send('moveGate;', wait_for='moveGate:done;')
+
+        threads = [threading.Thread(target=move, args=(robot,))
+                   for robot in robots]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.time() - start < 0.55
+        for robot in robots:
+            robot.close()
+        assert sim_a.location == sim_b.location == 'gate'
+
+
+def test_waiting_yields_to_other_greenlets():
+    ticks = []
+
+    def ticker():
+        while True:
+            gevent.sleep(0.01)
+            ticks.append(1)
+
+    with ControllerSimulator(durations={'moveGate': 0.2}) as simulator:
+        with Robot(robot_host=simulator.host, robot_port=simulator.port,
+                   socket_timeout=0.5) as ema:
+            tick_greenlet = gevent.spawn(ticker)
+            ema.send('moveGate;', wait_for='moveGate:done;')
+            assert len(ticks) > 5
+
+            # The test command never gets a reply
+            start = time.monotonic()
+            with pytest.raises(RuntimeError, match=r'.*timeout'):
+                ema.send('test;')
+            assert time.monotonic() - start < 1
+            tick_greenlet.kill()
@@ -0,0 +1,28 @@
+import pytest
+
+from emacontrol.speed import PROFILES, SpeedProfile, get_profile
+
+
+def test_speed_profile():
+    profile = SpeedProfile('test', 50, 7.5)
+    assert profile.speed_for('moveGate') == 50
+    assert profile.speed_for('moveOffside') == 50
+    assert profile.speed_for('moveSpinner') == 7.5
+    assert profile.speed_for('moveCoords') == 7.5
+    # Gripping moves use a fixed speed on the controller
+    assert profile.speed_for('samplePick') is None
+    assert profile.speed_for('setCoords') is None
+
+    with pytest.raises(ValueError, match=r'Speed must be.*'):
+        SpeedProfile('test', 101, 5)
+    with pytest.raises(ValueError, match=r'Speed must be.*'):
+        SpeedProfile('test', 50, -1)
+
+
+def test_get_profile():
+    assert get_profile('standard') is PROFILES['standard']
+    assert get_profile(None) is None
+    profile = SpeedProfile('test', 50, 7.5)
+    assert get_profile(profile) is profile
+    with pytest.raises(ValueError, match=r'Unknown speed profile.*'):
+        get_profile('ludicrous')
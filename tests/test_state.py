@@ -0,0 +1,50 @@
+from emacontrol.ema import Robot
+from emacontrol.state import ControllerState
+
+
+def update(state, message, reply):
+    try:
+        parsed = Robot.parse_message(reply)
+    except ValueError:
+        parsed = None
+    state.update(message, reply, parsed)
+
+
+def test_update():
+    state = ControllerState()
+    assert state.as_dict() == {'power': None, 'coords': None, 'speed': None,
+                               'gripper': None, 'location': None}
+
+    update(state, 'powerOn;', 'powerOn:done;')
+    update(state, 'setCoords:#X7#Y4;', 'setCoords:done;')
+    update(state, 'setSpeed:#20;', 'setSpeed:done;')
+    update(state, 'moveCoords;', 'moveCoords:done;')
+    update(state, 'samplePick;', 'samplePick:done;')
+    assert state.as_dict() == {'power': True, 'coords': (7, 4), 'speed': 20,
+                               'gripper': 'closed', 'location': 'magazine'}
+
+    update(state, 'moveSpinner;', 'moveSpinner:done;')
+    update(state, 'sampleRelease;', 'sampleRelease:done;')
+    update(state, 'hello;', 'world;')
+    assert (state.location, state.gripper) == ('spinner', 'open')
+    update(state, 'interrupt;', 'interrupt:done;')
+    assert state.location is None
+    assert state.power is True
+
+    # Queries
+    update(state, 'getCoords;', 'getCoords:#X3#Y9;')
+    update(state, 'getSpeed;', 'getSpeed:#12.5;')
+    update(state, 'getPowerState;', 'getPowerState:#Off;')
+    update(state, 'getGripperState;', 'getGripperState:closed;')
+    assert state.as_dict() == {'power': False, 'coords': (3, 9),
+                               'speed': 12.5, 'gripper': 'closed',
+                               'location': None}
+
+    # Fails, replies which can't be parsed and unknown commands all leave the
+    # state unknown
+    for message, reply in (('moveGate;', "moveGate:fail_'Stopped';"),
+                           ('moveGate;', 'garbage;'),
+                           ('setSAM:#X1;', 'setSAM:done;')):
+        update(state, 'powerOn;', 'powerOn:done;')
+        update(state, message, reply)
+        assert state.power is None
@@ -0,0 +1,53 @@
+import gevent
+
+from emacontrol.ema import Robot
+from emacontrol.simulator import ControllerSimulator
+
+
+def test_status_polling():
+    with ControllerSimulator(durations={'moveGate': 0.3}) as simulator:
+        with Robot(robot_host=simulator.host,
+                   robot_port=simulator.port) as ema:
+            assert ema.status is None
+            ema.power_on()
+            statuses = []
+            poller = ema.start_status_polling(interval=0.02)
+            poller.on_status(statuses.append)
+
+            operation = ema.start_mount(12)
+            while simulator.location != 'magazine' \
+                    or not simulator.gripper_closed:
+                gevent.sleep(0.01)
+            gevent.sleep(0.1)
+            # Status is read while the arm moves to the gate
+            assert simulator.location == 'magazine'
+            status = ema.status
+            assert status['error'] is None
+            assert status['power'] is True
+            assert status['coords'] == (1, 1)
+            assert status['gripper'] == 'closed'
+            assert status['speed'] == 5
+
+            operation.wait(timeout=5)
+            gevent.sleep(0.05)
+            assert ema.status['gripper'] == 'open'
+            assert ema.status['location'] == 'offside'
+            assert poller.running is True
+
+            # Status and moves use different connections
+            motion = {slot for slot, msg in simulator.received
+                      if msg == 'moveGate;'}
+            status_slots = {slot for slot, msg in simulator.received
+                            if msg == 'getCoords;'}
+            assert len(motion) == 1
+            assert status_slots.isdisjoint(motion)
+            assert len(statuses) > 5
+        assert poller.running is False
+
+    # Errors are reported in the status rather than stopping the poller
+    ema = Robot(robot_host='127.0.0.1', robot_port=simulator.port)
+    status = ema.start_status_polling(interval=0.02).read()
+    assert isinstance(status['error'], OSError)
+    assert status['coords'] is None
+    assert ema.start_status_polling().running is True
+    ema.stop_status_polling()